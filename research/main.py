@@ -1,61 +1,124 @@
+"""Search for good embeddings of TSP QUBOs into D-Wave 2000Q hardware graph.
+
+The sparsity pattern of TSP QUBO depends only on the number of locations, hence
+the QUBO structure is built once per size. Trials of minorminer's heuristic with
+different seeds are spread over a process pool, until the trial or time budget
+is exhausted or the best embedding did not improve for a number of trials.
+
+Embeddings are written as versioned JSON documents, e.g.::
+
+    python main.py --sizes 4 5 6 7 8 9 10 --trials 1000 --time-budget 600 --output-dir ../embeddings
+"""
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os, sys, inspect
+import time
 from minorminer import find_embedding
-import dwave_networkx as dnx
-import networkx as nx
-import utilities
 import numpy as np
-import pdb
-import os, sys, inspect
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
-sys.path.insert(0,parentdir) 
-
-from tsp.qubo import construct_qubo
-
-def main():
-    for graph_size in range(4, 10):
-        print("TSP size:", graph_size)
-        min_max_chain = 1000
-        min_mean_chain = 1000
-        best_embedding = None
-        for i in range(1000):
-            distance_matrix = utilities.create_random_distance_matrix(graph_size)
-            qubo_params = {'cost_constant': 10, 'constraint_constant': 400}
-            qubo_dict = construct_qubo(distance_matrix)
-
-            embedding = get_embedding(qubo_dict)
+sys.path.insert(0,parentdir)
+
+from tsp.qubo import qubo_interactions
+from tsp.registry import write_embedding
+
+DEFAULT_GRAPH = os.path.join(currentdir, 'Dwave_2000Q_edges.csv')
+
+# Hardware graph of the worker process, set once by _init_worker.
+_HARDWARE_EDGES = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Search for embeddings of TSP QUBOs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(range(4, 10)))
+    parser.add_argument('--trials', type=int, default=1000, help='maximum number of trials per size')
+    parser.add_argument('--time-budget', type=float, default=None, help='maximum number of seconds per size')
+    parser.add_argument('--patience', type=int, default=200,
+                        help='stop after that many trials without improvement')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--trial-timeout', type=float, default=60, help='timeout of a single trial')
+    parser.add_argument('--graph', default=DEFAULT_GRAPH, help='CSV file with edges of hardware graph')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    hardware_edges = load_hardware_graph(args.graph)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(hardware_edges,)) as executor:
+        for graph_size in args.sizes:
+            print("TSP size:", graph_size)
+            result = search_embedding(
+                executor, args.workers, graph_size, args.trials, args.time_budget, args.patience,
+                args.trial_timeout, args.seed)
+            if result is None:
+                print("No embedding found for size", graph_size)
+                continue
+            path = os.path.join(args.output_dir, 'embedding_' + str(graph_size) + '.json')
+            embedding, (n_qubits, max_chain, mean_chain), trials = result
+            write_embedding(path, graph_size, embedding, {
+                'qubits': n_qubits, 'max_chain': max_chain, 'mean_chain': mean_chain,
+                'trials': trials})
+            print("Saved", path, result[1])
+
+
+def load_hardware_graph(path):
+    """Read edges of hardware graph from CSV file as a list of pairs of ints."""
+    edges_array = np.genfromtxt(path, delimiter=',').astype(int)
+    return [(int(first), int(second)) for first, second in edges_array]
+
+
+def search_embedding(executor, workers, graph_size, trials, time_budget, patience, trial_timeout, seed):
+    """Run embedding trials for given size, returning (embedding, evaluation, trials) or None."""
+    structure = qubo_interactions(graph_size)
+    started = time.time()
+    best_embedding, best_evaluation = None, None
+    submitted, completed, since_improvement = 0, 0, 0
+    pending = set()
+
+    while True:
+        out_of_budget = (
+            submitted >= trials or since_improvement >= patience or
+            time_budget is not None and time.time() - started > time_budget)
+        while not out_of_budget and len(pending) < 2 * workers and submitted < trials:
+            pending.add(executor.submit(
+                get_embedding, structure, seed * 1000003 + graph_size * 10007 + submitted,
+                trial_timeout))
+            submitted += 1
+        if not pending:
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            completed += 1
+            since_improvement += 1
+            embedding = future.result()
+            if not embedding:
+                continue
             evaluation = evaluate_embedding(embedding)
-            if evaluation[1] < min_max_chain:
-                min_max_chain = evaluation[1]
-                min_mean_chain = evaluation[2]
-                best_embedding = embedding
-                print(i, evaluation)
-            elif evaluation[1] == min_max_chain:
-                if evaluation[2] < min_mean_chain:
-                    min_max_chain = evaluation[1]
-                    min_mean_chain = evaluation[2]
-                    best_embedding = embedding
-                    print(i, evaluation)
- 
-        import numpy as np
-        np.save('embedding_' + str(graph_size) + '.npy', best_embedding) 
-
-
-def get_embedding(qubo_dict):
-    # graph = dnx.chimera_graph(16, 16, 4)
-    edges_array = np.genfromtxt("Dwave_2000Q_edges.csv", delimiter=',')
-    
-    edges = []
-    for item in edges_array:
-        edges.append((item[0], item[1]))
+            if best_evaluation is None or _rank(evaluation) < _rank(best_evaluation):
+                best_embedding, best_evaluation = embedding, evaluation
+                since_improvement = 0
+                print(completed, evaluation)
+        if out_of_budget:
+            # Trials that already started can't be cancelled, we still wait for them.
+            pending = set(future for future in pending if not future.cancel())
+
+    if best_embedding is None:
+        return None
+    return best_embedding, best_evaluation, completed
+
+
+def get_embedding(structure, random_seed, timeout):
+    """Run single trial of minorminer, returning embedding or None on failure."""
     try:
-        embedding = find_embedding(qubo_dict, edges)
+        embedding = find_embedding(
+            structure, _HARDWARE_EDGES, random_seed=random_seed, timeout=timeout)
     except Exception as e:
         print(e)
-        return [np.nan, np.nan, np.nan]
+        return None
 
     if len(embedding) == 0:
-        return [np.nan, np.nan, np.nan]
-    return embedding
+        return None
+    return {int(node): [int(qubit) for qubit in chain] for node, chain in embedding.items()}
 
 
 def evaluate_embedding(embedding):
@@ -67,8 +130,19 @@ def evaluate_embedding(embedding):
     n_qubits = len(np.unique(all_chains))
     max_chain = np.max(chain_lenghts)
     mean_chain = np.mean(chain_lenghts)
-    return [n_qubits, max_chain, mean_chain]
+    return [int(n_qubits), int(max_chain), float(mean_chain)]
+
+
+def _rank(evaluation):
+    # Shorter longest chain is the most important, then mean chain and number of qubits.
+    n_qubits, max_chain, mean_chain = evaluation
+    return (max_chain, mean_chain, n_qubits)
+
+
+def _init_worker(hardware_edges):
+    global _HARDWARE_EDGES
+    _HARDWARE_EDGES = hardware_edges
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
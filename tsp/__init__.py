@@ -1,4 +1,4 @@
 """Initialization/core module of tsp."""
-from tsp.solver import sample_from_distance_matrix, sample_from_locations
+from tsp.solver import sample_batch, sample_from_distance_matrix, sample_from_locations
 
-__all__ = [sample_from_distance_matrix, sample_from_locations]
+__all__ = [sample_batch, sample_from_distance_matrix, sample_from_locations]
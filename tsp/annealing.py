@@ -0,0 +1,190 @@
+"""Simulated annealing of many replicas at once, vectorized with NumPy.
+
+Every replica is updated with single-flip Metropolis moves, sweeping over all
+variables in fixed order. Instead of looping over replicas, each move is applied
+to all replicas at once, so the cost of Python's loop is amortized over them.
+Moreover, variables are greedily partitioned into classes of mutually uncoupled
+variables, which are updated simultaneously, as flipping one of them doesn't
+change energy change of flipping the others. Local fields of all replicas are kept
+up to date (with a single matrix product per class), so that energy change of a
+flip is read from them instead of being recomputed.
+
+The sampler is a dimod sampler, i.e. it accepts binary quadratic models and returns
+sample sets, hence it can be used anywhere QBSolv or D-Wave solvers are used::
+
+    sampler = AnnealingSampler()
+    sampleset = sampler.sample(construct_bqm(distance_matrix), num_reads=1000, seed=42)
+"""
+import math
+import time
+import dimod
+import numpy as np
+
+
+DEFAULT_NUM_READS = 100
+DEFAULT_NUM_SWEEPS = 1000
+BETA_SCHEDULES = ('geometric', 'linear')
+
+
+class AnnealingSampler(dimod.Sampler):
+    """Vectorized simulated annealing sampler.
+
+    Parameters of :py:meth:`sample` are:
+
+    - num_reads: number of replicas annealed at once, i.e. returned samples.
+    - num_sweeps: number of sweeps over all variables.
+    - beta_range: pair (hot, cold) of inverse temperatures. Defaults to the range in
+      which the largest energy change is accepted with probability 1/2 at first
+      and the smallest one with probability 1/100 at the end.
+    - beta_schedule_type: "geometric" (default) or "linear" interpolation of
+      inverse temperatures between ends of beta_range.
+    - beta_schedule: explicit sequence of inverse temperatures, one per sweep.
+      Overrides num_sweeps, beta_range and beta_schedule_type.
+    - seed: seed of random number generator.
+    - time_limit: number of seconds after which annealing is stopped, even if
+      the schedule is not finished. Samples are then quenched with a single sweep
+      at zero temperature.
+    - chain_strength: ignored, accepted so that the sampler can stand in for D-Wave
+      solvers.
+    """
+
+    parameters = {
+        'num_reads': [],
+        'num_sweeps': [],
+        'beta_range': [],
+        'beta_schedule_type': ['beta_schedule_options'],
+        'beta_schedule': [],
+        'seed': [],
+        'time_limit': [],
+        'chain_strength': []
+    }
+    properties = {'beta_schedule_options': BETA_SCHEDULES}
+
+    def sample(self, bqm, num_reads=DEFAULT_NUM_READS, num_sweeps=DEFAULT_NUM_SWEEPS,
+               beta_range=None, beta_schedule_type='geometric', beta_schedule=None,
+               seed=None, time_limit=None, chain_strength=None):
+        """Sample binary quadratic model, see the class for description of parameters.
+
+        :rtype: dimod.SampleSet
+        """
+        started = time.perf_counter()
+        labels = list(bqm.variables)
+        binary = bqm if bqm.vartype is dimod.BINARY else bqm.change_vartype(
+            dimod.BINARY, inplace=False)
+        matrix = qubo_matrix(binary, labels)
+        if beta_schedule is None:
+            beta_schedule = make_beta_schedule(
+                matrix, num_sweeps, beta_range, beta_schedule_type)
+        samples, energies, sweeps = anneal(
+            matrix, num_reads, np.asarray(beta_schedule, dtype='float64'),
+            np.random.RandomState(seed), started + time_limit if time_limit else None)
+        energies = energies + binary.offset
+        if bqm.vartype is dimod.SPIN:
+            samples = 2 * samples - 1
+        elapsed = time.perf_counter() - started
+        return dimod.SampleSet.from_samples(
+            (samples, labels), bqm.vartype, energies,
+            info={
+                'sweeps': sweeps,
+                'timed_out': sweeps < len(beta_schedule),
+                'timing': {'total_real_time': elapsed * 1e6}})
+
+
+def qubo_matrix(bqm, labels):
+    """Return upper-triangular matrix of binary model with variables ordered as labels."""
+    index = {label: position for position, label in enumerate(labels)}
+    matrix = np.zeros((len(labels), len(labels)))
+    for label, bias in bqm.linear.items():
+        matrix[index[label], index[label]] = bias
+    for (first, second), bias in bqm.quadratic.items():
+        first, second = sorted((index[first], index[second]))
+        matrix[first, second] += bias
+    return matrix
+
+
+def make_beta_schedule(matrix, num_sweeps, beta_range=None, schedule_type='geometric'):
+    """Compute inverse temperatures of consecutive sweeps.
+
+    :param matrix: upper-triangular QUBO matrix.
+    :type matrix: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
+    if schedule_type not in BETA_SCHEDULES:
+        raise ValueError('Unknown beta schedule: {}.'.format(schedule_type))
+    if beta_range is None:
+        beta_range = default_beta_range(matrix)
+    hot, cold = beta_range
+    if schedule_type == 'geometric':
+        return np.geomspace(hot, cold, num_sweeps)
+    return np.linspace(hot, cold, num_sweeps)
+
+
+def default_beta_range(matrix):
+    """Compute range of inverse temperatures suitable for QUBO with given matrix."""
+    couplings = np.abs(matrix + matrix.T - np.diag(np.diag(matrix)))
+    largest = couplings.sum(axis=1).max() if couplings.size else 0.0
+    nonzero = couplings[couplings > 0]
+    if nonzero.size == 0:
+        return 0.1, 1.0
+    return math.log(2) / largest, math.log(100) / nonzero.min()
+
+
+def anneal(matrix, num_reads, beta_schedule, random_state, deadline=None):
+    """Anneal num_reads replicas of QUBO with given upper-triangular matrix.
+
+    :returns: triple (samples, energies, sweeps), where samples is an array of shape
+     (num_reads, number of variables) and sweeps is the number of completed sweeps.
+    """
+    size = matrix.shape[0]
+    linear = np.diag(matrix).copy()
+    couplings = matrix + matrix.T
+    couplings[np.arange(size), np.arange(size)] = 0
+    # Replicas are the last axis, so that values of a single variable are contiguous.
+    states = random_state.randint(0, 2, (size, num_reads)).astype('float64')
+    # fields[i, r] - change of energy of r-th replica after setting i-th variable to 1.
+    fields = couplings @ states + linear[:, None]
+
+    classes = [(variables, couplings[:, variables]) for variables in color_classes(couplings)]
+
+    sweeps = 0
+    for beta in beta_schedule:
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        thresholds = random_state.standard_exponential((size, num_reads)) / beta
+        for variables, columns in classes:
+            _update(states, fields, variables, columns, thresholds[variables])
+        sweeps += 1
+    if sweeps < len(beta_schedule):
+        for variables, columns in classes:
+            _update(states, fields, variables, columns, 0.0)
+
+    samples = states.T
+    energies = np.einsum('ri,ri->r', samples @ np.triu(matrix, 1), samples) + samples @ linear
+    return samples.astype(np.int8), energies, sweeps
+
+
+def color_classes(couplings):
+    """Greedily partition variables into classes of variables not coupled with each other.
+
+    :param couplings: symmetric matrix of couplings with zero diagonal.
+    :type couplings: numpy.ndarray
+    :returns: arrays of indices of variables in consecutive classes.
+    :rtype: list of numpy.ndarray
+    """
+    coupled = couplings != 0
+    colors = np.full(couplings.shape[0], -1, dtype=np.intp)
+    for variable in np.argsort(-coupled.sum(axis=1), kind='stable'):
+        used = set(colors[coupled[variable]].tolist())
+        colors[variable] = next(color for color in range(len(used) + 1) if color not in used)
+    return [np.flatnonzero(colors == color) for color in range(colors.max(initial=-1) + 1)]
+
+
+def _update(states, fields, variables, columns, thresholds):
+    """Flip uncoupled variables in replicas in which energy change is below threshold.
+
+    :param columns: columns of couplings matrix corresponding to variables.
+    """
+    steps = 1 - 2 * states[variables]
+    steps *= steps * fields[variables] < thresholds
+    states[variables] += steps
+    fields += columns @ steps
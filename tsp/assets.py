@@ -0,0 +1,269 @@
+"""In-memory serving of the frontend's build directory.
+
+All files of the directory are read once, compressed with gzip (and brotli, if it
+is installed) and kept in memory, so serving them costs neither disk reads nor
+compression. Responses carry strong ETags, conditional requests with matching
+If-None-Match get 304, and files with content hash in their name (e.g.
+static/js/main.1a2b3c4d.chunk.js) are cached by browsers for a year. Other files
+(e.g. index.html) have to be revalidated on every use.
+
+Every worker keeps its own copy of the files. If the store has a Redis connection,
+reloading them increments a generation counter in Redis, and a background thread
+of every worker checks the generation every check_interval seconds and reloads
+the worker's copy when it changes. Requests never wait for Redis.
+"""
+from collections import namedtuple
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+import time
+import falcon
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+LOGGER_NAME = 'tsp.assets'
+INDEX = 'index.html'
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# Compressed representation is kept only if it saves at least this fraction of size.
+MIN_SAVING = 0.1
+TEXT_TYPES = ('application/javascript', 'application/json', 'image/svg+xml')
+
+Asset = namedtuple('Asset', ['content_type', 'cache_control', 'representations'])
+Representation = namedtuple('Representation', ['data', 'etag'])
+
+
+def compress(data):
+    """Compress data with all available encodings.
+
+    :returns: mapping encoding -> compressed data, containing only encodings which
+     save at least MIN_SAVING of size.
+    :rtype: dict
+    """
+    encoded = {'gzip': gzip.compress(data, 9)}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(data)
+    return {
+        encoding: compressed for encoding, compressed in encoded.items()
+        if len(compressed) <= (1 - MIN_SAVING) * len(data)}
+
+
+def load_asset(path, name):
+    """Read file at path and prepare all its representations.
+
+    :param path: path of the file.
+    :type path: str
+    :param name: path of the file relative to the served directory, with "/" separators.
+    :type name: str
+    :rtype: Asset
+    """
+    with open(path, 'rb') as stream:
+        data = stream.read()
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in TEXT_TYPES:
+        content_type += '; charset=utf-8'
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    representations = {'identity': Representation(data, '"{}"'.format(digest))}
+    for encoding, compressed in compress(data).items():
+        representations[encoding] = Representation(
+            compressed, '"{}-{}"'.format(digest, encoding))
+    cache_control = IMMUTABLE if HASHED_NAME.search(os.path.basename(name)) else REVALIDATE
+    return Asset(content_type, cache_control, representations)
+
+
+def accepted_encodings(header):
+    """Parse Accept-Encoding header into a set of acceptable encodings.
+
+    Encodings with q=0 are not acceptable, and "*" stands for any encoding.
+    Identity is always acceptable.
+    """
+    accepted = {'identity'}
+    for item in (header or '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if not parts[0]:
+            continue
+        quality = 1.0
+        for parameter in parts[1:]:
+            if parameter.startswith('q='):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(parts[0].lower())
+    return accepted
+
+
+class AssetStore(object):
+    """Files of a directory kept in memory together with their compressed versions.
+
+    Files are loaded on first use (i.e. after gunicorn forks workers), which also
+    starts the thread following the generation in Redis, or by :py:meth:`reload`.
+    All files are replaced at once, so requests being served during reload see
+    either old or new files.
+
+    :param directory: directory with files to serve.
+    :type directory: str
+    :param redis: optional Redis connection holding the generation of files, so
+     that reloads reach all workers. Failures of Redis are logged and files are
+     then kept.
+    :type redis: redis.StrictRedis
+    :param key: key of the generation in Redis.
+    :type key: str
+    :param check_interval: number of seconds between checks of the generation.
+    :type check_interval: number
+    """
+
+    def __init__(self, directory, redis=None, key='tsp:assets:generation', check_interval=1.0):
+        self.directory = directory
+        self.redis = redis
+        self.key = key
+        self.check_interval = check_interval
+        self._assets = None
+        self._generation = None
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    @property
+    def assets(self):
+        """Mapping of relative paths of files to assets."""
+        if self._assets is None:
+            with self._lock:
+                if self._assets is None:
+                    self._assets = self._load()
+                    if self.redis is not None and self._watcher is None:
+                        self._watcher = threading.Thread(
+                            target=self._follow, name='tsp-assets', daemon=True)
+                        self._watcher.start()
+        return self._assets
+
+    def get(self, name):
+        """Get asset with given relative path or None if there is no such file."""
+        return self.assets.get(name)
+
+    def reload(self):
+        """Read all files again in this and (through Redis) other workers.
+
+        :returns: statistics of the store.
+        :rtype: dict
+        """
+        generation = None
+        if self.redis is not None:
+            try:
+                generation = self.redis.incr(self.key)
+            except Exception as error:
+                logging.getLogger(LOGGER_NAME).warning(
+                    'Unable to notify workers about reload: %s', error)
+        assets = self._load()
+        with self._lock:
+            self._assets = assets
+            self._generation = generation
+        return self.info()
+
+    def info(self):
+        """Return statistics of the store as a dictionary."""
+        assets = self.assets
+        sizes = {}
+        for asset in assets.values():
+            for encoding, representation in asset.representations.items():
+                sizes[encoding] = sizes.get(encoding, 0) + len(representation.data)
+        return {'directory': self.directory, 'files': len(assets), 'bytes': sizes,
+                'generation': self._generation}
+
+    def _follow(self):
+        """Reload files whenever another worker reloads them, runs in the watcher thread."""
+        while True:
+            generation = self._read_generation()
+            with self._lock:
+                current = self._generation
+                if current is None:
+                    # Files were just loaded, so they are of the generation read.
+                    self._generation = generation
+            if generation is not None and current is not None and generation != current:
+                # Requests keep being served with current files in the meantime.
+                assets = self._load()
+                with self._lock:
+                    # Unless this worker reloaded files meanwhile.
+                    if self._generation == current:
+                        self._assets = assets
+                        self._generation = generation
+            time.sleep(self.check_interval)
+
+    def _read_generation(self):
+        if self.redis is None:
+            return None
+        try:
+            return int(self.redis.get(self.key) or 0)
+        except Exception as error:
+            logging.getLogger(LOGGER_NAME).warning(
+                'Unable to read generation of static files: %s', error)
+            return None
+
+    def _load(self):
+        assets = {}
+        if not os.path.isdir(self.directory):
+            logging.getLogger(LOGGER_NAME).warning(
+                'Static directory %s does not exist.', self.directory)
+            return assets
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, '/')
+                assets[name] = load_asset(path, name)
+        logging.getLogger(LOGGER_NAME).info(
+            'Loaded %d static files from %s.', len(assets), self.directory)
+        return assets
+
+
+class AssetSink(object):
+    """Falcon sink serving files of :py:class:`AssetStore`, with index.html at /."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __call__(self, req, resp):
+        if req.method not in ('GET', 'HEAD'):
+            raise falcon.HTTPMethodNotAllowed(['GET', 'HEAD'])
+        name = req.path.lstrip('/') or INDEX
+        asset = self.store.get(name)
+        if asset is None:
+            raise falcon.HTTPNotFound()
+        accepted = accepted_encodings(req.get_header('Accept-Encoding'))
+        encoding = next(
+            encoding for encoding in ('br', 'gzip', 'identity')
+            if encoding in asset.representations and
+            (encoding in accepted or '*' in accepted))
+        representation = asset.representations[encoding]
+
+        resp.set_header('ETag', representation.etag)
+        resp.set_header('Cache-Control', asset.cache_control)
+        resp.set_header('Vary', 'Accept-Encoding')
+        tags = _entity_tags(req.get_header('If-None-Match'))
+        if representation.etag in tags or '*' in tags:
+            resp.status = falcon.HTTP_304
+            return
+        resp.content_type = asset.content_type
+        if encoding != 'identity':
+            resp.set_header('Content-Encoding', encoding)
+        resp.data = representation.data
+
+
+def _entity_tags(header):
+    """Parse If-None-Match header, ignoring weakness of tags (as RFC 7232 requires)."""
+    tags = set()
+    for tag in (header or '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag:
+            tags.add(tag)
+    return tags
@@ -0,0 +1,357 @@
+"""Benchmarks of TSP solving pipeline.
+
+For every instance kind, size and backend, the benchmark measures wall time and
+peak memory of the consecutive stages of solving (computing distance matrix,
+constructing QUBO, solving, decoding samples and computing mileage), together with
+the rate of feasible solutions and the optimality gap against an exact reference.
+
+QUBOs with objective couplers pruned to k nearest neighbours are benchmarked as
+backends "qbsolv-knn<k>", e.g. "qbsolv-knn3". Their number of couplers and solving
+time are compared to dense QUBO if "qbsolv" backend is benchmarked as well.
+
+Backends "qbsolv-auto" and "anneal-auto" use penalty weight calibrated for every
+instance (see :py:mod:`tsp.calibration`) instead of the fixed const_mul, while
+"anneal-refined" additionally refines it with annealing pre-samples. Penalty weights
+are reported in metrics, so that feasible rates can be compared with fixed weight.
+
+Results are written as JSON, so that they can be compared between commits::
+
+    python -m tsp.bench --sizes 4 6 8 --backends qbsolv exact heuristic -o bench.json
+"""
+import argparse
+from collections import OrderedDict
+import json
+import platform
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from dwave_qbsolv import QBSolv
+import numpy as np
+from tsp.annealing import AnnealingSampler
+from tsp.calibration import calibrate
+from tsp.classical import CLASSICAL_BACKENDS, EXACT_MAX_SIZE, held_karp
+from tsp.pruning import admits_route, nearest_neighbours_mask
+from tsp.qubo import best_routes, construct_bqm, coupler_count, decode_samples
+from tsp.solver import dwave_num_reads
+from tsp.utils import calculate_mileage, create_distance_matrix
+
+
+KINDS = ['random', 'geographic']
+DEFAULT_SIZES = [4, 5, 6, 7, 8, 9]
+DEFAULT_BACKENDS = ['qbsolv', 'exact', 'heuristic']
+
+# Bounding box of generated geographic instances, roughly covering Poland.
+GEOGRAPHIC_BOX = ((49.0, 54.8), (14.1, 24.1))
+
+
+def random_instance(size, random_state):
+    """Generate distance matrix of points drawn uniformly from [0, 10] x [0, 10] square."""
+    points = random_state.rand(size, 2) * 10
+    return None, np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+
+
+def geographic_instance(size, random_state):
+    """Generate locations drawn uniformly from GEOGRAPHIC_BOX and their distance matrix."""
+    (min_lat, max_lat), (min_long, max_long) = GEOGRAPHIC_BOX
+    locations = np.column_stack((
+        random_state.uniform(min_lat, max_lat, size),
+        random_state.uniform(min_long, max_long, size)))
+    return locations, None
+
+
+INSTANCES = {
+    'random': random_instance,
+    'geographic': geographic_instance
+}
+
+
+class Measurement(object):
+    """Accumulator of wall times and peak memory of benchmark stages."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.times = OrderedDict()
+        self.memory = OrderedDict()
+        self.values = OrderedDict()
+
+    def __call__(self, stage, function, *args, **kwargs):
+        """Call function, recording its wall time and peak memory under given stage."""
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.times.setdefault(stage, []).append(time.perf_counter() - started)
+            if self.trace_memory:
+                self.memory.setdefault(stage, []).append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+    def record(self, name, value):
+        """Record value of a metric other than time or memory, e.g. size of QUBO."""
+        self.values.setdefault(name, []).append(value)
+
+    def metrics(self):
+        """Return means of recorded metrics as a dictionary."""
+        return OrderedDict(
+            (name, float(np.mean(values))) for name, values in self.values.items())
+
+    def summary(self):
+        """Return statistics of all stages as a dictionary."""
+        result = OrderedDict()
+        for stage, times in self.times.items():
+            result[stage] = OrderedDict([
+                ('time_mean', float(np.mean(times))),
+                ('time_median', float(np.median(times))),
+                ('time_max', float(np.max(times)))])
+            if stage in self.memory:
+                result[stage]['peak_memory_max'] = int(np.max(self.memory[stage]))
+        return result
+
+
+def run_qbsolv(measure, dist_matrix, dist_mul, const_mul, neighbours=None):
+    """Solve problem with QBSolv, returning (route, fraction of feasible samples).
+
+    If neighbours is given, objective couplers are pruned to that many nearest
+    neighbours of every location, unless pruned QUBO doesn't admit a feasible route.
+    """
+    return run_sampler(measure, QBSolv().sample, dist_matrix, dist_mul, const_mul, neighbours)
+
+
+def run_anneal(measure, dist_matrix, dist_mul, const_mul):
+    """Solve problem with vectorized simulated annealing, taking as many reads as D-Wave."""
+    def sample(bqm):
+        return AnnealingSampler().sample(
+            bqm, num_reads=dwave_num_reads(dist_matrix.shape[0]), seed=0)
+    return run_sampler(measure, sample, dist_matrix, dist_mul, const_mul)
+
+
+def run_sampler(measure, sample, dist_matrix, dist_mul, const_mul, neighbours=None):
+    """Solve problem with given sampling function, see :py:func:`run_qbsolv`."""
+    size = dist_matrix.shape[0]
+    normalized = dist_matrix / np.max(dist_matrix)
+    allowed = None
+    if neighbours is not None:
+        allowed = measure('prune', nearest_neighbours_mask, normalized, neighbours)
+        if not measure('validate', admits_route, allowed):
+            allowed = None
+        measure.record('pruned', float(allowed is not None))
+    measure.record('couplers', coupler_count(size, allowed))
+    measure.record('const_mul', const_mul)
+    bqm = measure('qubo', construct_bqm, normalized, dist_mul, const_mul, allowed)
+    result = measure('solve', sample, bqm)
+    decoded = measure('decode', decode_samples, result, size)
+    candidates = best_routes(decoded, dist_matrix)
+    feasible = float(
+        np.sum(decoded.occurrences[decoded.feasible]) / np.sum(decoded.occurrences))
+    return (candidates[0].route if candidates else None), feasible
+
+
+def run_classical(backend):
+    """Create runner for native classical backend."""
+    def run(measure, dist_matrix, dist_mul, const_mul):
+        route = measure('solve', CLASSICAL_BACKENDS[backend], dist_matrix, 0, None)
+        return route, 1.0
+    return run
+
+
+def run_pruned(neighbours):
+    """Create runner for QBSolv solving QUBO pruned to given number of neighbours."""
+    def run(measure, dist_matrix, dist_mul, const_mul):
+        return run_qbsolv(measure, dist_matrix, dist_mul, const_mul, neighbours)
+    return run
+
+
+def run_calibrated(runner, refine=False):
+    """Create runner solving QUBO with calibrated penalty weight instead of const_mul."""
+    def run(measure, dist_matrix, dist_mul, const_mul):
+        normalized = dist_matrix / np.max(dist_matrix)
+        calibration = measure('calibrate', calibrate, normalized, dist_mul, refine, 0)
+        return runner(measure, dist_matrix, dist_mul, calibration['const_mul'])
+    return run
+
+
+BACKENDS = OrderedDict([
+    ('qbsolv', run_qbsolv),
+    ('qbsolv-auto', run_calibrated(run_qbsolv)),
+    ('anneal', run_anneal),
+    ('anneal-auto', run_calibrated(run_anneal)),
+    ('anneal-refined', run_calibrated(run_anneal, refine=True)),
+    ('exact', run_classical('exact')),
+    ('heuristic', run_classical('heuristic')),
+    ('auto', run_classical('auto'))
+])
+PRUNED_BACKEND = re.compile(r'^qbsolv-knn(\d+)$')
+
+
+def backend_runner(name):
+    """Return runner of backend with given name, see BACKENDS and PRUNED_BACKEND."""
+    if name in BACKENDS:
+        return BACKENDS[name]
+    match = PRUNED_BACKEND.match(name)
+    if match is None:
+        raise ValueError('Unknown backend: {}.'.format(name))
+    return run_pruned(int(match.group(1)))
+
+
+def benchmark(sizes=DEFAULT_SIZES, backends=DEFAULT_BACKENDS, kinds=KINDS, trials=5,
+              seed=0, dist_mul=10, const_mul=400, trace_memory=True):
+    """Run benchmark and return its results as a JSON-serializable dictionary.
+
+    Instances are generated from seeded random state, hence the same arguments
+    always produce the same instances. All routes start in the first and finish
+    in the last location, as in the web application.
+
+    :param sizes: numbers of locations of generated instances.
+    :type sizes: sequence of ints
+    :param backends: names of benchmarked backends, keys of BACKENDS or names of
+     pruned QBSolv backends, see :py:func:`backend_runner`.
+    :type backends: sequence of str
+    :param kinds: kinds of generated instances, keys of INSTANCES.
+    :type kinds: sequence of str
+    :param trials: number of instances of every kind and size.
+    :type trials: int
+    :param seed: seed of random state used for generating instances.
+    :type seed: int
+    :param dist_mul: multiplier of target function in QUBO.
+    :type dist_mul: number
+    :param const_mul: multiplier of constraints in QUBO.
+    :type const_mul: number
+    :param trace_memory: whether to trace peak memory. Tracing slows down
+     allocation-heavy stages, so wall times are slightly inflated when it is on.
+    :type trace_memory: bool
+    :rtype: dict
+    """
+    runners = OrderedDict((backend, backend_runner(backend)) for backend in backends)
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            random_state = np.random.RandomState([seed, size, KINDS.index(kind)])
+            instances = [INSTANCES[kind](size, random_state) for _ in range(trials)]
+            shared = Measurement(trace_memory)
+            measurements = OrderedDict(
+                (backend, Measurement(trace_memory)) for backend in backends)
+            gaps = OrderedDict((backend, []) for backend in backends)
+            feasible = OrderedDict((backend, []) for backend in backends)
+            for locations, dist_matrix in instances:
+                if locations is not None:
+                    dist_matrix = shared('distance_matrix', create_distance_matrix, locations)
+                routes = {}
+                for backend, measure in measurements.items():
+                    route, feasible_fraction = runners[backend](
+                        measure, dist_matrix, dist_mul, const_mul)
+                    if route is not None and not _is_feasible(route, size):
+                        route = None
+                    feasible[backend].append(feasible_fraction)
+                    if route is not None:
+                        routes[backend] = measure(
+                            'mileage', calculate_mileage, dist_matrix, route)
+                reference = _reference_mileage(dist_matrix, routes)
+                for backend in backends:
+                    if backend in routes and reference > 0:
+                        gaps[backend].append(routes[backend] / reference - 1)
+                    elif backend in routes:
+                        gaps[backend].append(0.0)
+            for backend in backends:
+                metrics = measurements[backend].metrics()
+                if PRUNED_BACKEND.match(backend) and 'qbsolv' in measurements:
+                    metrics['reduction'] = _reduction(
+                        measurements['qbsolv'], measurements[backend])
+                results.append(OrderedDict([
+                    ('kind', kind),
+                    ('size', size),
+                    ('backend', backend),
+                    ('trials', trials),
+                    ('reference', 'exact' if size <= EXACT_MAX_SIZE else 'best-known'),
+                    ('stages', OrderedDict(
+                        list(shared.summary().items()) +
+                        list(measurements[backend].summary().items()))),
+                    ('feasible_rate', float(np.mean(feasible[backend]))),
+                    ('solved_rate', len(gaps[backend]) / float(trials)),
+                    ('gap_mean', float(np.mean(gaps[backend])) if gaps[backend] else None),
+                    ('gap_max', float(np.max(gaps[backend])) if gaps[backend] else None),
+                    ('metrics', metrics)
+                ]))
+    parameters = OrderedDict([
+        ('sizes', list(sizes)), ('backends', list(backends)), ('kinds', list(kinds)),
+        ('trials', trials), ('seed', seed), ('dist_mul', dist_mul),
+        ('const_mul', const_mul), ('trace_memory', trace_memory)])
+    return OrderedDict([('meta', _metadata(parameters)), ('results', results)])
+
+
+def _reference_mileage(dist_matrix, mileages):
+    """Optimal mileage for small instances and best mileage found otherwise."""
+    if dist_matrix.shape[0] <= EXACT_MAX_SIZE:
+        return calculate_mileage(dist_matrix, held_karp(dist_matrix, 0, None))
+    return min(mileages.values()) if mileages else 0.0
+
+
+def _reduction(dense, pruned):
+    """Relative reduction of number of couplers and solving time by pruning."""
+    dense_time = np.mean(dense.times['solve'])
+    return OrderedDict([
+        ('couplers', float(
+            1 - np.mean(pruned.values['couplers']) / np.mean(dense.values['couplers']))),
+        ('solve_time', float(1 - np.mean(pruned.times['solve']) / dense_time))])
+
+
+def _is_feasible(route, size):
+    """Check that route starts in the first, ends in the last and visits all locations."""
+    return route[0] == 0 and route[-1] == size - 1 and sorted(route) == list(range(size))
+
+
+def _metadata(parameters):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([
+        ('commit', commit),
+        ('timestamp', time.time()),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('machine', platform.machine()),
+        ('parameters', parameters)])
+
+
+def main(argv=None):
+    """Entry point of command line interface."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--backends', nargs='+', default=DEFAULT_BACKENDS,
+                        help='backends to benchmark: {} or qbsolv-knn<k>'.format(
+                            ', '.join(BACKENDS)))
+    parser.add_argument('--prune-neighbours', type=int, nargs='+', default=[],
+                        help='benchmark QBSolv on QUBO pruned to given numbers of neighbours')
+    parser.add_argument('--kinds', nargs='+', default=KINDS, choices=KINDS)
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dist-mul', type=float, default=10)
+    parser.add_argument('--const-mul', type=float, default=400)
+    parser.add_argument('--no-memory', action='store_true', help='do not trace peak memory')
+    parser.add_argument('-o', '--output', help='output file, defaults to standard output')
+    args = parser.parse_args(argv)
+    backends = list(args.backends) + [
+        'qbsolv-knn' + str(neighbours) for neighbours in args.prune_neighbours]
+    for backend in backends:
+        try:
+            backend_runner(backend)
+        except ValueError as error:
+            parser.error(str(error))
+
+    results = benchmark(
+        args.sizes, backends, args.kinds, args.trials, args.seed,
+        args.dist_mul, args.const_mul, not args.no_memory)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
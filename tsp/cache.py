@@ -0,0 +1,172 @@
+"""Caching of TSP solutions keyed by canonicalized problems."""
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+import time
+import numpy as np
+from tsp.solver import TSPSolution
+
+
+LOGGER_NAME = 'tsp.cache'
+KEY_DECIMALS = 9
+
+
+def canonical_key(dist_matrix, dist_mul, const_mul, start, end, backend):
+    """Compute key identifying TSP problem for the purpose of caching its solutions.
+
+    Distance matrix is normalized in the same way as the solver does it (i.e. divided
+    by its maximum entry) and rounded, hence problems differing only in the scale
+    of distances share the key.
+
+    :param dist_matrix: distance matrix of the problem.
+    :type dist_matrix: numpy.ndarray
+    :param dist_mul: multiplier of the target function.
+    :type dist_mul: number
+    :param const_mul: multiplier of the constraints, or "auto" if it is calibrated.
+    :type const_mul: number or str
+    :param start: starting node or None.
+    :type start: int
+    :param end: ending node or None.
+    :type end: int
+    :param backend: name of the backend used for solving the problem.
+    :type backend: str
+    :returns: hex digest identifying the problem.
+    :rtype: str
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    max_distance = np.max(dist_matrix) if dist_matrix.size else 0
+    if max_distance > 0:
+        dist_matrix = dist_matrix / max_distance
+    normalized = np.ascontiguousarray(np.round(dist_matrix, KEY_DECIMALS) + 0.0)
+    digest = hashlib.sha256()
+    digest.update(str(normalized.shape).encode())
+    digest.update(normalized.tobytes())
+    digest.update(json.dumps(
+        [float(dist_mul), const_mul if isinstance(const_mul, str) else float(const_mul),
+         start, end, backend]).encode())
+    return digest.hexdigest()
+
+
+def dump_solution(solution):
+    """Serialize TSPSolution to JSON string."""
+    return json.dumps({
+        'route': [int(node) for node in solution.route],
+        'energy': float(solution.energy),
+        'mileage': float(solution.mileage),
+        'info': solution.info
+    })
+
+
+def load_solution(data):
+    """Deserialize TSPSolution from JSON string produced by :py:func:`dump_solution`."""
+    payload = json.loads(data)
+    return TSPSolution(
+        payload['route'], payload['energy'], payload['mileage'], payload['info'])
+
+
+class SolutionCache(object):
+    """Two-tier cache of TSP solutions.
+
+    The first tier is an in-process LRU mapping bounded by maxsize, with entries
+    expiring after ttl seconds. The second, optional tier is Redis, shared between
+    all workers. Failures of Redis are logged and treated as misses.
+
+    :param maxsize: maximum number of solutions kept in process memory.
+    :type maxsize: int
+    :param ttl: number of seconds after which entries expire. None means
+     entries never expire.
+    :type ttl: number
+    :param redis: optional Redis connection used as the second tier.
+    :type redis: redis.StrictRedis
+    :param prefix: prefix of keys stored in Redis.
+    :type prefix: str
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600, redis=None, prefix='tsp:solution:'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.redis = redis
+        self.prefix = prefix
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'redis_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Get solution stored under given key.
+
+        :returns: pair (solution, tier) where tier is either "memory" or "redis",
+         or (None, None) if there is no valid entry for the key.
+        :rtype: tuple
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < now:
+                del self._data[key]
+                entry = None
+            if entry is not None:
+                self._data.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1], 'memory'
+
+        solution = self._redis_get(key)
+        with self._lock:
+            if solution is None:
+                self.stats['misses'] += 1
+                return None, None
+            self.stats['redis_hits'] += 1
+        self._store(key, solution)
+        return solution, 'redis'
+
+    def set(self, key, solution):
+        """Store solution under given key in all tiers."""
+        self._store(key, solution)
+        if self.redis is not None:
+            try:
+                self.redis.set(
+                    self.prefix + key,
+                    dump_solution(solution),
+                    ex=int(self.ttl) if self.ttl else None)
+            except Exception as error:
+                logging.getLogger(LOGGER_NAME).warning(
+                    'Unable to store solution in Redis: %s', error)
+
+    def clear(self):
+        """Remove all entries from in-process tier."""
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        """Return cache statistics as a dictionary."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._data)
+        stats['maxsize'] = self.maxsize
+        stats['ttl'] = self.ttl
+        stats['redis'] = self.redis is not None
+        return stats
+
+    def _store(self, key, solution):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires, solution)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def _redis_get(self, key):
+        if self.redis is None:
+            return None
+        try:
+            data = self.redis.get(self.prefix + key)
+        except Exception as error:
+            logging.getLogger(LOGGER_NAME).warning(
+                'Unable to read solution from Redis: %s', error)
+            return None
+        return None if data is None else load_solution(data)
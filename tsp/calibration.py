@@ -0,0 +1,131 @@
+"""Automatic calibration of QUBO penalty weight and QPU chain strength.
+
+Penalty weight (const_mul) has to be large enough for feasible routes to have lower
+energy than infeasible ones, but every excess makes the target function a smaller
+fraction of the range of biases, i.e. it wastes precision of the annealer.
+
+With the encoding used in :py:mod:`tsp.qubo`, a constraint group (step or location)
+with k chosen variables contributes const_mul * (2k^2 - 3k) to energy. Dropping a
+variable from a feasible sample empties its step and its location, which costs
+2 * const_mul, and saves at most dist_mul times two edges incident to the dropped
+location. Choosing additional variables is never profitable, hence
+
+    const_mul > dist_mul * max_i (sum of two largest distances from i) / 2
+
+suffices for every optimal sample to be feasible. The calibrated weight is this
+bound multiplied by PENALTY_MARGIN, optionally increased further until a cheap
+simulated annealing pre-sample is feasible often enough.
+"""
+import math
+import numpy as np
+from tsp.annealing import AnnealingSampler
+from tsp.qubo import construct_bqm, decode_samples
+
+
+AUTO = 'auto'
+PENALTY_MARGIN = 1.5
+TARGET_FEASIBLE_FRACTION = 0.25
+REFINE_FACTOR = 2.0
+REFINE_STEPS = 4
+PRESAMPLE_READS = 64
+PRESAMPLE_SWEEPS = 200
+CHAIN_STRENGTH_PREFACTOR = 1.414
+
+
+def min_penalty(dist_matrix, dist_mul=1):
+    """Compute the smallest penalty weight for which optimal samples are feasible.
+
+    :param dist_matrix: (normalized) distance matrix QUBO is constructed from.
+    :type dist_matrix: numpy.ndarray
+    :param dist_mul: multiplier of target function.
+    :type dist_mul: number
+    :rtype: float
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    if dist_matrix.shape[0] < 3:
+        return 0.0
+    largest = np.sort(dist_matrix + np.diag(np.full(dist_matrix.shape[0], -np.inf)), axis=1)
+    return float(dist_mul * (largest[:, -1] + largest[:, -2]).max() / 2)
+
+
+def penalty_weight(dist_matrix, dist_mul=1, margin=PENALTY_MARGIN):
+    """Compute penalty weight from the distance matrix, see :py:func:`min_penalty`."""
+    weight = margin * min_penalty(dist_matrix, dist_mul)
+    # Degenerate instances (e.g. all distances equal zero) still need the constraints.
+    return weight if weight > 0 else float(dist_mul or 1)
+
+
+def refine_penalty(dist_matrix, dist_mul, const_mul, seed=None):
+    """Increase penalty weight until pre-sample is feasible often enough.
+
+    Pre-sample consists of PRESAMPLE_READS reads of PRESAMPLE_SWEEPS sweeps of
+    :py:class:`tsp.annealing.AnnealingSampler`. Penalty is multiplied by REFINE_FACTOR
+    at most REFINE_STEPS times, until the fraction of feasible reads reaches
+    TARGET_FEASIBLE_FRACTION.
+
+    :returns: pair (penalty weight, list of (penalty weight, feasible fraction) pairs
+     of all pre-samples).
+    """
+    history = []
+    sampler = AnnealingSampler()
+    for _ in range(REFINE_STEPS + 1):
+        sampleset = sampler.sample(
+            construct_bqm(dist_matrix, dist_mul, const_mul),
+            num_reads=PRESAMPLE_READS, num_sweeps=PRESAMPLE_SWEEPS, seed=seed)
+        decoded = decode_samples(sampleset, np.shape(dist_matrix)[0])
+        fraction = float(
+            np.sum(decoded.occurrences[decoded.feasible]) / np.sum(decoded.occurrences))
+        history.append((const_mul, fraction))
+        if fraction >= TARGET_FEASIBLE_FRACTION:
+            break
+        const_mul *= REFINE_FACTOR
+    # If target was never reached, use the weight with the best feasible fraction.
+    return max(history, key=lambda item: (item[1] >= TARGET_FEASIBLE_FRACTION, item[1]))[0], history
+
+
+def calibrate(dist_matrix, dist_mul=1, refine=False, seed=None):
+    """Choose penalty weight for QUBO of given (normalized) distance matrix.
+
+    :param refine: whether to refine the weight with pre-samples, see
+     :py:func:`refine_penalty`.
+    :type refine: bool
+    :returns: dictionary with "const_mul", "min_const_mul" and, if refined,
+     "presamples" keys, suitable for reporting in solution's info.
+    :rtype: dict
+    """
+    calibration = {
+        'const_mul': penalty_weight(dist_matrix, dist_mul),
+        'min_const_mul': min_penalty(dist_matrix, dist_mul)
+    }
+    if refine and np.shape(dist_matrix)[0] > 3:
+        calibration['const_mul'], presamples = refine_penalty(
+            dist_matrix, dist_mul, calibration['const_mul'], seed)
+        calibration['presamples'] = [
+            {'const_mul': weight, 'feasible_fraction': fraction}
+            for weight, fraction in presamples]
+    return calibration
+
+
+def chain_strength(bqm, prefactor=CHAIN_STRENGTH_PREFACTOR):
+    """Compute chain strength with uniform torque compensation.
+
+    Chain strength is prefactor times root mean square of quadratic biases times
+    square root of the mean degree of variables, which makes chains about as
+    strong as the typical torque exerted on a variable by its neighbours.
+
+    :param bqm: model submitted to the QPU.
+    :type bqm: dimod.BinaryQuadraticModel
+    :rtype: float
+    """
+    biases = np.fromiter(bqm.quadratic.values(), dtype='float64', count=len(bqm.quadratic))
+    if biases.size == 0:
+        return 1.0
+    mean_degree = 2.0 * biases.size / len(bqm.linear)
+    return float(prefactor * math.sqrt(np.mean(biases ** 2)) * math.sqrt(mean_degree))
+
+
+def resolve_const_mul(dist_matrix, dist_mul, const_mul):
+    """Return const_mul, or calibrated penalty weight if const_mul is AUTO."""
+    if const_mul == AUTO:
+        return penalty_weight(dist_matrix, dist_mul)
+    return const_mul
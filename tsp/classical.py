@@ -0,0 +1,257 @@
+"""Native classical algorithms for TSP: exact dynamic programming and local search.
+
+All functions operate on routes with fixed ends. If start and end differ, the
+route is a path visiting every location once, starting in start and finishing in
+end. If they are equal, the route is a closed tour, i.e. start appears both as
+the first and the last element of the route.
+"""
+import numpy as np
+from tsp.qubo import default_ends
+
+
+EXACT_MAX_SIZE = 13
+
+
+def held_karp(dist_matrix, start=None, end=None):
+    """Find optimal route using Held-Karp dynamic programming.
+
+    The dynamic programming table is filled layer by layer (subsets of the same
+    size at once) with NumPy, which makes it practical for up to about 16 locations.
+
+    :param dist_matrix: distance matrix of the problem.
+    :type dist_matrix: numpy.ndarray
+    :param start: first location of the route. Defaults to 0.
+    :type start: int
+    :param end: last location of the route. Defaults to the last location.
+    :type end: int
+    :returns: the optimal route.
+    :rtype: list of ints
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    number_of_locations = dist_matrix.shape[0]
+    start, end = default_ends(number_of_locations, start, end)
+    if number_of_locations <= 2:
+        return _trivial_route(number_of_locations, start, end)
+    inner = np.array(
+        [node for node in range(number_of_locations) if node not in (start, end)])
+    size = inner.shape[0]
+    inner_dist = dist_matrix[np.ix_(inner, inner)]
+    bits = 1 << np.arange(size)
+
+    # cost[mask, j] - length of the shortest path from start visiting exactly
+    # inner nodes in mask and finishing in j-th inner node.
+    cost = np.full((1 << size, size), np.inf)
+    parent = np.full((1 << size, size), -1, dtype=np.int8)
+    cost[bits, np.arange(size)] = dist_matrix[start, inner]
+
+    masks = np.arange(1 << size)
+    popcounts = np.zeros(1 << size, dtype=np.intp)
+    for bit in bits:
+        popcounts += (masks & bit) > 0
+    for layer in range(2, size+1):
+        layer_masks = masks[popcounts == layer]
+        # previous[m, j] - mask without j-th node, valid only if j is in the mask.
+        contains = (layer_masks[:, None] & bits[None, :]) > 0
+        previous = layer_masks[:, None] ^ bits[None, :]
+        # candidates[m, j, k] - path ending in k extended by edge k -> j.
+        candidates = cost[previous] + inner_dist.T[None, :, :]
+        best = candidates.argmin(axis=2)
+        values = np.take_along_axis(candidates, best[:, :, None], axis=2)[:, :, 0]
+        cost[layer_masks[:, None], np.arange(size)[None, :]] = np.where(contains, values, np.inf)
+        parent[layer_masks[:, None], np.arange(size)[None, :]] = np.where(contains, best, -1)
+
+    full = (1 << size) - 1
+    last = int(np.argmin(cost[full] + dist_matrix[inner, end]))
+    route = [end]
+    mask = full
+    while last >= 0:
+        route.append(int(inner[last]))
+        mask, last = mask ^ (1 << last), int(parent[mask, last])
+    route.append(start)
+    return route[::-1]
+
+
+def nearest_neighbour(dist_matrix, start=None, end=None):
+    """Construct route greedily, always going to the nearest unvisited location.
+
+    The parameters have the same meaning as in :py:func:`held_karp`.
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    number_of_locations = dist_matrix.shape[0]
+    start, end = default_ends(number_of_locations, start, end)
+    if number_of_locations <= 2:
+        return _trivial_route(number_of_locations, start, end)
+    visited = np.zeros(number_of_locations, dtype=bool)
+    visited[[start, end]] = True
+    route = [start]
+    for _ in range(number_of_locations - 2 if start != end else number_of_locations - 1):
+        distances = np.where(visited, np.inf, dist_matrix[route[-1]])
+        route.append(int(np.argmin(distances)))
+        visited[route[-1]] = True
+    route.append(end)
+    return route
+
+
+def local_search(dist_matrix, route, max_iterations=1000):
+    """Improve route with 2-opt and Or-opt moves until local optimum is reached.
+
+    In each iteration, all 2-opt moves (reversals of a segment) and all Or-opt moves
+    (relocations of a segment of at most 3 locations, possibly reversed) are evaluated
+    at once with NumPy and the best improving one is applied. Ends of the route are
+    never moved.
+
+    :param dist_matrix: distance matrix of the problem.
+    :type dist_matrix: numpy.ndarray
+    :param route: initial route.
+    :type route: sequence of ints
+    :param max_iterations: maximum number of applied moves.
+    :type max_iterations: int
+    :returns: improved route.
+    :rtype: list of ints
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    route = np.array(route, dtype=np.intp)
+    for _ in range(max_iterations):
+        two_opt = _best_two_opt(dist_matrix, route)
+        or_opt = _best_or_opt(dist_matrix, route)
+        best = min(two_opt, or_opt, key=lambda move: move[0])
+        if best[0] >= -1e-12:
+            break
+        route = best[1](route)
+    return route.tolist()
+
+
+def repair_route(dist_matrix, route, max_iterations=100):
+    """Turn broken route into a feasible one, keeping as much of it as possible.
+
+    Broken steps are the ones containing -1, repeated occurrences of a location are
+    treated as broken as well. Broken steps are filled left to right with the missing
+    location that is the cheapest to insert between its neighbours, and the result
+    is polished with at most max_iterations moves of :py:func:`local_search`.
+
+    :param dist_matrix: distance matrix of the problem.
+    :type dist_matrix: numpy.ndarray
+    :param route: route with ends set and possibly some broken steps.
+    :type route: sequence of ints
+    :param max_iterations: maximum number of local search moves.
+    :type max_iterations: int
+    :returns: repaired route or None if route can't be repaired, e.g. its ends are broken.
+    :rtype: list of ints
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    number_of_locations = dist_matrix.shape[0]
+    route = [int(node) for node in route]
+    if route[0] < 0 or route[-1] < 0:
+        return None
+    seen = {route[0], route[-1]}
+    for step in range(1, len(route)-1):
+        if route[step] in seen:
+            route[step] = -1
+        elif route[step] >= 0:
+            seen.add(route[step])
+    missing = [node for node in range(number_of_locations) if node not in seen]
+    if len(missing) != route.count(-1):
+        return None
+    for step, node in enumerate(route):
+        if node >= 0:
+            continue
+        cost = dist_matrix[route[step-1], missing]
+        if route[step+1] >= 0:
+            cost = cost + dist_matrix[missing, route[step+1]]
+        route[step] = missing.pop(int(np.argmin(cost)))
+    return local_search(dist_matrix, route, max_iterations)
+
+
+def solve_exact(dist_matrix, start=None, end=None):
+    """Find optimal route, see :py:func:`held_karp`."""
+    return held_karp(dist_matrix, start, end)
+
+
+def solve_heuristic(dist_matrix, start=None, end=None, max_iterations=1000):
+    """Find good route using nearest neighbour construction followed by local search."""
+    return local_search(
+        dist_matrix, nearest_neighbour(dist_matrix, start, end), max_iterations)
+
+
+def solve_auto(dist_matrix, start=None, end=None):
+    """Find route using exact algorithm for small problems and heuristic otherwise."""
+    if np.shape(dist_matrix)[0] <= EXACT_MAX_SIZE:
+        return solve_exact(dist_matrix, start, end)
+    return solve_heuristic(dist_matrix, start, end)
+
+
+CLASSICAL_BACKENDS = {
+    'exact': solve_exact,
+    'heuristic': solve_heuristic,
+    'auto': solve_auto
+}
+
+
+def _trivial_route(number_of_locations, start, end):
+    if number_of_locations < 2:
+        return list(range(number_of_locations))
+    if start == end:
+        return [start, 1 - start, start]
+    return [start, end]
+
+
+def _best_two_opt(dist_matrix, route):
+    """Find the best reversal of route[i:j+1] for 1 <= i < j <= len(route)-2."""
+    length = route.shape[0]
+    if length < 4:
+        return 0.0, None
+    positions = np.arange(1, length-1)
+    i, j = positions[:, None], positions[None, :]
+    delta = (dist_matrix[route[i-1], route[j]] + dist_matrix[route[i], route[j+1]] -
+             dist_matrix[route[i-1], route[i]] - dist_matrix[route[j], route[j+1]])
+    delta = np.where(j > i, delta, np.inf)
+    best = np.unravel_index(np.argmin(delta), delta.shape)
+    first, last = positions[best[0]], positions[best[1]]
+
+    def apply(route):
+        route = route.copy()
+        route[first:last+1] = route[first:last+1][::-1]
+        return route
+    return delta[best], apply
+
+
+def _best_or_opt(dist_matrix, route, max_segment=3):
+    """Find the best relocation of a segment of at most max_segment locations."""
+    length = route.shape[0]
+    best_delta, best_move = 0.0, None
+    for segment in range(1, max_segment+1):
+        # Segment route[i:i+segment], with 1 <= i and i+segment <= length-1.
+        i = np.arange(1, length - segment)[:, None]
+        if i.size == 0:
+            break
+        before, first = route[i-1], route[i]
+        last, after = route[i+segment-1], route[i+segment]
+        removal = (dist_matrix[before, first] + dist_matrix[last, after] -
+                   dist_matrix[before, after])
+        # Insertion between route[k] and route[k+1], outside of the segment.
+        k = np.arange(0, length-1)[None, :]
+        outside = (k < i-1) | (k >= i+segment)
+        left, right = route[k], route[k+1]
+        forward = dist_matrix[left, first] + dist_matrix[last, right]
+        backward = dist_matrix[left, last] + dist_matrix[first, right]
+        insertion = np.minimum(forward, backward) - dist_matrix[left, right]
+        delta = np.where(outside, insertion - removal, np.inf)
+        index = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[index] < best_delta:
+            best_delta = delta[index]
+            best_move = _or_opt_move(
+                int(i[index[0], 0]), segment, int(k[0, index[1]]),
+                backward[index] < forward[index])
+    return best_delta, best_move
+
+
+def _or_opt_move(position, segment, target, reverse):
+    def apply(route):
+        moved = route[position:position+segment]
+        if reverse:
+            moved = moved[::-1]
+        rest = np.concatenate((route[:position], route[position+segment:]))
+        # Index of target in the route with the segment removed.
+        insert_at = target + 1 if target < position else target + 1 - segment
+        return np.concatenate((rest[:insert_at], moved, rest[insert_at:]))
+    return apply
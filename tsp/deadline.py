@@ -0,0 +1,137 @@
+"""Anytime solving: a chain of backends run under a single deadline.
+
+Stages of the chain (e.g. D-Wave, local QUBO sampler and heuristic) are tried in
+order, each with the time left until the deadline. A stage is skipped if less
+than its min_seconds is left, and stages that can't be interrupted (D-Wave calls)
+are abandoned when their time is up. The first stage producing a feasible route
+ends the chain, otherwise the next stage is tried. The last stage is a safety
+net: it is always run (unless a feasible route was already found), even if the
+deadline has passed, so a feasible route is always returned.
+
+How the time was spent is reported in solution's info under "deadline" key::
+
+    {"time_limit_ms": 500, "elapsed_ms": 212.4, "stage": "anneal",
+     "stages": [{"stage": "dwave", "status": "timed_out", "budget_ms": 450.0,
+                 "elapsed_ms": 150.2},
+                {"stage": "anneal", "status": "done", "budget_ms": 299.8,
+                 "elapsed_ms": 61.9},
+                {"stage": "heuristic", "status": "unused", "budget_ms": 0.0,
+                 "elapsed_ms": 0.0}]}
+"""
+from collections import namedtuple
+import logging
+import threading
+import time
+
+
+LOGGER_NAME = 'tsp.deadline'
+# Number of seconds kept in reserve for the last stage of the chain.
+RESERVE = 0.05
+
+DONE = 'done'
+BROKEN = 'broken'
+FAILED = 'failed'
+TIMED_OUT = 'timed_out'
+SKIPPED = 'skipped'
+UNUSED = 'unused'
+
+# Function of a stage is called with the number of seconds the stage may take and
+# returns TSPSolution, or None if it has no result. The stage is skipped if less
+# than min_seconds is left.
+Stage = namedtuple('Stage', ['name', 'function', 'min_seconds'])
+
+
+class DeadlineExceeded(RuntimeError):
+    """Raised when a call does not finish in time."""
+
+
+def call_with_timeout(function, timeout):
+    """Call function in a daemon thread, waiting for its result at most timeout seconds.
+
+    The call can't be interrupted, so if it doesn't finish in time it is abandoned,
+    i.e. it keeps running in the background and its result is discarded.
+
+    :raises DeadlineExceeded: if the call doesn't finish in time.
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = function()
+        except Exception as error:
+            outcome['error'] = error
+
+    thread = threading.Thread(target=target, name='tsp-deadline', daemon=True)
+    thread.start()
+    thread.join(max(timeout, 0.0))
+    if thread.is_alive():
+        raise DeadlineExceeded('Call did not finish in {:.3f} seconds.'.format(timeout))
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def solve_anytime(stages, time_limit_ms, reserve=RESERVE):
+    """Run stages in order until one of them finds a feasible route.
+
+    :param stages: stages of the chain, the last one should always succeed quickly.
+    :type stages: sequence of Stage
+    :param time_limit_ms: number of milliseconds all stages may take together.
+    :type time_limit_ms: number
+    :param reserve: number of seconds kept for the last stage, i.e. not given to the
+     preceding ones.
+    :type reserve: number
+    :returns: the first feasible solution or, if no stage found one, the broken
+     solution with the shortest mileage. Its info contains report of the chain
+     under "deadline" key.
+    :rtype: TSPSolution
+    :raises ValueError: if stages are empty.
+    :raises Exception: error of the last stage, if no stage returned a solution.
+    """
+    if not stages:
+        raise ValueError('At least one stage is required.')
+    logger = logging.getLogger(LOGGER_NAME)
+    started = time.perf_counter()
+    deadline = started + time_limit_ms / 1000.0
+    best, best_stage, error = None, None, None
+    report = []
+    for index, stage in enumerate(stages):
+        last = index == len(stages) - 1
+        record = {'stage': stage.name, 'status': UNUSED, 'budget_ms': 0.0, 'elapsed_ms': 0.0}
+        report.append(record)
+        if best is not None and -1 not in best.route:
+            continue
+        budget = max(deadline - time.perf_counter() - (0.0 if last else reserve), 0.0)
+        record['budget_ms'] = budget * 1000
+        if not last and budget < stage.min_seconds:
+            record['status'] = SKIPPED
+            continue
+        stage_started = time.perf_counter()
+        try:
+            solution = stage.function(budget)
+            record['status'] = FAILED if solution is None else (
+                BROKEN if -1 in solution.route else DONE)
+        except DeadlineExceeded as exc:
+            solution, error = None, exc
+            record['status'] = TIMED_OUT
+        except Exception as exc:
+            logger.warning('Stage %s failed: %s', stage.name, exc)
+            solution, error = None, exc
+            record['status'] = FAILED
+        record['elapsed_ms'] = (time.perf_counter() - stage_started) * 1000
+        if solution is not None and (best is None or _better(solution, best)):
+            best, best_stage = solution, stage.name
+    if best is None:
+        raise error or RuntimeError('No stage of the chain returned a solution.')
+    best.info['deadline'] = {
+        'time_limit_ms': time_limit_ms,
+        'elapsed_ms': (time.perf_counter() - started) * 1000,
+        'stage': best_stage,
+        'stages': report
+    }
+    return best
+
+
+def _better(solution, other):
+    """Check if solution is better than other: feasible first, then shorter."""
+    return (-1 in solution.route, solution.mileage) < (-1 in other.route, other.mileage)
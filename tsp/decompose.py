@@ -0,0 +1,213 @@
+"""Cluster-first decomposition of TSP instances too big to be solved as a single QUBO.
+
+Locations (except ends of the route) are partitioned into clusters of at most
+max_cluster_size locations. The order in which clusters are visited is found by
+solving TSP on the graph of clusters, then the location through which the route
+enters and leaves each cluster is chosen, so that every cluster becomes a path
+sub-problem with fixed ends. Sub-problems are solved independently (hence possibly
+in parallel), stitched together and seams are smoothed with local search.
+
+If there are too many clusters to solve their order as a single sub-problem, the
+graph of clusters is decomposed in the same way, hence the decomposition is
+hierarchical.
+
+All sub-problems are passed to the solver as paths from the first to the last
+location of the sub-problem's distance matrix, i.e. the form in which ends are
+fixed by the QUBO encoding.
+"""
+from collections import namedtuple
+import numpy as np
+from tsp.classical import local_search
+from tsp.qubo import default_ends
+
+
+# The largest size for which there is a precomputed embedding.
+DEFAULT_CLUSTER_SIZE = 9
+MIN_CLUSTER_SIZE = 3
+CLUSTERING_ITERATIONS = 20
+SMOOTHING_ITERATIONS = 200
+
+Decomposition = namedtuple('Decomposition', ['route', 'clusters', 'levels'])
+
+
+def cluster_locations(dist_matrix, locations, max_cluster_size):
+    """Partition locations into clusters of at most max_cluster_size locations.
+
+    This is capacity-constrained k-medoids: medoids are seeded with farthest-point
+    traversal, then locations are greedily assigned to the nearest medoid that has
+    free capacity and medoids are recomputed until they don't change.
+
+    :param dist_matrix: distance matrix of the whole problem.
+    :type dist_matrix: numpy.ndarray
+    :param locations: locations to partition.
+    :type locations: sequence of ints
+    :param max_cluster_size: maximum number of locations in a cluster.
+    :type max_cluster_size: int
+    :returns: clusters, each being a list of locations.
+    :rtype: list of lists of ints
+    """
+    locations = np.asarray(locations, dtype=np.intp)
+    if locations.shape[0] == 0:
+        return []
+    number_of_clusters = -(-locations.shape[0] // max_cluster_size)
+    distances = dist_matrix[np.ix_(locations, locations)]
+
+    medoids = [int(np.argmax(distances.sum(axis=1)))]
+    nearest = distances[medoids[0]].copy()
+    while len(medoids) < number_of_clusters:
+        medoids.append(int(np.argmax(nearest)))
+        nearest = np.minimum(nearest, distances[medoids[-1]])
+
+    for _ in range(CLUSTERING_ITERATIONS):
+        labels = _assign(distances[:, medoids], max_cluster_size)
+        updated = []
+        for cluster in range(number_of_clusters):
+            members = np.flatnonzero(labels == cluster)
+            if members.shape[0] == 0:
+                updated.append(medoids[cluster])
+                continue
+            within = distances[np.ix_(members, members)].sum(axis=1)
+            updated.append(int(members[np.argmin(within)]))
+        if updated == medoids:
+            break
+        medoids = updated
+    clusters = [locations[labels == cluster].tolist() for cluster in range(number_of_clusters)]
+    return [cluster for cluster in clusters if cluster]
+
+
+def cluster_distances(dist_matrix, clusters):
+    """Compute single-linkage distances between clusters.
+
+    :returns: matrix M such that M[i, j] is the shortest distance between a location
+     of i-th cluster and a location of j-th cluster.
+    :rtype: numpy.ndarray
+    """
+    result = np.zeros((len(clusters), len(clusters)))
+    for i, first in enumerate(clusters):
+        for j in range(i+1, len(clusters)):
+            result[i, j] = result[j, i] = dist_matrix[np.ix_(first, clusters[j])].min()
+    return result
+
+
+def choose_cluster_ends(dist_matrix, ordered_clusters):
+    """Choose locations through which the route enters and leaves every cluster.
+
+    Clusters are processed in order and each transition uses the shortest edge
+    between consecutive clusters, which doesn't leave the cluster through the
+    location it was entered (unless the cluster has a single location). The first
+    and the last cluster are assumed to contain just the ends of the route.
+
+    :returns: list of (entry, exit) pairs of locations.
+    :rtype: list of tuples
+    """
+    entries = [ordered_clusters[0][0]]
+    exits = []
+    for current, following in zip(ordered_clusters[:-1], ordered_clusters[1:]):
+        candidates = [node for node in current if node != entries[-1]] or current
+        distances = dist_matrix[np.ix_(candidates, following)]
+        exit_index, entry_index = np.unravel_index(np.argmin(distances), distances.shape)
+        exits.append(candidates[exit_index])
+        entries.append(following[entry_index])
+    exits.append(ordered_clusters[-1][-1])
+    return list(zip(entries, exits))
+
+
+def solve_decomposed(dist_matrix, solve_paths, max_cluster_size=DEFAULT_CLUSTER_SIZE,
+                     start=None, end=None, smoothing_iterations=SMOOTHING_ITERATIONS):
+    """Find route by solving clusters of locations as independent sub-problems.
+
+    :param dist_matrix: distance matrix of the problem.
+    :type dist_matrix: numpy.ndarray
+    :param solve_paths: function taking a list of distance matrices of sub-problems
+     and returning list of their routes. Route of each sub-problem has to start in
+     its first and finish in its last location.
+    :type solve_paths: callable
+    :param max_cluster_size: maximum number of locations in a sub-problem, at least
+     MIN_CLUSTER_SIZE.
+    :type max_cluster_size: int
+    :param start: first location of the route. Defaults to 0.
+    :type start: int
+    :param end: last location of the route. Defaults to the last location. If equal
+     to start, closed tour is returned.
+    :type end: int
+    :param smoothing_iterations: maximum number of local search moves applied to
+     the stitched route.
+    :type smoothing_iterations: int
+    :returns: namedtuple with "route", "clusters" and "levels" fields, where clusters
+     are sizes of clusters in the order of visiting and levels is the depth of the
+     hierarchy (0 if the problem was small enough to be solved directly and 1 if
+     the order of clusters was solved directly).
+    :rtype: Decomposition
+    """
+    if max_cluster_size < MIN_CLUSTER_SIZE:
+        raise ValueError(
+            'Clusters have to contain at least {} locations.'.format(MIN_CLUSTER_SIZE))
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    number_of_locations = dist_matrix.shape[0]
+    start, end = default_ends(number_of_locations, start, end)
+    inner = [node for node in range(number_of_locations) if node not in (start, end)]
+    if len(inner) + 2 <= max_cluster_size:
+        route = _solve_paths(dist_matrix, solve_paths, [[start] + inner + [end]])[0]
+        return Decomposition(route, [len(route)], 0)
+
+    clusters = [[start]] + cluster_locations(dist_matrix, inner, max_cluster_size) + [[end]]
+
+    # Order of clusters is a path from the start's to the end's cluster. For closed
+    # tours, the end's cluster is a copy of the start's one.
+    between = cluster_distances(dist_matrix, clusters)
+    if len(clusters) <= max_cluster_size:
+        order = _solve_paths(between, solve_paths, [list(range(len(clusters)))])[0]
+        levels = 1
+    else:
+        order = solve_decomposed(
+            between, solve_paths, max_cluster_size, 0, len(clusters) - 1, smoothing_iterations)
+        order, levels = order.route, order.levels + 1
+    ordered_clusters = [clusters[index] for index in order]
+
+    paths = []
+    for (entry, exit), cluster in zip(choose_cluster_ends(dist_matrix, ordered_clusters),
+                                      ordered_clusters):
+        if entry == exit:
+            paths.append([entry])
+        else:
+            paths.append([entry] + [node for node in cluster if node not in (entry, exit)] + [exit])
+    routes = _solve_paths(dist_matrix, solve_paths, paths[1:-1])
+    route = [start] + [node for path in routes for node in path] + [end]
+    route = local_search(dist_matrix, route, smoothing_iterations)
+    return Decomposition(route, [len(path) for path in paths[1:-1]], levels)
+
+
+def _solve_paths(dist_matrix, solve_paths, paths):
+    """Solve path sub-problems, each given as a list of locations with fixed ends.
+
+    Sub-problems of at most 3 locations have a single solution and are not passed
+    to the solver. Returns routes as lists of locations of the whole problem.
+    """
+    nontrivial = [path for path in paths if len(path) > 3]
+    solved = iter(solve_paths([dist_matrix[np.ix_(path, path)] for path in nontrivial]))
+    routes = []
+    for path in paths:
+        if len(path) > 3:
+            routes.append([path[index] for index in next(solved)])
+        else:
+            routes.append(path)
+    return routes
+
+
+def _assign(distances, capacity):
+    """Assign points to the nearest of clusters with free capacity.
+
+    :param distances: matrix M such that M[i, j] is distance of i-th point from j-th
+     medoid.
+    :returns: labels of points.
+    :rtype: numpy.ndarray
+    """
+    labels = np.full(distances.shape[0], -1, dtype=np.intp)
+    free = np.full(distances.shape[1], capacity)
+    points, clusters = np.unravel_index(np.argsort(distances, axis=None, kind='stable'),
+                                        distances.shape)
+    for point, cluster in zip(points.tolist(), clusters.tolist()):
+        if labels[point] < 0 and free[cluster] > 0:
+            labels[point] = cluster
+            free[cluster] -= 1
+    return labels
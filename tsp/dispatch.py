@@ -0,0 +1,293 @@
+"""Dispatching of D-Wave calls: single-flight coalescing and priority queueing.
+
+D-Wave calls are rate limited by a choke manager (at most limit calls in a window of
+window_length seconds). Instead of rejecting calls over the limit,
+:py:class:`QPUDispatcher` makes them wait in a queue shared by all workers through
+Redis:
+
+- Identical calls (i.e. calls with the same key, see :py:func:`tsp.cache.canonical_key`)
+  are made once. Threads of a worker wait for the thread making the call, while
+  other workers wait for the worker making it, which publishes its result in Redis.
+- Calls wait in a sorted set ordered by priority and arrival time. The call at the
+  head of the queue is made as soon as the rate limit allows it. Callers waiting
+  longer than their max_wait get QueueTimeoutError and are removed from the queue.
+
+Redis keys used by the dispatcher (all starting with prefix) are:
+
+- "flight:<key>" - token of the worker making the call, expiring after lease seconds,
+  so that calls of dead workers are taken over by waiting ones.
+- "result:<key>:<token>" - published result of the call made by the worker with
+  given token, expiring after result_ttl seconds. Followers read the token from
+  "flight:<key>", so they never get result of an earlier call of the same key.
+- "queue" - sorted set of tickets of waiting calls.
+"""
+import copy
+import json
+import logging
+import threading
+import time
+import uuid
+from choke import CallLimitExceededError
+from tsp.cache import dump_solution, load_solution
+from tsp.jobs import QueueFullError
+from tsp.metrics import REGISTRY
+
+
+LOGGER_NAME = 'tsp.dispatch'
+# Difference of one in priority outweighs this many seconds of waiting.
+PRIORITY_WEIGHT = 1e6
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'tsp_qpu_wait_seconds', 'Time D-Wave calls waited for rate limit or coalesced call.',
+    ['role'], WAIT_BUCKETS)
+DISPATCHES = REGISTRY.counter(
+    'tsp_qpu_dispatches', 'Number of D-Wave calls by role of the caller.', ['role'])
+
+LEADER = 'leader'
+FOLLOWER = 'follower'
+COALESCED = 'coalesced'
+
+
+class QueueTimeoutError(CallLimitExceededError):
+    """Raised when a call is not made (or its result is not ready) before deadline."""
+
+
+class RemoteCallError(RuntimeError):
+    """Raised in callers waiting for a call which failed in another worker."""
+
+
+class _Flight(object):
+    """Call being made by a thread of this worker."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class QPUDispatcher(object):
+    """Coalescing, priority-ordered dispatcher of rate-limited D-Wave calls.
+
+    :param redis: Redis connection shared by all workers.
+    :type redis: redis.StrictRedis
+    :param choke_manager: manager enforcing the rate limit.
+    :type choke_manager: choke.RedisChokeManager
+    :param window_length: length of the rate limit's window in seconds.
+    :type window_length: number
+    :param limit: maximum number of calls in the window.
+    :type limit: number
+    :param max_depth: maximum number of calls waiting in the queue. Submitting more
+     calls raises QueueFullError.
+    :type max_depth: int
+    :param lease: number of seconds after which the call of a worker is considered
+     dead and is taken over by a waiting worker.
+    :type lease: number
+    :param result_ttl: number of seconds for which published results are kept.
+    :type result_ttl: number
+    :param poll_interval: number of seconds between checks of the queue and results.
+    :type poll_interval: number
+    :param tag: tag of rate-limited calls in the choke manager.
+    :type tag: str
+    :param prefix: prefix of keys stored in Redis.
+    :type prefix: str
+    :param depth_interval: number of seconds between background reads of the depth
+     of the queue reported by :py:meth:`info`.
+    :type depth_interval: number
+    """
+
+    def __init__(self, redis, choke_manager, window_length=60, limit=10, max_depth=64,
+                 lease=120, result_ttl=60, poll_interval=0.1, tag='solve_using_dwave',
+                 prefix='tsp:qpu:', depth_interval=5.0):
+        self.redis = redis
+        self.choke_manager = choke_manager
+        self.window_length = window_length
+        self.limit = limit
+        self.max_depth = max_depth
+        self.lease = lease
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.tag = tag
+        self.prefix = prefix
+        self.depth_interval = depth_interval
+        self._depth = None
+        self._depth_thread = None
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {LEADER: 0, FOLLOWER: 0, COALESCED: 0, 'timeouts': 0, 'rejected': 0}
+
+    def dispatch(self, key, function, priority=0, max_wait=10):
+        """Call function once rate limit allows, unless identical call is in flight.
+
+        :param key: key identifying the call, calls with equal keys are coalesced.
+        :type key: str
+        :param function: function without arguments returning TSPSolution.
+        :type function: callable
+        :param priority: priority of the call, calls of higher priority are made first.
+        :type priority: int
+        :param max_wait: maximum number of seconds to wait for the call to be made
+         or for the result of identical call.
+        :type max_wait: number
+        :returns: result of the function or of identical call. Results of coalesced
+         calls are copies, so they can be modified by callers.
+        :rtype: TSPSolution
+        :raises QueueTimeoutError: if max_wait passes before the result is ready.
+        :raises QueueFullError: if max_depth calls are already waiting.
+        """
+        started = time.time()
+        deadline = started + max_wait
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self._count(COALESCED)
+            if not flight.done.wait(max(0.0, deadline - time.time())):
+                self._count('timeouts')
+                raise QueueTimeoutError('Timed out waiting for coalesced D-Wave call.')
+            QUEUE_WAIT_SECONDS.observe(time.time() - started, role=COALESCED)
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+        try:
+            flight.result = self._dispatch(key, function, priority, started, deadline)
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def info(self):
+        """Return statistics of the dispatcher as a dictionary, without waiting for Redis.
+
+        Depth of the queue is read by a background thread (started by the first call)
+        every depth_interval seconds, it is None until it is read or if Redis is
+        unavailable.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self._flights)
+            if self._depth_thread is None:
+                self._depth_thread = threading.Thread(
+                    target=self._watch_depth, name='tsp-qpu-depth', daemon=True)
+                self._depth_thread.start()
+        total = stats[LEADER] + stats[FOLLOWER] + stats[COALESCED]
+        stats['coalesce_rate'] = (stats[FOLLOWER] + stats[COALESCED]) / total if total else 0.0
+        stats['depth'] = self._depth
+        stats['max_depth'] = self.max_depth
+        return stats
+
+    def _watch_depth(self):
+        while True:
+            try:
+                self._depth = self.redis.zcard(self.prefix + 'queue')
+            except Exception as error:
+                logging.getLogger(LOGGER_NAME).warning('Unable to read queue depth: %s', error)
+                self._depth = None
+            time.sleep(self.depth_interval)
+
+    def _dispatch(self, key, function, priority, started, deadline):
+        """Make the call, or wait for result of identical call made by another worker."""
+        flight_key = self.prefix + 'flight:' + key
+        result_prefix = self.prefix + 'result:' + key + ':'
+        token = uuid.uuid4().hex
+        following = False
+        while not self.redis.set(flight_key, token, nx=True, ex=int(self.lease)):
+            if not following:
+                following = True
+                self._count(FOLLOWER)
+            data = self._wait_for_result(flight_key, result_prefix, deadline)
+            if data is not None:
+                QUEUE_WAIT_SECONDS.observe(time.time() - started, role=FOLLOWER)
+                payload = json.loads(data)
+                if 'error' in payload:
+                    raise RemoteCallError(payload['error'])
+                return load_solution(data)
+            # The call was abandoned without result, try taking it over.
+        if not following:
+            self._count(LEADER)
+        try:
+            self._wait_for_slot(priority, deadline)
+            QUEUE_WAIT_SECONDS.observe(time.time() - started, role=LEADER)
+            try:
+                result = function()
+            except Exception as error:
+                self._publish(result_prefix + token, json.dumps({'error': str(error)}))
+                raise
+            self._publish(result_prefix + token, dump_solution(result))
+            return result
+        finally:
+            if _text(self.redis.get(flight_key)) == token:
+                self.redis.delete(flight_key)
+
+    def _wait_for_result(self, flight_key, result_prefix, deadline):
+        """Wait for result of the call in flight, returning None if it was abandoned."""
+        token = _text(self.redis.get(flight_key))
+        while token is not None:
+            data = self.redis.get(result_prefix + token)
+            if data is not None:
+                return data
+            current = _text(self.redis.get(flight_key))
+            if current != token:
+                # The call ended (its result is published before the flight ends) or
+                # was taken over by another worker, whose result is waited for then.
+                data = self.redis.get(result_prefix + token)
+                if data is not None:
+                    return data
+                token = current
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self._count('timeouts')
+                raise QueueTimeoutError('Timed out waiting for D-Wave call of another worker.')
+            time.sleep(min(self.poll_interval, remaining))
+
+    def _wait_for_slot(self, priority, deadline):
+        """Wait in the queue until the call is at its head and rate limit allows it."""
+        queue = self.prefix + 'queue'
+        if self.redis.zcard(queue) >= self.max_depth:
+            self._count('rejected')
+            raise QueueFullError('D-Wave queue is full ({} waiting calls).'.format(self.max_depth))
+        ticket = '{:.6f}:{}'.format(deadline, uuid.uuid4().hex)
+        self.redis.zadd(queue, {ticket: time.time() - priority * PRIORITY_WEIGHT})
+        try:
+            while True:
+                now = time.time()
+                head = [_text(item) for item in self.redis.zrange(queue, 0, 0)]
+                if head and head[0] != ticket and float(head[0].split(':')[0]) < now:
+                    # Ticket of a caller that died while waiting.
+                    self.redis.zrem(queue, head[0])
+                    continue
+                if head and head[0] == ticket and self._acquire():
+                    return
+                if now >= deadline:
+                    self._count('timeouts')
+                    raise QueueTimeoutError('Timed out waiting in D-Wave queue.')
+                time.sleep(min(self.poll_interval, deadline - now))
+        finally:
+            self.redis.zrem(queue, ticket)
+
+    def _acquire(self):
+        """Register the call in the choke manager if rate limit allows it."""
+        if self.choke_manager.count_records(self.tag, self.window_length) >= self.limit:
+            return False
+        self.choke_manager.register_timestamp(self.tag)
+        return True
+
+    def _publish(self, result_key, data):
+        self.redis.set(result_key, data, ex=int(self.result_ttl))
+
+    def _count(self, role):
+        with self._lock:
+            self.stats[role] += 1
+        if role in (LEADER, FOLLOWER, COALESCED):
+            DISPATCHES.inc(role=role)
+
+
+def _text(value):
+    """Decode value returned by Redis, which returns bytes unless decode_responses is set."""
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,283 @@
+"""In-process stand-in for D-Wave's QPU, for load tests which shouldn't reach SAPI.
+
+:py:class:`FakeDWaveSampler` imitates DWaveSampler of a 2000Q (Chimera C16
+topology) and :py:class:`FakeFixedEmbeddingComposite` imitates FixedEmbeddingComposite
+(or EmbeddingComposite, if embedding is None). A call:
+
+- is rejected with :py:class:`FakeRateLimitError` if the sampler was called rate_limit
+  times in the last window seconds (rate_limit of 0 disables throttling),
+- waits latency seconds plus exponentially distributed jitter (with mean jitter) for
+  the network and SAPI, and embedding_time more if embedding is found on every call,
+- fails with :py:class:`FakeSolverError` with probability failure_rate,
+- holds the (per-process) QPU for as long as the real one would, according to timing
+  reported in info["timing"] in microseconds, like SAPI does,
+- returns samples of a short run (num_sweeps sweeps) of
+  :py:class:`tsp.annealing.AnnealingSampler`, in which every chain of the embedding
+  breaks with probability 1 - (1 - chain_break_rate) ** (length - 1) and is then
+  resolved to a random value. Fraction of broken chains of every sample is
+  reported in "chain_break_fraction" vector.
+
+The web service uses the fake sampler if FAKE_DWAVE environment variable is set to
+comma-separated settings (see :py:func:`parse_settings`), e.g.::
+
+    FAKE_DWAVE="latency=0.3,failure_rate=0.02,rate_limit=5" gunicorn tsp.web:api
+"""
+import functools
+import random
+import threading
+import time
+import dimod
+import numpy as np
+from tsp.annealing import AnnealingSampler, qubo_matrix
+
+
+CHIMERA_SHAPE = (16, 16, 4)
+# Per-sample times of 2000Q and its programming time, in microseconds.
+ANNEAL_TIME = 20
+READOUT_TIME = 123
+DELAY_TIME = 21
+PROGRAMMING_TIME = 9160
+POST_PROCESSING_TIME = 1500
+# Length of chains assumed when embedding is found on every call.
+DEFAULT_CHAIN_LENGTH = 4
+
+DEFAULT_SETTINGS = {
+    'latency': 0.25,
+    'jitter': 0.05,
+    'embedding_time': 1.0,
+    'failure_rate': 0.0,
+    'rate_limit': 0,
+    'window': 1.0,
+    'chain_break_rate': 0.005,
+    'num_sweeps': 50,
+    'seed': None
+}
+
+
+class FakeSolverError(RuntimeError):
+    """Raised by fake calls which fail."""
+
+
+class FakeRateLimitError(FakeSolverError):
+    """Raised by fake calls over the rate limit."""
+
+
+def parse_settings(spec):
+    """Parse comma-separated settings of the fake sampler, e.g. "latency=0.3,seed=1".
+
+    Names of settings are the keys of DEFAULT_SETTINGS, an empty string means defaults.
+
+    :rtype: dict
+    :raises ValueError: if a setting is unknown or its value is not a number.
+    """
+    settings = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, _, value = item.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_SETTINGS:
+            raise ValueError('Unknown setting of fake D-Wave: {}.'.format(name))
+        settings[name] = int(value) if name in ('num_sweeps', 'seed') else float(value)
+    return settings
+
+
+def fake_factories(spec):
+    """Return pair (sampler_factory, composite_factory) for :py:class:`tsp.registry.SolverRegistry`.
+
+    :param spec: settings of the fake sampler, see :py:func:`parse_settings`.
+    :type spec: str
+    """
+    return functools.partial(FakeDWaveSampler, **parse_settings(spec)), FakeFixedEmbeddingComposite
+
+
+def chimera_edges(rows, columns, shore):
+    """Return couplers of Chimera graph with given shape, with qubits numbered as D-Wave does."""
+    def qubit(row, column, side, index):
+        return ((row * columns + column) * 2 + side) * shore + index
+
+    edges = []
+    for row in range(rows):
+        for column in range(columns):
+            edges.extend(
+                (qubit(row, column, 0, first), qubit(row, column, 1, second))
+                for first in range(shore) for second in range(shore))
+            if row + 1 < rows:
+                edges.extend(
+                    (qubit(row, column, 0, index), qubit(row + 1, column, 0, index))
+                    for index in range(shore))
+            if column + 1 < columns:
+                edges.extend(
+                    (qubit(row, column, 1, index), qubit(row, column + 1, 1, index))
+                    for index in range(shore))
+    return edges
+
+
+def qpu_timing(num_reads):
+    """Return timing of a QPU call with given number of reads, as reported by SAPI."""
+    sampling = num_reads * (ANNEAL_TIME + READOUT_TIME + DELAY_TIME)
+    return {
+        'qpu_sampling_time': sampling,
+        'qpu_anneal_time_per_sample': ANNEAL_TIME,
+        'qpu_readout_time_per_sample': READOUT_TIME,
+        'qpu_delay_time_per_sample': DELAY_TIME,
+        'qpu_programming_time': PROGRAMMING_TIME,
+        'qpu_access_time': PROGRAMMING_TIME + sampling,
+        'qpu_access_overhead_time': 0,
+        'run_time_chip': sampling,
+        'anneal_time_per_run': ANNEAL_TIME,
+        'readout_time_per_run': READOUT_TIME,
+        'total_post_processing_time': POST_PROCESSING_TIME,
+        'post_processing_overhead_time': POST_PROCESSING_TIME,
+        'total_real_time': PROGRAMMING_TIME + sampling
+    }
+
+
+class FakeDWaveSampler(dimod.Sampler):
+    """Fake QPU sampler, accepting the same arguments as DWaveSampler and fake settings.
+
+    See the module for description of settings, token and endpoint are ignored.
+    """
+
+    parameters = {'num_reads': [], 'annealing_time': [], 'auto_scale': []}
+
+    def __init__(self, token=None, endpoint=None, **settings):
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError('Unknown settings of fake D-Wave: {}.'.format(', '.join(sorted(unknown))))
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self.edgelist = chimera_edges(*CHIMERA_SHAPE)
+        self.nodelist = list(range(CHIMERA_SHAPE[0] * CHIMERA_SHAPE[1] * 2 * CHIMERA_SHAPE[2]))
+        self._properties = {
+            'chip_id': 'FAKE_2000Q',
+            'topology': {'type': 'chimera', 'shape': list(CHIMERA_SHAPE)},
+            'num_qubits': len(self.nodelist),
+            'qubits': self.nodelist,
+            'couplers': self.edgelist
+        }
+        self.stats = {'calls': 0, 'failures': 0, 'throttled': 0}
+        self._random = random.Random(self.settings['seed'])
+        self._calls = []
+        self._lock = threading.Lock()
+        self._qpu = threading.Lock()
+
+    @property
+    def properties(self):
+        """Properties of the fake QPU, like the ones reported by SAPI."""
+        return self._properties
+
+    def sample(self, bqm, num_reads=1, **parameters):
+        """Sample binary quadratic model, whose variables are treated as single qubits.
+
+        :rtype: dimod.SampleSet
+        """
+        return self.run(bqm, num_reads, {variable: 1 for variable in bqm.variables})
+
+    def run(self, bqm, num_reads, chain_lengths, find_embedding=False):
+        """Make fake call sampling (logical) model with given lengths of chains.
+
+        :param chain_lengths: mapping variable -> number of qubits of its chain.
+        :type chain_lengths: dict
+        :param find_embedding: whether embedding_time should be spent.
+        :type find_embedding: bool
+        :rtype: dimod.SampleSet
+        :raises FakeRateLimitError: if the call is over the rate limit.
+        :raises FakeSolverError: if the call fails.
+        """
+        settings = self.settings
+        with self._lock:
+            self.stats['calls'] += 1
+            now = time.monotonic()
+            self._calls = [called for called in self._calls if called > now - settings['window']]
+            if settings['rate_limit'] and len(self._calls) >= settings['rate_limit']:
+                self.stats['throttled'] += 1
+                raise FakeRateLimitError('Too many requests.')
+            self._calls.append(now)
+            jitter = self._random.expovariate(1 / settings['jitter']) if settings['jitter'] else 0.0
+            failed = self._random.random() < settings['failure_rate']
+            seed = self._random.randrange(2 ** 32)
+        delay = settings['latency'] + jitter
+        if find_embedding:
+            delay += settings['embedding_time']
+        time.sleep(delay)
+        if failed:
+            with self._lock:
+                self.stats['failures'] += 1
+            raise FakeSolverError('Fake D-Wave call failed.')
+
+        timing = qpu_timing(num_reads)
+        with self._qpu:
+            started = time.perf_counter()
+            sampleset = AnnealingSampler().sample(
+                bqm, num_reads=num_reads, num_sweeps=settings['num_sweeps'], seed=seed)
+            time.sleep(max(timing['qpu_access_time'] / 1e6 - (time.perf_counter() - started), 0.0))
+        return self._break_chains(bqm, sampleset, chain_lengths, timing, np.random.RandomState(seed))
+
+    def _break_chains(self, bqm, sampleset, chain_lengths, timing, random_state):
+        """Resolve randomly broken chains to random values and recompute energies."""
+        labels = list(sampleset.variables)
+        samples = np.array(sampleset.record.sample, dtype=np.int8)
+        lengths = np.array([chain_lengths[label] for label in labels], dtype='float64')
+        probabilities = 1 - (1 - self.settings['chain_break_rate']) ** (lengths - 1)
+        broken = random_state.random_sample(samples.shape) < probabilities
+        values = (0, 1) if bqm.vartype is dimod.BINARY else (-1, 1)
+        samples[broken] = random_state.choice(values, size=int(broken.sum()))
+
+        binary = bqm if bqm.vartype is dimod.BINARY else bqm.change_vartype(
+            dimod.BINARY, inplace=False)
+        matrix = qubo_matrix(binary, labels)
+        spins = samples if bqm.vartype is dimod.BINARY else (samples + 1) // 2
+        spins = spins.astype('float64')
+        energies = np.einsum('ri,ri->r', spins @ matrix, spins) + binary.offset
+        return dimod.SampleSet.from_samples(
+            (samples, labels), bqm.vartype, energies,
+            info={'timing': timing, 'problem_id': 'fake-{:08x}'.format(random_state.randint(2 ** 31))},
+            chain_break_fraction=broken.mean(axis=1) if labels else np.zeros(len(samples)))
+
+
+class FakeFixedEmbeddingComposite(dimod.ComposedSampler):
+    """Fake FixedEmbeddingComposite, or EmbeddingComposite if embedding is None.
+
+    :param child_sampler: fake QPU sampler.
+    :type child_sampler: FakeDWaveSampler
+    :param embedding: mapping variable -> list of qubits.
+    :type embedding: dict
+    """
+
+    def __init__(self, child_sampler, embedding=None):
+        if embedding is not None:
+            qubits = set(child_sampler.nodelist)
+            if any(qubit not in qubits for chain in embedding.values() for qubit in chain):
+                raise ValueError('Embedding uses qubits missing from the sampler.')
+        self._children = [child_sampler]
+        self.embedding = embedding
+
+    @property
+    def children(self):
+        """List containing the fake QPU sampler."""
+        return self._children
+
+    @property
+    def parameters(self):
+        """Parameters of the fake QPU sampler and chain_strength."""
+        return dict(self.child.parameters, chain_strength=[])
+
+    @property
+    def properties(self):
+        """Properties of the fake QPU sampler."""
+        return {'child_properties': self.child.properties}
+
+    def sample(self, bqm, chain_strength=1.0, num_reads=1, **parameters):
+        """Sample binary quadratic model, chain_strength is accepted but ignored.
+
+        :rtype: dimod.SampleSet
+        :raises ValueError: if embedding doesn't contain all variables of the model.
+        """
+        if self.embedding is None:
+            lengths = {variable: DEFAULT_CHAIN_LENGTH for variable in bqm.variables}
+        else:
+            missing = [variable for variable in bqm.variables if variable not in self.embedding]
+            if missing:
+                raise ValueError('Embedding is missing variables: {}.'.format(missing[:10]))
+            lengths = {variable: len(self.embedding[variable]) for variable in bqm.variables}
+        return self.child.run(bqm, num_reads, lengths, find_embedding=self.embedding is None)
@@ -0,0 +1,256 @@
+"""Asynchronous execution of TSP solving jobs.
+
+Jobs are executed by threads of the worker which accepted them. If the queue has a
+Redis connection, status and result of every job are also published in Redis (under
+"<prefix><job_id>" key), so that any worker can report them. Publishing is done by
+a background thread, so neither submitting nor running jobs waits for Redis, and
+the worker's own state of its jobs stays the source of truth.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import threading
+import time
+import uuid
+from tsp.cache import dump_solution, load_solution
+
+
+LOGGER_NAME = 'tsp.jobs'
+# Records of queued or running jobs expire after this many seconds, so that jobs
+# of dead workers are eventually forgotten.
+PENDING_TTL = 24 * 3600
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    """Raised when job is submitted to a queue that reached its maximum depth."""
+
+
+class Job(object):
+    """Single job submitted to :py:class:`JobQueue`."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        """Return description of the job (without result) as a dictionary."""
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error
+        }
+
+
+def dump_job(job):
+    """Serialize job, including its result (TSPSolution), to JSON string."""
+    record = job.to_dict()
+    record['result'] = None if job.result is None else dump_solution(job.result)
+    return json.dumps(record)
+
+
+def load_job(data):
+    """Deserialize job from JSON string produced by :py:func:`dump_job`."""
+    record = json.loads(data)
+    job = Job(record['job_id'])
+    for name in ('status', 'created', 'started', 'finished', 'error'):
+        setattr(job, name, record[name])
+    if record['result'] is not None:
+        job.result = load_solution(record['result'])
+    if job.finished is not None:
+        job.done.set()
+    return job
+
+
+class JobQueue(object):
+    """Bounded queue of jobs executed by a pool of worker threads.
+
+    Solving is dominated by waiting for D-Wave or by native code of QBSolv, hence
+    threads are sufficient and allow jobs to share solvers of the web resource.
+
+    :param max_workers: number of jobs executed concurrently.
+    :type max_workers: int
+    :param max_depth: maximum number of jobs that are queued or running at once.
+     Submitting more jobs raises QueueFullError.
+    :type max_depth: int
+    :param ttl: number of seconds after which finished jobs are forgotten.
+    :type ttl: number
+    :param redis: optional Redis connection in which jobs are published, so that
+     jobs of other workers can be read. Failures of Redis are logged and jobs of
+     other workers are then treated as missing.
+    :type redis: redis.StrictRedis
+    :param prefix: prefix of keys stored in Redis.
+    :type prefix: str
+    :param poll_interval: number of seconds between checks of jobs of other workers
+     which are waited for.
+    :type poll_interval: number
+    """
+
+    def __init__(self, max_workers=2, max_depth=32, ttl=600, redis=None, prefix='tsp:job:',
+                 poll_interval=0.25):
+        self.max_workers = max_workers
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self.redis = redis
+        self.prefix = prefix
+        self.poll_interval = poll_interval
+        self._executor = None
+        self._publisher = None
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """Pool executing jobs, created on first use (i.e. after gunicorn forks)."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    @property
+    def publisher(self):
+        """Single thread publishing jobs in Redis in order, created on first use."""
+        with self._lock:
+            if self._publisher is None:
+                self._publisher = ThreadPoolExecutor(max_workers=1)
+            return self._publisher
+
+    @property
+    def depth(self):
+        """Number of jobs that are queued or running."""
+        return self._pending
+
+    def submit(self, function, *args, **kwargs):
+        """Submit function to be executed asynchronously.
+
+        :returns: the created job.
+        :rtype: Job
+        :raises QueueFullError: if max_depth jobs are already pending.
+        """
+        executor = self.executor
+        with self._lock:
+            self._expire()
+            if self._pending >= self.max_depth:
+                raise QueueFullError(
+                    'Job queue is full ({} pending jobs).'.format(self._pending))
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.job_id] = job
+            self._pending += 1
+        self._publish(job)
+        executor.submit(self._run, job, function, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        """Get job with given id or None if there is no such job.
+
+        Jobs of other workers are read from Redis, they are snapshots which are not
+        updated when the job progresses.
+        """
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+        return job if job is not None else self._read(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """Wait at most timeout seconds for job to finish.
+
+        :returns: the job or None if there is no job with given id.
+        :rtype: Job
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        job = self.get(job_id)
+        while job is not None and not job.done.is_set():
+            if job_id in self._jobs:
+                job.done.wait(None if deadline is None else max(deadline - time.time(), 0.0))
+                break
+            # Job of another worker, whose progress is visible only in Redis.
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+            job = self.get(job_id) or job
+        return job
+
+    def info(self):
+        """Return statistics of the queue as a dictionary."""
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            'depth': self._pending,
+            'max_depth': self.max_depth,
+            'workers': self.max_workers,
+            'queued': statuses.count(QUEUED),
+            'running': statuses.count(RUNNING),
+            'redis': self.redis is not None
+        }
+
+    def _run(self, job, function, args, kwargs):
+        job.status = RUNNING
+        job.started = time.time()
+        self._publish(job)
+        try:
+            job.result = function(*args, **kwargs)
+            job.status = DONE
+        except Exception as error:
+            logging.getLogger(LOGGER_NAME).exception('Job %s failed.', job.job_id)
+            job.error = str(error)
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+            self._publish(job)
+            with self._lock:
+                self._pending -= 1
+            job.done.set()
+
+    def _publish(self, job):
+        """Schedule publishing of the current state of the job in Redis."""
+        if self.redis is None:
+            return
+        try:
+            data = dump_job(job)
+        except Exception as error:
+            logging.getLogger(LOGGER_NAME).warning(
+                'Unable to serialize job %s: %s', job.job_id, error)
+            return
+        ttl = max(int(self.ttl), 1) if job.finished is not None else PENDING_TTL
+        self.publisher.submit(self._store, job.job_id, data, ttl)
+
+    def _store(self, job_id, data, ttl):
+        try:
+            self.redis.set(self.prefix + job_id, data, ex=ttl)
+        except Exception as error:
+            logging.getLogger(LOGGER_NAME).warning(
+                'Unable to store job %s in Redis: %s', job_id, error)
+
+    def _read(self, job_id):
+        if self.redis is None:
+            return None
+        try:
+            data = self.redis.get(self.prefix + job_id)
+        except Exception as error:
+            logging.getLogger(LOGGER_NAME).warning(
+                'Unable to read job %s from Redis: %s', job_id, error)
+            return None
+        return None if data is None else load_job(data)
+
+    def _expire(self):
+        # Jobs are ordered by creation, not by finishing, so all of them are checked.
+        deadline = time.time() - self.ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and job.finished < deadline:
+                del self._jobs[job_id]
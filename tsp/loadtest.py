@@ -0,0 +1,332 @@
+"""Load test of the web service: throughput and tail latency of /tsp/solve.
+
+Unless --url is given, the load test starts the service on a local gunicorn with fake
+D-Wave (see :py:mod:`tsp.fakeqpu`), so that D-Wave requests never reach SAPI. Redis
+has to be running (see REDIS_HOST and REDIS_PORT), as the service uses it for rate
+limiting D-Wave calls::
+
+    python -m tsp.loadtest --workers 4 --concurrency 16 --duration 60 \\
+        --fake-dwave latency=0.3,failure_rate=0.02 -o load.json
+
+Clients send problems of random kind (see :py:data:`tsp.bench.INSTANCES`), size and
+mode, where modes are:
+
+- "local" - solved by CLASSICAL_BACKEND,
+- "dwave" - solved on (fake) D-Wave, falling back to CLASSICAL_BACKEND,
+- "decompose" - problems of --large-sizes solved with "decompose": true,
+- "deadline" - solved on D-Wave with "time_limit_ms" of --time-limit-ms.
+
+With probability --repeat a client sends one of the problems sent before, exercising
+the solution cache and coalescing of D-Wave calls.
+
+Latency percentiles (p50, p95, p99), throughput and error rate are reported for all
+requests and for every mode and size, together with fallback rate (fraction of
+requests for D-Wave solved classically) and resident memory of every worker
+(sampled during the test, Linux only).
+"""
+import argparse
+from collections import OrderedDict
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import numpy as np
+from tsp.bench import INSTANCES, KINDS
+
+
+MODES = ['local', 'dwave', 'decompose', 'deadline']
+DEFAULT_MODES = ['local', 'dwave']
+DEFAULT_SIZES = [5, 7, 9]
+DEFAULT_LARGE_SIZES = [20, 40]
+PERCENTILES = (50, 95, 99)
+RSS_INTERVAL = 0.5
+STARTUP_TIMEOUT = 30
+REQUEST_TIMEOUT = 120
+
+
+def make_payload(mode, size, kind, random_state, time_limit_ms):
+    """Generate payload of /tsp/solve with random problem of given mode, size and kind."""
+    locations, dist_matrix = INSTANCES[kind](size, random_state)
+    if locations is not None:
+        payload = {'locations': locations.tolist()}
+    else:
+        payload = {'distances': dist_matrix.tolist()}
+    if mode in ('dwave', 'deadline'):
+        payload['use_dwave'] = True
+    if mode == 'decompose':
+        payload['decompose'] = True
+    if mode == 'deadline':
+        payload['time_limit_ms'] = time_limit_ms
+    return payload
+
+
+def post(url, payload):
+    """Send payload to /tsp/solve, returning pair (HTTP status, decoded response or None)."""
+    request = urllib.request.Request(
+        url + '/tsp/solve', data=json.dumps(payload).encode(),
+        headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return response.status, json.loads(response.read().decode())
+    except urllib.error.HTTPError as error:
+        return error.code, None
+    except (OSError, ValueError):
+        return None, None
+
+
+def worker_pids(master_pid):
+    """Return PIDs of children of the process with given PID (Linux only)."""
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as stat:
+                # Command name may contain spaces, the parent PID follows it.
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(name))
+    return sorted(pids)
+
+
+def resident_memory(pid):
+    """Return resident memory of process with given PID in bytes, or None if it is gone."""
+    try:
+        with open('/proc/{}/statm'.format(pid)) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+class MemorySampler(object):
+    """Periodic sampler of resident memory of gunicorn's workers.
+
+    :param master_pid: PID of gunicorn's master process.
+    :type master_pid: int
+    """
+
+    def __init__(self, master_pid):
+        self.master_pid = master_pid
+        self.samples = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and return maximum and last RSS of every worker in MiB."""
+        self._stopped.set()
+        self._thread.join()
+        return OrderedDict(
+            (str(pid), OrderedDict([
+                ('max_mib', max(values) / 2 ** 20),
+                ('last_mib', values[-1] / 2 ** 20)]))
+            for pid, values in sorted(self.samples.items()))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if os.path.isdir('/proc'):
+                for pid in worker_pids(self.master_pid):
+                    rss = resident_memory(pid)
+                    if rss is not None:
+                        self.samples.setdefault(pid, []).append(rss)
+            self._stopped.wait(RSS_INTERVAL)
+
+
+def start_server(port, workers, fake_dwave, gunicorn_args=()):
+    """Start local gunicorn serving tsp.web:api and wait until it responds.
+
+    :returns: gunicorn's master process.
+    :rtype: subprocess.Popen
+    """
+    env = dict(os.environ, COMPUTE_MISSING_EMBEDDINGS='0')
+    if fake_dwave is not None:
+        env['FAKE_DWAVE'] = fake_dwave
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+         'tsp.web:api', '-b', '127.0.0.1:{}'.format(port), '-w', str(workers)] +
+        list(gunicorn_args), env=env)
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with code {}.'.format(process.returncode))
+        try:
+            with urllib.request.urlopen(url + '/metrics', timeout=1):
+                return process
+        except (OSError, ValueError):
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start in {} seconds.'.format(STARTUP_TIMEOUT))
+
+
+def run_load(url, concurrency=8, duration=30.0, requests=None, modes=DEFAULT_MODES,
+             sizes=DEFAULT_SIZES, large_sizes=DEFAULT_LARGE_SIZES, kinds=KINDS,
+             time_limit_ms=2000, repeat=0.0, seed=0):
+    """Drive /tsp/solve of the service at url with concurrent clients.
+
+    Clients stop after duration seconds or, if requests is given, once that many
+    requests were sent.
+
+    :returns: list of records with "mode", "size", "kind", "status", "latency",
+     "backend", "fallback" and "cache" keys, and duration of the test in seconds.
+    :rtype: tuple
+    """
+    records = []
+    sent = []
+    in_flight = [0]
+    lock = threading.Lock()
+    started = time.perf_counter()
+    stop_at = started + duration
+
+    def client(index):
+        random_state = np.random.RandomState(seed + index)
+        while time.perf_counter() < stop_at:
+            with lock:
+                if requests is not None and len(records) + in_flight[0] >= requests:
+                    return
+                in_flight[0] += 1
+                previous = sent[random_state.randint(len(sent))] if sent else None
+            if previous is not None and random_state.rand() < repeat:
+                mode, size, kind, payload = previous
+            else:
+                mode = modes[random_state.randint(len(modes))]
+                size_choices = large_sizes if mode == 'decompose' else sizes
+                size = size_choices[random_state.randint(len(size_choices))]
+                kind = kinds[random_state.randint(len(kinds))]
+                payload = make_payload(mode, size, kind, random_state, time_limit_ms)
+                with lock:
+                    sent.append((mode, size, kind, payload))
+            request_started = time.perf_counter()
+            status, body = post(url, payload)
+            latency = time.perf_counter() - request_started
+            info = body.get('info', {}) if body else {}
+            with lock:
+                in_flight[0] -= 1
+                records.append({
+                    'mode': mode,
+                    'size': size,
+                    'kind': kind,
+                    'status': status,
+                    'latency': latency,
+                    'backend': info.get('backend'),
+                    'fallback': payload.get('use_dwave', False) and body is not None and
+                                info.get('backend') != 'dwave',
+                    'cache': info.get('cache')
+                })
+
+    threads = [
+        threading.Thread(target=client, args=(index,), name='client-' + str(index))
+        for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, time.perf_counter() - started
+
+
+def summarize(records, duration):
+    """Compute latency percentiles, throughput, error and fallback rates of records."""
+    latencies = np.array([record['latency'] for record in records if record['status'] == 200])
+    errors = sum(1 for record in records if record['status'] != 200)
+    for_dwave = [record for record in records if record['mode'] in ('dwave', 'deadline')]
+    summary = OrderedDict([
+        ('requests', len(records)),
+        ('errors', errors),
+        ('error_rate', errors / len(records) if records else 0.0),
+        ('throughput', (len(records) - errors) / duration if duration else 0.0)])
+    for percentile in PERCENTILES:
+        summary['p{}'.format(percentile)] = (
+            float(np.percentile(latencies, percentile)) if latencies.size else None)
+    summary['mean'] = float(latencies.mean()) if latencies.size else None
+    if for_dwave:
+        summary['fallback_rate'] = (
+            sum(1 for record in for_dwave if record['fallback']) / len(for_dwave))
+    summary['cache_hits'] = sum(
+        1 for record in records if record['cache'] not in (None, 'miss'))
+    return summary
+
+
+def report(records, duration, parameters, workers=None):
+    """Build report of the load test, overall and broken down by mode and by size."""
+    modes, sizes = {}, {}
+    for record in records:
+        modes.setdefault(record['mode'], []).append(record)
+        sizes.setdefault(record['size'], []).append(record)
+    return OrderedDict([
+        ('parameters', parameters),
+        ('duration', duration),
+        ('summary', summarize(records, duration)),
+        ('modes', OrderedDict(
+            (mode, summarize(modes[mode], duration)) for mode in sorted(modes))),
+        ('sizes', OrderedDict(
+            (str(size), summarize(sizes[size], duration)) for size in sorted(sizes))),
+        ('workers', workers)])
+
+
+def main(argv=None):
+    """Entry point of command line interface."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='URL of running service, if not given local '
+                        'gunicorn is started')
+    parser.add_argument('--pid', type=int, help='PID of gunicorn master of the running '
+                        'service, for memory of its workers')
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--fake-dwave', default='', help='settings of fake D-Wave, see '
+                        'tsp/fakeqpu.py (default: defaults of fake D-Wave)')
+    parser.add_argument('--gunicorn', default='', help='additional arguments of gunicorn')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--requests', type=int, help='stop after this many requests')
+    parser.add_argument('--modes', nargs='+', default=DEFAULT_MODES, choices=MODES)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--large-sizes', type=int, nargs='+', default=DEFAULT_LARGE_SIZES)
+    parser.add_argument('--kinds', nargs='+', default=KINDS, choices=KINDS)
+    parser.add_argument('--time-limit-ms', type=float, default=2000)
+    parser.add_argument('--repeat', type=float, default=0.0,
+                        help='probability of sending a problem sent before')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='output file, defaults to standard output')
+    args = parser.parse_args(argv)
+
+    server = None
+    url, master_pid = args.url, args.pid
+    if url is None:
+        server = start_server(
+            args.port, args.workers, args.fake_dwave, shlex.split(args.gunicorn))
+        url, master_pid = 'http://127.0.0.1:{}'.format(args.port), server.pid
+    memory = MemorySampler(master_pid) if master_pid is not None else None
+    try:
+        if memory is not None:
+            memory.start()
+        records, duration = run_load(
+            url, args.concurrency, args.duration, args.requests, args.modes, args.sizes,
+            args.large_sizes, args.kinds, args.time_limit_ms, args.repeat, args.seed)
+    finally:
+        workers = memory.stop() if memory is not None else None
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    parameters = OrderedDict(
+        (name, value) for name, value in sorted(vars(args).items()) if name != 'output')
+    results = report(records, duration, parameters, workers)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
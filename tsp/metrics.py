@@ -0,0 +1,244 @@
+"""Low-overhead instrumentation of TSP solving: timing spans, counters and histograms.
+
+Metrics are kept in memory of the process and rendered in Prometheus text format
+by :py:meth:`Registry.render`. Every gunicorn worker has its own metrics, hence
+each worker should be scraped separately (or requests should be sticky).
+
+Stages of solving are timed with :py:func:`span`, which records their duration
+in STAGE_SECONDS histogram and, if the current thread is profiling a request
+(see :py:func:`profiling`), in the request's profile.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+import gc
+import math
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter(object):
+    """Monotonically increasing counter, optionally split by labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Increase value of the counter with given labels by amount."""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Return current value of the counter with given labels."""
+        return self._values.get(tuple(str(labels.get(name, '')) for name in self.labelnames), 0)
+
+    def samples(self):
+        """Yield (name, labels, value) triples of all series of the counter."""
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + '_total', list(zip(self.labelnames, key)), value
+
+
+class Histogram(object):
+    """Histogram with fixed buckets, optionally split by labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Record observation of value in the series with given labels."""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        """Yield (name, labels, value) triples of buckets, sums and counts."""
+        with self._lock:
+            series = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._series.items())
+        for key, (counts, total) in series:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield self.name + '_bucket', labels + [('le', _format_value(bound))], cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class Registry(object):
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        """Create and register :py:class:`Counter`."""
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Create and register :py:class:`Histogram`."""
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, function):
+        """Register function computing metrics at scrape time.
+
+        The function should return iterable of (name, documentation, value) triples
+        of gauges, or (name, documentation, value, kind) quadruples where kind is
+        "gauge" or "counter". Samples of counters get "_total" suffix, like the ones
+        of :py:class:`Counter`.
+        """
+        self._collectors.append(function)
+        return function
+
+    def render(self):
+        """Render all metrics in Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append(_format_sample(name, labels, value))
+        for collector in self._collectors:
+            for metric in collector():
+                name, documentation, value = metric[:3]
+                kind = metric[3] if len(metric) > 3 else 'gauge'
+                lines.append('# HELP {} {}'.format(name, documentation))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                lines.append(_format_sample(
+                    name + '_total' if kind == 'counter' else name, [], value))
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('Metric {} is already registered.'.format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    'tsp_stage_duration_seconds', 'Duration of stages of solving TSP.', ['stage'])
+
+
+class Profile(object):
+    """Spans recorded while solving a single request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def to_dict(self):
+        """Return the profile as a JSON-serializable dictionary."""
+        return {
+            'total': time.perf_counter() - self.started,
+            'spans': [{'stage': stage, 'offset': offset, 'seconds': seconds}
+                      for stage, offset, seconds in self.spans]
+        }
+
+
+_LOCAL = threading.local()
+
+
+@contextmanager
+def profiling(enabled=True):
+    """Record spans of the current thread in a new :py:class:`Profile`.
+
+    Yields the profile, or None if profiling is not enabled.
+    """
+    if not enabled:
+        yield None
+        return
+    previous = getattr(_LOCAL, 'profile', None)
+    _LOCAL.profile = profile = Profile()
+    try:
+        yield profile
+    finally:
+        _LOCAL.profile = previous
+
+
+@contextmanager
+def span(stage):
+    """Measure duration of the enclosed block as given stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        profile = getattr(_LOCAL, 'profile', None)
+        if profile is not None:
+            profile.spans.append((stage, started - profile.started, elapsed))
+
+
+class GCPolicy(object):
+    """Policy of forcing garbage collection after requests.
+
+    :param policy: "never" (default), "always" or a number N, in which case garbage
+     is collected after every N-th request.
+    :type policy: str
+    """
+
+    def __init__(self, policy='never'):
+        if policy == 'never':
+            self.interval = 0
+        elif policy == 'always':
+            self.interval = 1
+        else:
+            self.interval = int(policy)
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    def after_request(self):
+        """Collect garbage if the policy says so, returning whether it was collected."""
+        if self.interval <= 0:
+            return False
+        with self._lock:
+            self._requests += 1
+            if self._requests < self.interval:
+                return False
+            self._requests = 0
+        with span('gc'):
+            gc.collect()
+        return True
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(
+            '{}="{}"'.format(label, _escape(text)) for label, text in labels) + '}'
+    return '{} {}'.format(name, _format_value(value))
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -0,0 +1,85 @@
+"""Sparsification of TSP QUBO by pruning transitions between distant locations.
+
+Dense QUBO has an objective coupler for every pair of distinct locations in every
+pair of consecutive steps. Good routes almost never go from a location to a distant
+one, hence couplers of such transitions can be pruned (see
+:py:func:`tsp.qubo.objective_terms`), which makes QUBO considerably sparser.
+"""
+import numpy as np
+from tsp.classical import solve_auto
+from tsp.utils import calculate_mileage
+
+
+def nearest_neighbours_mask(distance_matrix, neighbours):
+    """Allow transitions between each location and its nearest neighbours.
+
+    :param distance_matrix: distance matrix of the problem.
+    :type distance_matrix: numpy.ndarray
+    :param neighbours: number of nearest neighbours of every location.
+    :type neighbours: int
+    :returns: symmetric boolean matrix, allowed[i, j] is True if j is one of
+     neighbours nearest locations of i or the other way round.
+    :rtype: numpy.ndarray
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype='float64')
+    size = distance_matrix.shape[0]
+    distances = distance_matrix + np.diag(np.full(size, np.inf))
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :min(neighbours, size-1)]
+    allowed = np.zeros((size, size), dtype=bool)
+    allowed[np.arange(size)[:, None], nearest] = True
+    return allowed | allowed.T
+
+
+def quantile_mask(distance_matrix, quantile):
+    """Allow transitions not longer than given quantile of distances between locations.
+
+    :param distance_matrix: distance matrix of the problem.
+    :type distance_matrix: numpy.ndarray
+    :param quantile: quantile of distances between distinct locations, in [0, 1].
+    :type quantile: float
+    :rtype: numpy.ndarray
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype='float64')
+    off_diagonal = ~np.eye(distance_matrix.shape[0], dtype=bool)
+    threshold = np.quantile(distance_matrix[off_diagonal], quantile)
+    return (distance_matrix <= threshold) & off_diagonal
+
+
+def pruning_mask(distance_matrix, neighbours=None, quantile=None):
+    """Compute transitions allowed by given pruning parameters.
+
+    If both neighbours and quantile are given, transitions allowed by either of
+    them are allowed. If none is given, None is returned (i.e. no pruning).
+    """
+    masks = []
+    if neighbours is not None:
+        masks.append(nearest_neighbours_mask(distance_matrix, neighbours))
+    if quantile is not None:
+        masks.append(quantile_mask(distance_matrix, quantile))
+    if not masks:
+        return None
+    return np.logical_or.reduce(masks)
+
+
+def admits_route(allowed):
+    """Check that pruned QUBO admits a feasible route using only allowed transitions.
+
+    The first and the last location are fixed by the encoding and connected to all
+    other locations, hence this is equivalent to existence of Hamiltonian path
+    through remaining locations in the graph of allowed transitions. The check is
+    exact for problems solved exactly by :py:func:`tsp.classical.solve_auto` and
+    conservative for larger ones, i.e. it may reject masks admitting a route.
+
+    :param allowed: boolean matrix of allowed transitions.
+    :type allowed: numpy.ndarray
+    :rtype: bool
+    """
+    allowed = np.asarray(allowed, dtype=bool)
+    inner = allowed.shape[0] - 2
+    if inner <= 1:
+        return True
+    # Path between two virtual ends connected to every location for free, in which
+    # each pruned transition costs 1.
+    cost = np.zeros((inner + 2, inner + 2))
+    cost[1:-1, 1:-1] = ~allowed[1:-1, 1:-1]
+    return bool(calculate_mileage(cost, solve_auto(cost, 0, inner + 1)) == 0)
@@ -1,11 +1,39 @@
-"""Utilities for constructing and solving TSP QUBO."""
-from collections import defaultdict
-from functools import partial
+"""Utilities for constructing and solving TSP QUBO.
 
+QUBO encodes routes of n locations starting in the first and finishing in the last
+location: x(step, location) = 1 if location is visited in given step. The ends are
+fixed by the encoding, i.e. only steps and locations 1..n-2 have variables, hence
+QUBO has (n-2)^2 variables. Problems with other ends (including closed tours)
+are reordered with :py:func:`fixed_ends_order`, so that the chosen ends become
+the first and the last location, and decoded routes are mapped back to original
+locations (see :py:func:`decode_samples`).
+"""
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+from itertools import compress
+import dimod
+import numpy as np
+from tsp.utils import calculate_mileage
 
-def construct_qubo(distance_matrix, dist_mul=1, const_mul=8500):
+
+QUBOArrays = namedtuple('QUBOArrays', ['rows', 'cols', 'biases'])
+QUBOMatrix = namedtuple('QUBOMatrix', ['matrix', 'labels'])
+DecodedSamples = namedtuple(
+    'DecodedSamples', ['routes', 'feasible', 'energies', 'occurrences'])
+RouteCandidate = namedtuple('RouteCandidate', ['route', 'energy', 'mileage', 'occurrences'])
+QUBOTemplate = namedtuple(
+    'QUBOTemplate',
+    ['labels', 'rows', 'cols', 'const_biases', 'diag', 'first', 'last',
+     'obj_rows', 'obj_cols', 'obj_src', 'obj_dst'])
+
+
+def construct_qubo(distance_matrix, dist_mul=1, const_mul=8500, allowed=None):
     """Construct QUBO for TSP problem given distance matrix and model parameters.
 
+    This is a thin adapter over :py:func:`construct_qubo_arrays` kept for
+    backwards compatibility - it returns exactly the same mapping as the
+    original loop-based implementation did.
+
     :param distance_matrix: matrix M such that M[i,j] is a distance between
      i-th and j-th location. It is assumed that this matrix is symmetric and
      contains only nonnegative entries.
@@ -16,46 +44,199 @@ def construct_qubo(distance_matrix, dist_mul=1, const_mul=8500):
     :param const_mul: multiplier for constraints coefficients. Defaults to
      8500 as in original TSP-48 notebook
     :type const_mul: number
+    :param allowed: optional boolean matrix of transitions whose objective
+     couplers are kept, see :py:func:`objective_terms`. By default QUBO is dense.
+    :type allowed: numpy.ndarray
     :returns: mapping (i, j) -> coefficient, where (i, j) are encoded QUBO's
      variables. The returned mapping is always symmetric.
     :rtype: defaultdict(float)
     """
+    rows, cols, biases = construct_qubo_arrays(distance_matrix, dist_mul, const_mul, allowed)
+    qubo = defaultdict(float)
+    qubo.update(zip(zip(rows.tolist(), cols.tolist()), biases.tolist()))
+    return qubo
+
+def construct_qubo_arrays(distance_matrix, dist_mul=1, const_mul=8500, allowed=None):
+    """Construct QUBO for TSP problem in coordinate (COO) format.
+
+    The parameters have the same meaning as in :py:func:`construct_qubo`.
+
+    :returns: namedtuple with "rows", "cols" and "biases" fields, such that
+     biases[k] is the coefficient of the term (rows[k], cols[k]). Indices are
+     encoded QUBO's variables (see :py:func:`map_x_to_qubit`) and every pair
+     of indices occurs exactly once.
+    :rtype: QUBOArrays
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype='float64')
+    template = qubo_template(distance_matrix.shape[0], const_mul)
+    obj_rows, obj_cols, obj_biases = objective_terms(
+        template, distance_matrix, dist_mul, allowed)
+    return QUBOArrays(
+        np.concatenate((template.labels, template.rows, obj_rows)),
+        np.concatenate((template.labels, template.cols, obj_cols)),
+        np.concatenate((
+            _diagonal_biases(template, distance_matrix, dist_mul),
+            template.const_biases,
+            obj_biases)))
+
+def construct_qubo_matrix(distance_matrix, dist_mul=1, const_mul=8500, allowed=None):
+    """Construct QUBO for TSP problem as a dense upper-triangular matrix.
+
+    The parameters have the same meaning as in :py:func:`construct_qubo`.
+
+    :returns: namedtuple with "matrix" and "labels" fields. The matrix Q is
+     upper triangular and such that energy of a sample x equals x^T Q x, where
+     x[k] is the value of the variable labels[k]. Only variables that actually
+     occur in QUBO are included.
+    :rtype: QUBOMatrix
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype='float64')
+    template = qubo_template(distance_matrix.shape[0], const_mul)
+    size = template.labels.shape[0]
     number_of_locations = distance_matrix.shape[0]
+    # Labels are sorted, hence compact indices of i-th and j-th variable preserve order.
+    compact = np.full(number_of_locations ** 2, -1, dtype=np.intp)
+    compact[template.labels] = np.arange(size)
 
-    x = partial(map_x_to_qubit, num_variables=number_of_locations)
-    qubo = defaultdict(float)
+    matrix = np.zeros((size, size))
+    matrix[np.arange(size), np.arange(size)] = _diagonal_biases(
+        template, distance_matrix, dist_mul)
+    # Constraint terms are symmetric - fold both halves into the upper triangle.
+    upper = template.rows < template.cols
+    matrix[compact[template.rows[upper]], compact[template.cols[upper]]] = \
+        2 * template.const_biases[upper]
+    obj_rows, obj_cols, obj_biases = objective_terms(
+        template, distance_matrix, dist_mul, allowed)
+    matrix[compact[obj_rows], compact[obj_cols]] = obj_biases
+    return QUBOMatrix(matrix, template.labels)
 
-    # First: add row constraints. Don't include first row, as it is fixed
-    # as a part of optimized encoding
-    for row in range(1, number_of_locations-1):
-        for i in range(1, number_of_locations-1):
-            qubo[(x(row, i), x(row, i))] += -const_mul
-            for j in range(i+1, number_of_locations-1):
-                qubo[(x(row, i), x(row, j))] += 2 * const_mul
-                qubo[(x(row, j), x(row, i))] += 2 * const_mul
-
-    # Second: add column constraints. Note that we treat i=0 in special way
-    # due to an optimized encoding
-    for col in range(1, number_of_locations-1):
-        for i in range(1, number_of_locations-1):
-            qubo[(x(i, col), x(i, col))] += -const_mul
-            for j in range(i+1, number_of_locations-1):
-                qubo[(x(i, col), x(j, col))] += 2 * const_mul
-                qubo[(x(j, col), x(i, col))] += 2 * const_mul
-
-    # Third: add the objective function
-    for i in range(1, number_of_locations-1):
-        # First and last steps are special as they produce linear terms
-        dist_to_first =  distance_matrix[0, i]
-        dist_to_last =  distance_matrix[-1, i]
-        qubo[x(1, i), x(1, i)] += dist_mul * dist_to_first
-        qubo[(x(number_of_locations-2, i), x(number_of_locations-2, i))] += dist_mul * dist_to_last
-        for j in range(1, number_of_locations-1):
-            if i != j:
-                for step in range(1, number_of_locations-2):
-                    dist = distance_matrix[i, j]
-                    qubo[(x(step, i), x((step+1), j))] += dist_mul * dist
-    return qubo
+def construct_bqm(distance_matrix, dist_mul=1, const_mul=8500, allowed=None):
+    """Construct TSP QUBO as dimod's BinaryQuadraticModel.
+
+    The parameters have the same meaning as in :py:func:`construct_qubo`. Variables
+    of the returned model are labeled in the same way as keys of the mapping returned
+    by :py:func:`construct_qubo`, hence precomputed embeddings can be used with it.
+
+    :rtype: dimod.BinaryQuadraticModel
+    """
+    rows, cols, biases = construct_qubo_arrays(distance_matrix, dist_mul, const_mul, allowed)
+    linear = rows == cols
+    rows, cols, biases = rows.tolist(), cols.tolist(), biases.tolist()
+    # Terms (i, j) and (j, i) are accumulated into single interaction by dimod.
+    return dimod.BinaryQuadraticModel(
+        dict(zip(compress(rows, linear), compress(biases, linear))),
+        dict(zip(
+            zip(compress(rows, ~linear), compress(cols, ~linear)),
+            compress(biases, ~linear))),
+        0.0,
+        dimod.BINARY)
+
+@lru_cache(maxsize=64)
+def qubo_template(number_of_locations, const_mul):
+    """Compute distance-independent part of TSP QUBO.
+
+    Results are cached per (number_of_locations, const_mul), so constructing
+    QUBO for a new distance matrix of already seen size only requires gathering
+    the distance terms. Returned arrays are read-only and shared between calls.
+
+    :param number_of_locations: number of locations in TSP instance.
+    :type number_of_locations: int
+    :param const_mul: multiplier for constraints coefficients.
+    :type const_mul: number
+    :rtype: QUBOTemplate
+    """
+    n = number_of_locations
+    # Only rows (steps) and columns (locations) 1..n-2 are encoded, the first and
+    # the last location are fixed as a part of optimized encoding.
+    inner = np.arange(1, n-1)
+    steps, locations = np.meshgrid(inner, inner, indexing='ij')
+    labels = map_x_to_qubit(steps, locations, n).ravel()
+
+    # Row and column constraints: every ordered pair of distinct variables sharing
+    # step or location gets 2 * const_mul, every variable gets -const_mul twice.
+    first, second = np.meshgrid(inner, inner, indexing='ij')
+    distinct = first != second
+    first, second = first[distinct], second[distinct]
+    same_step = (
+        map_x_to_qubit(inner[:, None], first, n).ravel(),
+        map_x_to_qubit(inner[:, None], second, n).ravel())
+    same_location = (
+        map_x_to_qubit(first, inner[:, None], n).ravel(),
+        map_x_to_qubit(second, inner[:, None], n).ravel())
+    rows = np.concatenate((same_step[0], same_location[0]))
+    cols = np.concatenate((same_step[1], same_location[1]))
+    const_biases = np.full(rows.shape, 2.0 * const_mul)
+    diag = np.full(labels.shape, -2.0 * const_mul)
+
+    # Objective: going from i in given step to j in the next one costs M[i, j].
+    step = np.arange(1, n-2)[:, None]
+    obj_rows = map_x_to_qubit(step, first, n).ravel()
+    obj_cols = map_x_to_qubit(step + 1, second, n).ravel()
+    obj_src = np.broadcast_to(first, (step.shape[0], first.shape[0])).ravel()
+    obj_dst = np.broadcast_to(second, (step.shape[0], second.shape[0])).ravel()
+
+    template = QUBOTemplate(
+        labels, rows, cols, const_biases, diag,
+        # Positions in labels corresponding to the first and the last step.
+        np.arange(0, n-2), np.arange((n-3) * (n-2), (n-2) ** 2),
+        obj_rows, obj_cols, obj_src, obj_dst)
+    for array in template:
+        array.flags.writeable = False
+    return template
+
+def qubo_interactions(number_of_locations):
+    """Return interactions of TSP QUBO for given number of locations.
+
+    The sparsity pattern of QUBO doesn't depend on distances, hence this is all
+    that is needed for embedding QUBOs of given size into hardware graph.
+
+    :returns: sorted list of pairs (i, j), i < j, of interacting variables.
+    :rtype: list of pairs of ints
+    """
+    template = qubo_template(number_of_locations, 1)
+    rows = np.concatenate((template.rows, template.obj_rows))
+    cols = np.concatenate((template.cols, template.obj_cols))
+    pairs = np.unique(np.sort(np.column_stack((rows, cols)), axis=1), axis=0)
+    return [(int(first), int(second)) for first, second in pairs]
+
+def objective_terms(template, distance_matrix, dist_mul, allowed=None):
+    """Compute couplers of QUBO's target function.
+
+    If allowed is given, only couplers of transitions i -> j such that allowed[i, j]
+    is True are kept. Missing coupler makes transition free, hence biases of kept
+    couplers are shifted by the longest kept distance, so that pruned transitions
+    cost as much as the longest allowed one. The shift changes energy of every
+    feasible route using only allowed transitions by the same constant, namely
+    -dist_mul * shift * (number_of_locations - 3), so their order is unchanged.
+    Transitions from the first and to the last location are linear terms and are
+    never pruned.
+
+    :returns: triple (rows, cols, biases) of arrays.
+    """
+    biases = distance_matrix[template.obj_src, template.obj_dst]
+    if allowed is None:
+        return template.obj_rows, template.obj_cols, dist_mul * biases
+    kept = np.asarray(allowed, dtype=bool)[template.obj_src, template.obj_dst]
+    shift = biases[kept].max() if kept.any() else 0.0
+    return template.obj_rows[kept], template.obj_cols[kept], dist_mul * (biases[kept] - shift)
+
+def coupler_count(number_of_locations, allowed=None):
+    """Return number of quadratic terms of TSP QUBO, possibly with pruned target function."""
+    template = qubo_template(number_of_locations, 1)
+    # Constraint terms are stored in both orders, objective terms don't overlap them.
+    constraints = template.rows.shape[0] // 2
+    if allowed is None:
+        return constraints + template.obj_rows.shape[0]
+    return constraints + int(
+        np.count_nonzero(np.asarray(allowed, dtype=bool)[template.obj_src, template.obj_dst]))
+
+def _diagonal_biases(template, distance_matrix, dist_mul):
+    """Compute linear terms of QUBO, i.e. constraints plus first and last step."""
+    inner = slice(1, distance_matrix.shape[0]-1)
+    diag = template.diag.copy()
+    diag[template.first] += dist_mul * distance_matrix[0, inner]
+    diag[template.last] += dist_mul * distance_matrix[-1, inner]
+    return diag
 
 def map_x_to_qubit(i, j, num_variables):
     """Map indices of x{i, j} variable to corresponding qubit number."""
@@ -84,21 +265,168 @@ def route_from_sample(sample, number_of_locations, start=None, end=None):
        not well defined.
     """
     number_of_nodes = number_of_locations
+    start, end = default_ends(number_of_nodes, start, end)
 
     route = [-1 for _ in range(number_of_nodes)]
     route[0] = start
     route[-1] = end
-    print(sample)
     for qubit in sample:
         if sample[qubit] > 0:
             # Note that mapping takes into account number of nodes, not locations
             step, location = map_qubit_to_x(qubit, number_of_nodes)
             route[step] = location
-    print(route)
-    print(adjust_ends_acyclic(route, start, end))
 
     return adjust_ends_acyclic(route, start, end)
 
+def decode_samples(sampleset, number_of_locations, start=None, end=None, order=None):
+    """Read routes corresponding to all samples in the sample set at once.
+
+    :param sampleset: samples obtained from the solver.
+    :type sampleset: dimod.SampleSet
+    :param number_of_locations: number of locations provided as the input for the problem.
+    :type number_of_locations: int
+    :param start: node that should appear first in routes.
+    :type start: int
+    :param end: node that should appear last in routes.
+    :type end: int
+    :param order: order of locations QUBO was constructed with, see
+     :py:func:`fixed_ends_order`. If given, samples are decoded as routes of the
+     reordered problem and mapped back to original locations, while number_of_locations,
+     start and end are ignored.
+    :type order: numpy.ndarray
+    :returns: namedtuple with fields:
+     - routes: array of shape (number of samples, number of locations), routes[k, i]
+       is the location visited in i-th step according to k-th sample, or -1 if the
+       sample does not assign exactly one location to this step or assigns this
+       location to other steps as well.
+     - feasible: boolean mask of samples satisfying all constraints.
+     - energies: energies of samples.
+     - occurrences: number of occurrences of samples.
+     Ends of feasible routes are not adjusted, see :py:func:`best_routes`.
+    :rtype: DecodedSamples
+    """
+    if order is not None:
+        decoded = decode_samples(sampleset, order.shape[0])
+        routes = decoded.routes
+        return decoded._replace(routes=np.where(routes >= 0, order[routes], -1))
+    n = number_of_locations
+    start, end = default_ends(n, start, end)
+    record = sampleset.record
+    samples = np.asarray(record.sample)
+    steps, locations = map_qubit_to_x(np.fromiter(sampleset.variables, dtype=np.intp), n)
+
+    grid = np.zeros((samples.shape[0], n, n), dtype=np.int8)
+    grid[:, steps, locations] = samples > 0
+    inner = grid[:, 1:-1, 1:-1]
+    step_counts = inner.sum(axis=2)
+    location_counts = inner.sum(axis=1)
+
+    routes = np.empty((samples.shape[0], n), dtype=np.intp)
+    routes[:, 0] = start
+    routes[:, -1] = end
+    # Routes of at most two locations have no encoded steps (and the QUBO no variables).
+    chosen = inner.argmax(axis=2) if n > 2 else np.zeros(step_counts.shape, dtype=np.intp)
+    # Steps with no or many locations, and steps sharing location with another step
+    # are marked as broken, hence every infeasible route contains -1.
+    unique = (step_counts == 1) & (np.take_along_axis(location_counts, chosen, axis=1) == 1)
+    routes[:, 1:-1] = np.where(unique, chosen + 1, -1)
+    feasible = (step_counts == 1).all(axis=1) & (location_counts == 1).all(axis=1)
+    return DecodedSamples(
+        routes, feasible, np.asarray(record.energy), np.asarray(record.num_occurrences))
+
+def best_routes(decoded, distance_matrix, k=1, start=None, end=None):
+    """Select k distinct feasible routes of lowest energy from decoded samples.
+
+    :param decoded: samples decoded with :py:func:`decode_samples`.
+    :type decoded: DecodedSamples
+    :param distance_matrix: distance matrix used for computing mileage of routes.
+    :type distance_matrix: numpy.ndarray
+    :param k: maximum number of routes to return.
+    :type k: int
+    :param start: node that should appear first in routes.
+    :type start: int
+    :param end: node that should appear last in routes.
+    :type end: int
+    :returns: at most k namedtuples with "route", "energy", "mileage" and "occurrences"
+     fields, sorted by energy. Occurrences are summed over all samples decoding to
+     the same route and energy is the lowest one among them.
+    :rtype: list of RouteCandidate
+    """
+    routes = decoded.routes[decoded.feasible]
+    if routes.shape[0] == 0:
+        return []
+    start, end = default_ends(routes.shape[1], start, end)
+    unique, inverse = np.unique(routes, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    energies = np.full(unique.shape[0], np.inf)
+    np.minimum.at(energies, inverse, decoded.energies[decoded.feasible])
+    occurrences = np.bincount(
+        inverse, weights=decoded.occurrences[decoded.feasible], minlength=unique.shape[0])
+    mileages = np.asarray(distance_matrix)[unique[:, :-1], unique[:, 1:]].sum(axis=1)
+
+    order = np.lexsort((mileages, energies))[:k]
+    return [
+        RouteCandidate(
+            adjust_ends_acyclic(unique[index].tolist(), start, end),
+            float(energies[index]),
+            float(mileages[index]),
+            int(occurrences[index]))
+        for index in order]
+
+def default_ends(number_of_locations, start, end):
+    """Return ends of the route, defaulting to the ones fixed by the encoding."""
+    return (0 if start is None else start,
+            number_of_locations - 1 if end is None else end)
+
+def fixed_ends_order(number_of_locations, start=None, end=None):
+    """Order locations so that the encoding fixes the chosen ends of the route.
+
+    Chosen start becomes the first and chosen end the last location, remaining
+    locations keep their relative order. Closed tours (start equal to end) are
+    encoded as paths from start to its copy, hence start occurs in the order twice.
+    For the default ends (0 and n-1) the order is the identity.
+
+    :param number_of_locations: number of locations of the problem.
+    :type number_of_locations: int
+    :param start: node that should appear first in the route. Defaults to 0.
+    :type start: int
+    :param end: node that should appear last in the route. Defaults to the last one.
+    :type end: int
+    :returns: array order such that QUBO constructed from
+     distance_matrix[np.ix_(order, order)] encodes routes with given ends, k-th
+     location of the reordered problem being order[k].
+    :rtype: numpy.ndarray
+    """
+    start, end = default_ends(number_of_locations, start, end)
+    inner = [node for node in range(number_of_locations) if node not in (start, end)]
+    return np.array([start] + inner + [end], dtype=np.intp)
+
+def qubo_size(number_of_locations, start=None, end=None):
+    """Return number of locations of QUBO encoding routes with given ends.
+
+    This is the size of the embedding needed to solve the problem on D-Wave, i.e.
+    number_of_locations for paths and number_of_locations + 1 for closed tours.
+    """
+    return fixed_ends_order(number_of_locations, start, end).shape[0]
+
+
+def route_energy(distance_matrix, route, dist_mul=1, const_mul=8500):
+    """Compute energy that QUBO assigns to the sample encoding given feasible route.
+
+    Every encoded step and location contributes -const_mul, and the target function
+    contributes dist_mul times length of the route. All steps except the ends are
+    encoded, hence this holds for closed tours encoded with :py:func:`fixed_ends_order`
+    as well.
+
+    :param distance_matrix: the (normalized) distance matrix QUBO is constructed from.
+    :type distance_matrix: numpy.ndarray
+    :param route: feasible route.
+    :type route: sequence of ints
+    :rtype: float
+    """
+    return float(
+        dist_mul * calculate_mileage(distance_matrix, route) -
+        2 * const_mul * max(len(route) - 2, 0))
 
 def adjust_ends_cyclic(route, start):
     """Adjust ending points in route, assuming the passed route should be cyclic.
@@ -0,0 +1,337 @@
+"""Lazy registry of D-Wave solvers with precomputed embeddings.
+
+Nothing is loaded or constructed when this module is imported. The QPU sampler is
+constructed on first use (and construction failures are logged and retried later),
+embeddings are loaded on first use of the given problem size, and embeddings
+of sizes that don't have one are computed in the background and stored on disk.
+
+Embeddings are stored as JSON documents ``embedding_<size>.json``::
+
+    {"format_version": 1, "size": 5, "metrics": {...}, "embedding": {"6": [819, 823], ...}}
+
+Legacy pickled ``embedding_<size>.npy`` files are still understood. Embeddings of all
+sizes can also be packed into a single store (see :py:class:`EmbeddingStore`), which
+is memory-mapped, so that its pages are shared by all gunicorn workers::
+
+    python -m tsp.registry embeddings embeddings/store.npy
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+from tsp.qubo import qubo_interactions
+
+
+LOGGER_NAME = 'tsp.registry'
+EMBEDDING_FORMAT_VERSION = 1
+
+
+def embedding_path(directory, size, extension='json'):
+    """Return path of the file with embedding of given size."""
+    return os.path.join(directory, 'embedding_' + str(size) + '.' + extension)
+
+
+def stored_sizes(directory):
+    """Return sorted sizes for which directory contains embedding files."""
+    sizes = set()
+    for name in os.listdir(directory):
+        stem, _ = os.path.splitext(name)
+        if stem.startswith('embedding_') and stem[len('embedding_'):].isdigit():
+            sizes.add(int(stem[len('embedding_'):]))
+    return sorted(sizes)
+
+
+def read_embedding(directory, size):
+    """Read embedding of given size from directory, or return None if there is none.
+
+    :returns: mapping variable -> list of qubits.
+    :rtype: dict
+    """
+    path = embedding_path(directory, size)
+    if os.path.exists(path):
+        with open(path) as document:
+            data = json.load(document)
+        if data.get('format_version') != EMBEDDING_FORMAT_VERSION:
+            raise ValueError('Unsupported embedding format in {}.'.format(path))
+        return {int(node): [int(qubit) for qubit in chain]
+                for node, chain in data['embedding'].items()}
+    path = embedding_path(directory, size, 'npy')
+    if os.path.exists(path):
+        # Legacy format: pickled dictionary of chains stored as floats.
+        embedding = np.load(path, allow_pickle=True).item()
+        return {int(node): [int(qubit) for qubit in chain]
+                for node, chain in embedding.items()}
+    return None
+
+
+def write_embedding(path, size, embedding, metrics=None):
+    """Atomically write embedding of given size as JSON document.
+
+    :param path: path of the written file.
+    :type path: str
+    :param size: number of locations of TSP problems the embedding is for.
+    :type size: int
+    :param embedding: mapping variable -> sequence of qubits.
+    :type embedding: Mapping
+    :param metrics: quality metrics of the embedding, e.g. number of qubits or
+     lengths of chains. Computed if not given.
+    :type metrics: dict
+    """
+    document = {
+        'format_version': EMBEDDING_FORMAT_VERSION,
+        'size': size,
+        'metrics': metrics if metrics is not None else embedding_metrics(embedding),
+        'created': time.time(),
+        'embedding': {str(node): [int(qubit) for qubit in chain]
+                      for node, chain in sorted(embedding.items())}
+    }
+    temporary = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temporary, 'w') as output:
+        json.dump(document, output)
+    os.replace(temporary, path)
+
+
+def embedding_metrics(embedding):
+    """Compute number of used qubits and maximum and mean length of chains."""
+    lengths = [len(chain) for chain in embedding.values()]
+    qubits = set(qubit for chain in embedding.values() for qubit in chain)
+    return {
+        'qubits': len(qubits),
+        'max_chain': max(lengths) if lengths else 0,
+        'mean_chain': float(np.mean(lengths)) if lengths else 0.0
+    }
+
+
+def dwave_sampler(token, endpoint):
+    """Construct D-Wave QPU sampler."""
+    from dwave.system.samplers import DWaveSampler
+    return DWaveSampler(token=token, endpoint=endpoint)
+
+
+def dwave_composite(sampler, embedding=None):
+    """Wrap QPU sampler with given embedding or, if it is None, one found on every call."""
+    if embedding is None:
+        from dwave.system.composites import EmbeddingComposite
+        return EmbeddingComposite(sampler)
+    from dwave.system.composites import FixedEmbeddingComposite
+    return FixedEmbeddingComposite(sampler, embedding=embedding)
+
+
+class EmbeddingStore(object):
+    """Embeddings of many sizes packed into a single memory-mapped array.
+
+    Each row of the array is a triple (size, variable, qubit), rows are sorted by
+    size and variable, so embedding of given size is a contiguous slice.
+
+    :param path: path of the .npy file created by :py:meth:`build`.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = np.load(path, mmap_mode='r')
+
+    def sizes(self):
+        """Return sizes for which the store contains embeddings."""
+        return np.unique(self.rows[:, 0]).tolist()
+
+    def get(self, size):
+        """Return embedding of given size or None if there is none."""
+        first, last = np.searchsorted(self.rows[:, 0], [size, size + 1])
+        if first == last:
+            return None
+        embedding = {}
+        for node, qubit in np.asarray(self.rows[first:last, 1:]).tolist():
+            embedding.setdefault(node, []).append(qubit)
+        return embedding
+
+    @staticmethod
+    def build(embeddings, path):
+        """Pack embeddings, given as mapping size -> embedding, into store at path."""
+        rows = [(size, node, qubit)
+                for size, embedding in sorted(embeddings.items())
+                for node, chain in sorted(embedding.items())
+                for qubit in chain]
+        np.save(path, np.array(rows, dtype=np.int32).reshape(-1, 3))
+
+
+class SolverRegistry(object):
+    """Registry of D-Wave solvers, constructed lazily for each problem size.
+
+    :param token: D-Wave API token.
+    :type token: str
+    :param endpoint: D-Wave API endpoint.
+    :type endpoint: str
+    :param embeddings_dir: directory with embeddings, where computed embeddings are
+     stored as well.
+    :type embeddings_dir: str
+    :param store_path: optional path of :py:class:`EmbeddingStore`, which is consulted
+     before embeddings_dir.
+    :type store_path: str
+    :param compute_missing: whether to compute missing embeddings in the background.
+    :type compute_missing: bool
+    :param retry_interval: number of seconds after which failed construction of the
+     sampler is retried.
+    :type retry_interval: number
+    :param embedding_timeout: timeout of minorminer's search for missing embeddings.
+    :type embedding_timeout: number
+    :param sampler_factory: function constructing QPU sampler from token and endpoint,
+     defaults to :py:func:`dwave_sampler`.
+    :type sampler_factory: callable
+    :param composite_factory: function wrapping QPU sampler with embedding (or None),
+     defaults to :py:func:`dwave_composite`.
+    :type composite_factory: callable
+    """
+
+    def __init__(self, token, endpoint, embeddings_dir='embeddings', store_path=None,
+                 compute_missing=True, retry_interval=60, embedding_timeout=300,
+                 sampler_factory=dwave_sampler, composite_factory=dwave_composite):
+        self.token = token
+        self.endpoint = endpoint
+        self.embeddings_dir = embeddings_dir
+        self.store_path = store_path
+        self.compute_missing = compute_missing
+        self.retry_interval = retry_interval
+        self.embedding_timeout = embedding_timeout
+        self.sampler_factory = sampler_factory
+        self.composite_factory = composite_factory
+        self._store = None
+        self._sampler = None
+        self._sampler_failed_at = None
+        self._backup_solver = None
+        self._embeddings = {}
+        self._solvers = {}
+        self._computing = set()
+        self._lock = threading.RLock()
+
+    @property
+    def store(self):
+        """Memory-mapped embedding store, or None if it is not configured or missing."""
+        with self._lock:
+            if self._store is None and self.store_path and os.path.exists(self.store_path):
+                self._store = EmbeddingStore(self.store_path)
+            return self._store
+
+    def preload(self):
+        """Load store and all embeddings stored on disk, e.g. in gunicorn's master process."""
+        store = self.store
+        sizes = set(store.sizes() if store is not None else [])
+        for size in sizes.union(stored_sizes(self.embeddings_dir)):
+            self.embedding(size)
+
+    def sampler(self):
+        """Return QPU sampler, constructing it if needed.
+
+        :returns: the sampler or None if it can't be constructed at the moment.
+        """
+        with self._lock:
+            if self._sampler is not None:
+                return self._sampler
+            if (self._sampler_failed_at is not None and
+                    time.monotonic() - self._sampler_failed_at < self.retry_interval):
+                return None
+            try:
+                self._sampler = self.sampler_factory(self.token, self.endpoint)
+            except Exception as error:
+                logging.getLogger(LOGGER_NAME).warning(
+                    'Unable to construct D-Wave sampler: %s', error)
+                self._sampler_failed_at = time.monotonic()
+            return self._sampler
+
+    def embedding(self, size):
+        """Return embedding for problems of given size, or None if it is not known."""
+        with self._lock:
+            if size not in self._embeddings:
+                embedding = self.store.get(size) if self.store is not None else None
+                if embedding is None:
+                    embedding = read_embedding(self.embeddings_dir, size)
+                if embedding is None:
+                    return None
+                self._embeddings[size] = embedding
+            return self._embeddings[size]
+
+    def get(self, size):
+        """Return solver for problems of given size.
+
+        If there is no embedding for this size, a solver finding embedding on every
+        call is returned and, if enabled, the embedding is computed in the background.
+
+        :returns: the solver or None if QPU sampler is unavailable.
+        """
+        with self._lock:
+            if size in self._solvers:
+                return self._solvers[size]
+        sampler = self.sampler()
+        if sampler is None:
+            return None
+        embedding = self.embedding(size)
+        if embedding is None:
+            if self.compute_missing:
+                self._compute_embedding(size, sampler)
+            return self._get_backup_solver(sampler)
+        try:
+            solver = self.composite_factory(sampler, embedding)
+        except Exception as error:
+            logging.getLogger(LOGGER_NAME).warning(
+                'Unable to use embedding of size %s: %s', size, error)
+            return self._get_backup_solver(sampler)
+        with self._lock:
+            self._solvers[size] = solver
+        return solver
+
+    def _get_backup_solver(self, sampler):
+        with self._lock:
+            if self._backup_solver is None:
+                self._backup_solver = self.composite_factory(sampler, None)
+            return self._backup_solver
+
+    def _compute_embedding(self, size, sampler):
+        with self._lock:
+            if size in self._computing:
+                return
+            self._computing.add(size)
+        thread = threading.Thread(
+            target=self._find_embedding, args=(size, sampler), name='embedding-' + str(size))
+        thread.daemon = True
+        thread.start()
+
+    def _find_embedding(self, size, sampler):
+        logger = logging.getLogger(LOGGER_NAME)
+        try:
+            from minorminer import find_embedding
+            embedding = find_embedding(
+                qubo_interactions(size), sampler.edgelist, timeout=self.embedding_timeout)
+            if not embedding:
+                logger.warning('No embedding found for size %s.', size)
+                return
+            embedding = {int(node): [int(qubit) for qubit in chain]
+                         for node, chain in embedding.items()}
+            with self._lock:
+                self._embeddings[size] = embedding
+            try:
+                write_embedding(embedding_path(self.embeddings_dir, size), size, embedding)
+            except OSError as error:
+                logger.warning('Unable to store embedding of size %s: %s', size, error)
+        except Exception:
+            logger.exception('Computing embedding of size %s failed.', size)
+        finally:
+            with self._lock:
+                self._computing.discard(size)
+
+
+def main(argv=None):
+    """Pack embeddings stored in a directory into :py:class:`EmbeddingStore`."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('embeddings_dir')
+    parser.add_argument('output')
+    args = parser.parse_args(argv)
+    EmbeddingStore.build({
+        size: read_embedding(args.embeddings_dir, size)
+        for size in stored_sizes(args.embeddings_dir)}, args.output)
+
+
+if __name__ == '__main__':
+    main()
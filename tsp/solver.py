@@ -1,13 +1,46 @@
 """Module containing functions for solving TSP using D-Wave's Qbsolv."""
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import threading
+import time
 from dwave_qbsolv import QBSolv
 import numpy as np
-from tsp.qubo import construct_qubo, route_from_sample
+from tsp.annealing import AnnealingSampler
+from tsp.calibration import AUTO, calibrate, chain_strength as uniform_torque, resolve_const_mul
+from tsp.classical import CLASSICAL_BACKENDS, repair_route
+from tsp.deadline import Stage, call_with_timeout, solve_anytime
+from tsp.decompose import DEFAULT_CLUSTER_SIZE, solve_decomposed
+from tsp.metrics import span
+from tsp.pruning import admits_route, pruning_mask
+from tsp.qubo import (
+    adjust_ends_acyclic, best_routes, construct_bqm, coupler_count, decode_samples,
+    default_ends, fixed_ends_order, qubo_size, route_energy)
 from tsp.utils import create_distance_matrix, calculate_mileage
 
 
 TSPSolution = namedtuple('TSPSolution', ['route', 'energy', 'mileage', 'info'])
+BatchResult = namedtuple('BatchResult', ['solution', 'error', 'time'])
 DWAVE_ENDPOINT = 'https://cloud.dwavesys.com/sapi'
+REPAIR_CANDIDATES = 5
+REPAIR_ITERATIONS = 100
+LOGGER_NAME = 'tsp.solver'
+QUBO_BACKENDS = ('qbsolv', 'anneal')
+# Least number of seconds for which stages of the deadline chain are run, QBSolv's
+# timeout is a whole number of seconds.
+STAGE_MIN_SECONDS = {'dwave': 1.0, 'qbsolv': 1.0, 'anneal': 0.02}
+# Fraction of stage's budget given to local sampler, the rest is left for decoding.
+SAMPLER_TIME_SHARE = 0.8
+# Batch workers are started by a fork server instead of forking the caller, which
+# (in the web service) runs threads whose locks would be copied while held.
+BATCH_START_METHOD = (
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+_BATCH_POOLS = {}
+_BATCH_POOLS_LOCK = threading.Lock()
 
 def sample_from_locations(locations, dist_mul=1, const_mul=8500, **kwargs):
     """Sample TSP qubo from given locations and return lowet-energy solution.
@@ -18,7 +51,8 @@ def sample_from_locations(locations, dist_mul=1, const_mul=8500, **kwargs):
      default is 1 as in original TSP 48 notebook.
     :type dist_mul: number
     :param const_mul: constant by which constraints are multiplied in QUBO.
-     Defaults to 8500 as in original TSP 48 notebook.
+     Defaults to 8500 as in original TSP 48 notebook. If "auto", it is calibrated
+     for the problem, see :py:mod:`tsp.calibration`.
     param kwargs: additional keyword arguments to pass to sample_qubo call.
     :returns: namedtuple with "route", "energy" and "mileage" fields where:
      - route is a sequence of indices of consecutively visited locations.
@@ -30,19 +64,107 @@ def sample_from_locations(locations, dist_mul=1, const_mul=8500, **kwargs):
     dist_matrix = create_distance_matrix(locations)
     return sample_from_distance_matrix(dist_matrix, dist_mul, const_mul, **kwargs)
 
-def sample_from_distance_matrix(dist_matrix, dist_mul=1, const_mul=8500, start=None, end=None, **kwargs):
+def sample_from_distance_matrix(dist_matrix, dist_mul=1, const_mul=8500, start=None, end=None,
+                                top_k=None, backend='qbsolv', repair=True, decompose=False,
+                                max_cluster_size=DEFAULT_CLUSTER_SIZE, max_workers=None,
+                                prune_neighbours=None, prune_quantile=None,
+                                chain_strength=None, refine_penalty=False, fix_ends=True,
+                                time_limit_ms=None, **kwargs):
     """Sample TSP qubo from given distance matrix and return lowest-energy sdolution.
 
     This is basically the same as :py:func:`sample_from_locations` except it skips
     calculation of distance matrix (which is instead given as parameter) and can
     take into account starting and ending node.
+
+    If fix_ends is True (default), chosen start and end (or just start, for closed
+    tours) are fixed by the encoding, i.e. QUBO is constructed for the problem
+    reordered with :py:func:`tsp.qubo.fixed_ends_order` and has no variables for
+    them. Otherwise QUBO always fixes the first and the last location and routes
+    are rotated to the chosen ends afterwards, which is correct only for the
+    default ends.
+
+    All samples returned by the solver are decoded and the feasible one with lowest
+    energy is returned. Fraction of feasible samples is stored in info under
+    "feasible_fraction" key. If top_k is given, up to top_k distinct feasible routes
+    with their energies, mileages and occurrences are stored in info under "routes" key.
+
+    The backend parameter selects how the problem is solved locally (i.e. if D-Wave
+    is not used or fails): "qbsolv" (default) samples QUBO with QBSolv, "anneal" with
+    :py:class:`tsp.annealing.AnnealingSampler` (taking as many reads as D-Wave
+    would, unless num_reads is given), while "exact", "heuristic" and "auto" use
+    native classical algorithms, see :py:func:`solve_classically`. Remaining keyword
+    arguments are passed to the sampler.
+
+    If none of the samples is feasible and repair is True, REPAIR_CANDIDATES samples
+    of lowest energy are repaired (see :py:func:`tsp.classical.repair_route`) and the
+    shortest of the results is returned. Info's "route_status" key is "raw" if the
+    route was read directly from a sample, "repaired" if it was repaired and "broken"
+    if it still contains -1.
+
+    If decompose is True and the problem has more than max_cluster_size locations,
+    it is split into clusters solved as independent sub-problems (see
+    :py:mod:`tsp.decompose`). Locally solved sub-problems are solved in parallel by
+    max_workers processes (see :py:func:`sample_batch`), while D-Wave solves them one
+    by one, using solver returned by "solvers" keyword argument - a function mapping
+    size of sub-problem to D-Wave solver. Sizes of clusters are stored in info under
+    "decomposition" key and top_k is ignored.
+
+    If prune_neighbours or prune_quantile is given, objective couplers of QUBO are
+    kept only for transitions to that many nearest neighbours or not longer than
+    that quantile of distances (see :py:mod:`tsp.pruning`). If the pruned QUBO
+    doesn't admit a feasible route, dense QUBO is used instead. Numbers of couplers
+    of pruned and dense QUBO are stored in info under "pruning" key.
+
+    If const_mul is "auto", it is calibrated from the normalized distance matrix
+    and, if refine_penalty is True, increased until a cheap annealing pre-sample is
+    feasible often enough (see :py:func:`tsp.calibration.calibrate`). Chain strength
+    of D-Wave solver is chain_strength if given, otherwise uniform torque
+    compensation if const_mul is calibrated and 2 * const_mul if it is not.
+    Calibrated values are stored in info under "calibration" key.
+
+    If time_limit_ms is given, the problem is solved by a chain of stages run under
+    a deadline that many milliseconds away (see :py:mod:`tsp.deadline`): D-Wave
+    (if use_dwave is True), then backend, then "heuristic". Stages which can't
+    finish in time are skipped (see STAGE_MIN_SECONDS), D-Wave calls are abandoned
+    at the deadline and local samplers get a time limit ("time_limit" of "anneal",
+    "timeout" of "qbsolv", split between sub-problems if decomposed). The first
+    feasible route is returned, and the stage which produced it, together with time
+    spent in every stage, is stored in info under "deadline" key.
+
+    If backend is None, only D-Wave is used and its errors are raised.
     """
-    dist_matrix = np.array(dist_matrix)
-    number_of_locations = dist_matrix.shape[0]
-    max_distance = np.max(dist_matrix)
-    dist_matrix = dist_matrix / max_distance
+    if time_limit_ms is not None:
+        options = dict(
+            kwargs, start=start, end=end, top_k=top_k, repair=repair, decompose=decompose,
+            max_cluster_size=max_cluster_size, max_workers=max_workers,
+            prune_neighbours=prune_neighbours, prune_quantile=prune_quantile,
+            chain_strength=chain_strength, refine_penalty=refine_penalty, fix_ends=fix_ends)
+        return _sample_with_deadline(
+            dist_matrix, dist_mul, const_mul, backend, time_limit_ms, options)
+    if backend is None and not kwargs.get('use_dwave', False):
+        raise ValueError('Backend is required unless D-Wave is used.')
+    if backend is not None and backend not in QUBO_BACKENDS and backend not in CLASSICAL_BACKENDS:
+        raise ValueError('Unknown backend: {}.'.format(backend))
+    if decompose and qubo_size(np.shape(dist_matrix)[0], start, end) > max_cluster_size:
+        kwargs.update(prune_neighbours=prune_neighbours, prune_quantile=prune_quantile)
+        return _sample_decomposed(
+            dist_matrix, dist_mul, const_mul, start, end, backend, repair,
+            max_cluster_size, max_workers, kwargs)
+    kwargs.pop('solvers', None)
+    logger = logging.getLogger(LOGGER_NAME)
+    with span('normalize'):
+        dist_matrix = np.array(dist_matrix)
+        number_of_locations = dist_matrix.shape[0]
+        max_distance = np.max(dist_matrix)
+        dist_matrix = dist_matrix / max_distance
+        order = fixed_ends_order(number_of_locations, start, end) if fix_ends else None
+        encoded = dist_matrix if order is None else dist_matrix[np.ix_(order, order)]
+    calibration = None
+    if const_mul == AUTO:
+        with span('calibrate'):
+            calibration = calibrate(encoded, dist_mul, refine_penalty, kwargs.get('seed'))
+        const_mul = calibration['const_mul']
 
-    qubo = construct_qubo(dist_matrix, dist_mul, const_mul)
     use_dwave = kwargs.get('use_dwave', False)
     token = kwargs.get('dwave_token', None)
     solver = kwargs.get('solver', None)
@@ -50,34 +172,360 @@ def sample_from_distance_matrix(dist_matrix, dist_mul=1, const_mul=8500, start=N
     if 'use_dwave' in kwargs:
         del kwargs['use_dwave']
         del kwargs['dwave_token']
-    import gc
 
+    result = None
+    pruning = None
+    if use_dwave or backend in QUBO_BACKENDS:
+        with span('qubo'):
+            allowed = pruning_mask(encoded, prune_neighbours, prune_quantile)
+            if allowed is not None:
+                pruning = {
+                    'applied': admits_route(allowed),
+                    'couplers': coupler_count(encoded.shape[0], allowed),
+                    'dense_couplers': coupler_count(encoded.shape[0])}
+                if not pruning['applied']:
+                    allowed = None
+            bqm = construct_bqm(encoded, dist_mul, const_mul, allowed)
     if use_dwave:
         try:
-            num_reads = 1000
-            if number_of_locations > 7:
-                num_reads = 2000
-            print("Start solving using D-Wave!")
+            num_reads = dwave_num_reads(number_of_locations)
+            logger.debug('Start solving using D-Wave.')
             # solver = EmbeddingComposite(DWaveSampler(token=token, endpoint=DWAVE_ENDPOINT))
-            result = solver.sample_qubo(qubo, num_reads=num_reads, chain_strength=const_mul*2)
+            if chain_strength is None:
+                chain_strength = uniform_torque(bqm) if calibration else const_mul*2
+            with span('embed_solve'):
+                result = solver.sample(bqm, num_reads=num_reads, chain_strength=chain_strength)
             info = {"total_time": result.info['timing']['total_real_time']/10e3,
-                "machine": "DWAVE 2000Q"}
+                "machine": "DWAVE 2000Q", "backend": "dwave",
+                "chain_strength": chain_strength}
         except Exception as e:
-            print(e)
-            print("D-Wave failed, switched to QBSolv!")
-            result = QBSolv().sample_qubo(qubo, **kwargs)
-            info = {"machine": "local"}
+            if backend is None:
+                raise
+            logger.warning('D-Wave failed, switched to local backend: %s', e)
+            result = None
+    if result is None and backend not in QUBO_BACKENDS:
+        solution = solve_classically(
+            dist_matrix * max_distance, backend, start, end, dist_mul, const_mul)
+        if calibration is not None:
+            solution.info['calibration'] = calibration
+        return solution
+    if result is None and backend == 'anneal':
+        logger.debug('Start solving using simulated annealing.')
+        kwargs.pop('solver', None)
+        kwargs.setdefault('num_reads', dwave_num_reads(number_of_locations))
+        with span('solve'):
+            result = AnnealingSampler().sample(bqm, **kwargs)
+        info = {"machine": "local", "backend": "anneal"}
+    elif result is None:
+        logger.debug('Start solving using QBSolv.')
+        with span('solve'):
+            result = QBSolv().sample(bqm, **kwargs)
+        info = {"machine": "local", "backend": "qbsolv"}
+    with span('decode'):
+        decoded = decode_samples(result, number_of_locations, start, end, order)
+        # Ends are resolved here, as routes of a single location are closed tours.
+        candidates = best_routes(
+            decoded, dist_matrix * max_distance, top_k or 1,
+            *default_ends(number_of_locations, start, end))
+    if candidates and pruning is not None and pruning['applied']:
+        # Energies of pruned QUBO are shifted, report the ones of dense QUBO.
+        candidates = [
+            candidate._replace(energy=route_energy(
+                dist_matrix, candidate.route, dist_mul, const_mul))
+            for candidate in candidates]
+    if candidates:
+        route, energy = candidates[0].route, candidates[0].energy
+        info['route_status'] = 'raw'
     else:
-        print("Start solving using QBSolv")
-        result = QBSolv().sample_qubo(qubo, **kwargs)
-        info = {"machine": "local"}
-    print("Got answer!")
-    route = route_from_sample(next(iter(result.samples())), number_of_locations, start, end)
+        with span('repair'):
+            route, energy = _repair_lowest(
+                decoded, dist_matrix, start, end, dist_mul, const_mul, repair)
+        info['route_status'] = 'broken' if -1 in route else 'repaired'
     mileage = calculate_mileage(dist_matrix * max_distance, route)
     info['mileage'] = mileage
-    print("Problem solved!")
-    energy = result.data_vectors['energy'][0]
-    del solver
-    del result
-    gc.collect()
+    info['feasible_fraction'] = float(
+        np.sum(decoded.occurrences[decoded.feasible]) / np.sum(decoded.occurrences))
+    if top_k:
+        info['routes'] = [candidate._asdict() for candidate in candidates]
+    if pruning is not None:
+        info['pruning'] = pruning
+    if calibration is not None:
+        info['calibration'] = calibration
+    logger.debug('Problem solved, route: %s.', route)
+    return TSPSolution(route, energy, mileage, info)
+
+def dwave_num_reads(number_of_locations):
+    """Return number of reads taken from D-Wave for problem of given size."""
+    return 2000 if number_of_locations > 7 else 1000
+
+def _repair_lowest(decoded, dist_matrix, start, end, dist_mul, const_mul, repair):
+    """Repair lowest-energy samples and return the shortest of repaired routes.
+
+    If repair is disabled or fails, the lowest-energy route with broken steps marked
+    with -1 is returned. Returns pair (route, energy).
+    """
+    ends = default_ends(dist_matrix.shape[0], start, end)
+    lowest = np.argsort(decoded.energies, kind='stable')[:REPAIR_CANDIDATES if repair else 1]
+    broken = [adjust_ends_acyclic(decoded.routes[index].tolist(), *ends) for index in lowest]
+    repaired = []
+    if repair:
+        repaired = [repair_route(dist_matrix, route, REPAIR_ITERATIONS) for route in broken]
+        repaired = [route for route in repaired if route is not None]
+    if not repaired:
+        return broken[0], float(decoded.energies[lowest[0]])
+    route = min(repaired, key=lambda route: calculate_mileage(dist_matrix, route))
+    return route, route_energy(dist_matrix, route, dist_mul, const_mul)
+
+def local_stages(dist_matrix, dist_mul=1, const_mul=8500, backend='qbsolv', **options):
+    """Return stages of the deadline chain solving the problem locally.
+
+    The chain consists of backend (unless it is "heuristic") and "heuristic" as the
+    last resort, see :py:func:`tsp.deadline.solve_anytime`.
+
+    :param options: keyword arguments of :py:func:`sample_from_distance_matrix`
+     (except D-Wave ones) used by the first stage. Start and end are used by both.
+    :rtype: list of tsp.deadline.Stage
+    """
+    start, end = options.get('start'), options.get('end')
+    size = qubo_size(np.shape(dist_matrix)[0], start, end)
+    max_cluster_size = options.get('max_cluster_size', DEFAULT_CLUSTER_SIZE)
+    # Time limits of samplers apply to each sub-problem (clusters and their order).
+    subproblems = 1
+    if options.get('decompose') and size > max_cluster_size:
+        subproblems = -(-np.shape(dist_matrix)[0] // max_cluster_size) + 1
+
+    def sample(budget):
+        limited = dict(options)
+        budget = SAMPLER_TIME_SHARE * budget / subproblems
+        if backend == 'anneal':
+            limited['time_limit'] = min(budget, options.get('time_limit') or np.inf)
+        elif backend == 'qbsolv':
+            limited['timeout'] = max(1, int(budget))
+        return sample_from_distance_matrix(
+            dist_matrix, dist_mul, const_mul, backend=backend, **limited)
+
+    stages = []
+    if backend not in (None, 'heuristic'):
+        stages.append(Stage(
+            backend, sample,
+            STAGE_MIN_SECONDS.get(backend, 0.0) * subproblems / SAMPLER_TIME_SHARE))
+    stages.append(Stage('heuristic', lambda budget: solve_classically(
+        dist_matrix, 'heuristic', start, end, dist_mul, const_mul), 0.0))
+    return stages
+
+def _sample_with_deadline(dist_matrix, dist_mul, const_mul, backend, time_limit_ms, options):
+    """Solve problem by chain of backends run under deadline, see :py:func:`sample_from_distance_matrix`."""
+    use_dwave = options.pop('use_dwave', False)
+    token = options.pop('dwave_token', None)
+    solver = options.pop('solver', None)
+    stages = []
+    if use_dwave and (solver is not None or options.get('solvers') is not None):
+        stages.append(Stage('dwave', lambda budget: call_with_timeout(
+            lambda: sample_from_distance_matrix(
+                dist_matrix, dist_mul, const_mul, backend=None, use_dwave=True,
+                dwave_token=token, solver=solver, **options),
+            budget), STAGE_MIN_SECONDS['dwave']))
+    stages.extend(local_stages(dist_matrix, dist_mul, const_mul, backend, **options))
+    return solve_anytime(stages, time_limit_ms)
+
+def _sample_decomposed(dist_matrix, dist_mul, const_mul, start, end, backend, repair,
+                       max_cluster_size, max_workers, kwargs):
+    """Solve problem by decomposing it into clusters, see :py:func:`sample_from_distance_matrix`.
+
+    Sub-problems whose solutions are broken are solved again classically.
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    use_dwave = kwargs.pop('use_dwave', False)
+    kwargs.pop('dwave_token', None)
+    solvers = kwargs.pop('solvers', None)
+    solutions = []
+
+    def solve_paths(matrices):
+        if use_dwave and solvers is not None:
+            batch = []
+            for matrix in matrices:
+                solver = solvers(matrix.shape[0])
+                batch.append(sample_from_distance_matrix(
+                    matrix, dist_mul, const_mul, backend=backend, repair=repair,
+                    use_dwave=solver is not None, dwave_token=None, solver=solver, **kwargs))
+        else:
+            batch = [item.solution for item in sample_batch(
+                matrices, dist_mul, const_mul, max_workers, backend=backend, repair=repair,
+                **kwargs)]
+        routes = []
+        for matrix, solution in zip(matrices, batch):
+            if solution is None or -1 in solution.route:
+                solution = solve_classically(matrix, 'auto', dist_mul=dist_mul, const_mul=const_mul)
+                solution.info['route_status'] = 'resolved'
+            solutions.append(solution)
+            routes.append(solution.route)
+        return routes
+
+    with span('decompose'):
+        decomposition = solve_decomposed(dist_matrix, solve_paths, max_cluster_size, start, end)
+    route = decomposition.route
+    mileage = calculate_mileage(dist_matrix, route)
+    normalized = dist_matrix / np.max(dist_matrix)
+    energy = route_energy(
+        normalized, route, dist_mul, resolve_const_mul(normalized, dist_mul, const_mul))
+    on_dwave = [solution for solution in solutions if solution.info['backend'] == 'dwave']
+    statuses = set(solution.info['route_status'] for solution in solutions)
+    info = {
+        'machine': 'DWAVE 2000Q' if on_dwave else 'local',
+        'backend': 'dwave' if on_dwave else backend,
+        'mileage': mileage,
+        'route_status': 'raw' if statuses <= {'raw'} else 'repaired',
+        'decomposition': {
+            'clusters': decomposition.clusters,
+            'levels': decomposition.levels,
+            'subproblems': len(solutions)}
+    }
+    if on_dwave:
+        info['total_time'] = sum(solution.info['total_time'] for solution in on_dwave)
     return TSPSolution(route, energy, mileage, info)
+
+def solve_classically(dist_matrix, backend='auto', start=None, end=None, dist_mul=1,
+                      const_mul=8500):
+    """Solve TSP using native classical algorithm, without constructing QUBO.
+
+    :param dist_matrix: distance matrix of the problem.
+    :type dist_matrix: numpy.ndarray
+    :param backend: one of the keys of :py:data:`tsp.classical.CLASSICAL_BACKENDS`.
+    :type backend: str
+    :param start: node that should appear first in the route.
+    :type start: int
+    :param end: node that should appear last in the route. If equal to start,
+     closed tour is returned.
+    :type end: int
+    :param dist_mul: multiplier of target function, used only to compute energy.
+    :type dist_mul: number
+    :param const_mul: multiplier of constraints, used only to compute energy. If
+     "auto", calibrated penalty weight is used.
+    :type const_mul: number or str
+    :returns: solution in the same format as :py:func:`sample_from_distance_matrix`.
+     Energy is the one QUBO would assign to the returned route.
+    :rtype: TSPSolution
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype='float64')
+    with span('solve'):
+        route = CLASSICAL_BACKENDS[backend](dist_matrix, start, end)
+    mileage = calculate_mileage(dist_matrix, route)
+    normalized = dist_matrix / np.max(dist_matrix)
+    energy = route_energy(
+        normalized, route, dist_mul, resolve_const_mul(normalized, dist_mul, const_mul))
+    return TSPSolution(route, energy, mileage, {
+        'machine': 'local', 'backend': backend, 'mileage': mileage, 'route_status': 'raw'})
+
+def sample_batch(problems, dist_mul=1, const_mul=8500, max_workers=None, **kwargs):
+    """Solve many independent TSP problems locally, in parallel.
+
+    Problems are grouped by their size and each group is solved in a single
+    worker process, so that distance-independent part of QUBO is computed once
+    per size (see :py:func:`tsp.qubo.qubo_template`).
+
+    :param problems: problems to solve. Each problem is either a distance matrix
+     or a mapping with "distances" key and optional "start", "end", "dist_mul",
+     "const_mul", "decompose" and "time_limit_ms" keys, overriding defaults passed to
+     this function.
+     Clusters of decomposed problems are solved in the worker solving the problem.
+    :type problems: sequence
+    :param dist_mul: default multiplier of target function.
+    :type dist_mul: number
+    :param const_mul: default multiplier of constraints.
+    :type const_mul: number
+    :param max_workers: number of worker processes (see :py:func:`batch_executor`).
+     Defaults to number of CPUs. If 1, problems are solved in the calling process.
+    :type max_workers: int
+    :param kwargs: additional keyword arguments passed to sample_qubo call.
+    :returns: sequence of namedtuples with "solution", "error" and "time" fields,
+     in the same order as problems. If solving given problem failed, its solution
+     is None and error contains the message, time is the wall time of solving in
+     seconds.
+    :rtype: list of BatchResult
+    """
+    defaults = {'start': None, 'end': None, 'dist_mul': dist_mul, 'const_mul': const_mul,
+                'decompose': False, 'time_limit_ms': None}
+    groups = defaultdict(list)
+    for index, problem in enumerate(problems):
+        if not isinstance(problem, dict):
+            problem = {'distances': problem}
+        problem = dict(defaults, **problem)
+        problem['distances'] = np.asarray(problem['distances'], dtype='float64')
+        groups[problem['distances'].shape[0]].append((index, problem))
+
+    max_workers = max_workers or os.cpu_count() or 1
+    results = [None] * len(problems)
+    if max_workers == 1 or len(problems) <= 1:
+        chunks = [_solve_chunk(chunk, kwargs) for chunk in groups.values()]
+    else:
+        executor = batch_executor(max_workers)
+        try:
+            futures = [
+                executor.submit(_solve_chunk, chunk, kwargs)
+                for chunk in _split_groups(groups, max_workers)]
+            chunks = [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A worker died, the next batch gets a new pool.
+            with _BATCH_POOLS_LOCK:
+                if _BATCH_POOLS.get(max_workers) is executor:
+                    del _BATCH_POOLS[max_workers]
+            raise
+    for chunk in chunks:
+        for index, result in chunk:
+            results[index] = result
+    return results
+
+def batch_executor(max_workers):
+    """Return pool of max_workers processes solving batches, created on first use.
+
+    The pool is kept for later batches of this process, so its workers keep QUBO
+    templates (see :py:func:`tsp.qubo.qubo_template`) computed for earlier ones.
+    Workers aren't forked from the caller, so scripts using the pool have to guard
+    their main code with ``if __name__ == '__main__'``.
+
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    with _BATCH_POOLS_LOCK:
+        executor = _BATCH_POOLS.get(max_workers)
+        if executor is None:
+            context = multiprocessing.get_context(BATCH_START_METHOD)
+            if BATCH_START_METHOD == 'forkserver':
+                context.set_forkserver_preload([__name__])
+            executor = _BATCH_POOLS[max_workers] = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=context)
+        return executor
+
+def _split_groups(groups, number_of_chunks):
+    """Split groups of problems of the same size into at most number_of_chunks chunks.
+
+    Big groups are split so that all workers are busy, but problems of the same
+    size are kept together whenever possible.
+    """
+    total = sum(len(group) for group in groups.values())
+    chunk_size = max(1, -(-total // number_of_chunks))
+    return [
+        group[i:i+chunk_size]
+        for group in groups.values()
+        for i in range(0, len(group), chunk_size)]
+
+def _solve_chunk(chunk, kwargs):
+    """Solve chunk of (index, problem) pairs, returning (index, BatchResult) pairs."""
+    results = []
+    for index, problem in chunk:
+        started = time.perf_counter()
+        try:
+            solution = sample_from_distance_matrix(
+                problem['distances'],
+                problem['dist_mul'],
+                problem['const_mul'],
+                start=problem['start'],
+                end=problem['end'],
+                decompose=problem['decompose'],
+                time_limit_ms=problem['time_limit_ms'],
+                max_workers=1,
+                **kwargs)
+            error = None
+        except Exception as exc:
+            solution, error = None, str(exc)
+        results.append((index, BatchResult(solution, error, time.perf_counter() - started)))
+    return results
@@ -1,8 +1,16 @@
 """Utility functions for the rest of TSP package."""
+from collections import OrderedDict
+from itertools import compress
+import threading
 import geopy.distance
 import numpy
 
 
+EARTH_MEAN_RADIUS = 6371.0088
+WGS84_MAJOR_AXIS = 6378137.0
+WGS84_FLATTENING = 1 / 298.257223563
+
+
 def distance(first, second):
     """Compute distance between two locations given their lat-long coordinates.
 
@@ -17,20 +25,126 @@ def distance(first, second):
     """
     return geopy.distance.distance(first, second).km
 
-def create_distance_matrix(locations):
+def create_distance_matrix(locations, model='geodesic', cache=None):
     """Compute distance matrix for given locations.
 
     :param locations: a sequence of cordinates
     :type location: sequence of pairs of floats
+    :param model: earth model used for computing distances, one of:
+     - "geodesic" (default): distances on WGS-84 ellipsoid, computed with vectorized
+       Vincenty's inverse formula. Results agree with geopy's geodesic distance within
+       1 mm, pairs for which Vincenty's iteration does not converge (nearly antipodal
+       points) are computed with geopy.
+     - "haversine": great-circle distances on a sphere of mean Earth radius. This is
+       faster, but can be off by up to 0.5% compared to the ellipsoidal model.
+    :type model: str
+    :param cache: optional cache of already computed distances, which is consulted
+     before and updated after computing the matrix.
+    :type cache: DistanceCache
     :returns: a matrix M of shape len(locations) x len(locations) such that
      M[i, j] is a distance between i-th and j-th location.
     :rtype: numpy.ndarray
     """
-    size = len(locations)
+    try:
+        engine = DISTANCE_MODELS[model]
+    except KeyError:
+        raise ValueError(
+            'Unknown distance model: {}. Available models are: {}.'.format(
+                model, ', '.join(sorted(DISTANCE_MODELS))))
+    locations = numpy.asarray(locations, dtype='float64').reshape(-1, 2)
+    size = locations.shape[0]
+    first, second = numpy.triu_indices(size, 1)
+    if cache is None:
+        distances = engine(locations[first], locations[second])
+    else:
+        distances = cache.get_many(model, locations[first], locations[second])
+        missing = numpy.isnan(distances)
+        if missing.any():
+            distances[missing] = engine(
+                locations[first[missing]], locations[second[missing]])
+            cache.set_many(
+                model, locations[first[missing]], locations[second[missing]],
+                distances[missing])
     result = numpy.zeros((size, size))
-    for i in range(size):
-        for j in range(i+1, size):
-            result[i, j] = result[j, i] = distance(locations[i], locations[j])
+    result[first, second] = result[second, first] = distances
+    return result
+
+def haversine_distances(first, second):
+    """Compute great-circle distances between corresponding pairs of locations.
+
+    :param first: array of shape (N, 2) of (lat, long) coordinates in degrees.
+    :type first: numpy.ndarray
+    :param second: array of shape (N, 2) of (lat, long) coordinates in degrees.
+    :type second: numpy.ndarray
+    :returns: array of N distances in kilometers.
+    :rtype: numpy.ndarray
+    """
+    lat1, lon1 = numpy.radians(first).T
+    lat2, lon2 = numpy.radians(second).T
+    hav = (numpy.sin((lat2 - lat1) / 2) ** 2 +
+           numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_MEAN_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(hav, 0, 1)))
+
+def geodesic_distances(first, second, tolerance=1e-12, max_iterations=200):
+    """Compute distances on WGS-84 ellipsoid between corresponding pairs of locations.
+
+    This is a vectorized implementation of Vincenty's inverse formula. For pairs for
+    which it does not converge in max_iterations, geopy's distance is used instead.
+
+    :param first: array of shape (N, 2) of (lat, long) coordinates in degrees.
+    :type first: numpy.ndarray
+    :param second: array of shape (N, 2) of (lat, long) coordinates in degrees.
+    :type second: numpy.ndarray
+    :returns: array of N distances in kilometers.
+    :rtype: numpy.ndarray
+    """
+    a, f = WGS84_MAJOR_AXIS, WGS84_FLATTENING
+    b = (1 - f) * a
+    lat1, lon1 = numpy.radians(first).T
+    lat2, lon2 = numpy.radians(second).T
+    diff_lon = lon2 - lon1
+    red_lat1 = numpy.arctan((1 - f) * numpy.tan(lat1))
+    red_lat2 = numpy.arctan((1 - f) * numpy.tan(lat2))
+    sin_u1, cos_u1 = numpy.sin(red_lat1), numpy.cos(red_lat1)
+    sin_u2, cos_u2 = numpy.sin(red_lat2), numpy.cos(red_lat2)
+
+    lambda_ = diff_lon
+    converged = numpy.zeros(diff_lon.shape, dtype=bool)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iterations):
+            sin_lambda, cos_lambda = numpy.sin(lambda_), numpy.cos(lambda_)
+            sin_sigma = numpy.hypot(
+                cos_u2 * sin_lambda,
+                cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
+            sigma = numpy.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = numpy.where(
+                sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lambda / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos_sq_alpha = 0, in which case cos_2sigma_m is 0.
+            cos_2sigma_m = numpy.where(
+                cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+            c = f / 16 * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+            previous = lambda_
+            lambda_ = diff_lon + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (
+                    cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = numpy.abs(lambda_ - previous) < tolerance
+            if converged.all():
+                break
+
+    u_sq = cos_sq_alpha * (a ** 2 - b ** 2) / b ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (
+        cos_2sigma_m + big_b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) *
+            (-3 + 4 * cos_2sigma_m ** 2)))
+    result = b * big_a * (sigma - delta_sigma) / 1000
+
+    for index in numpy.flatnonzero(~converged):
+        result[index] = distance(first[index], second[index])
     return result
 
 def calculate_mileage(distance_matrix, route):
@@ -48,7 +162,58 @@ def calculate_mileage(distance_matrix, route):
      distance_matrix is specified.
     :rtype: number
     """
-    mileage = 0
-    for i in range(len(route)-1):
-        mileage += distance_matrix[route[i], route[i+1]]
-    return mileage
+    route = numpy.asarray(route)
+    return numpy.asarray(distance_matrix)[route[:-1], route[1:]].sum()
+
+
+class DistanceCache(object):
+    """Bounded LRU cache of distances between pairs of coordinates.
+
+    Pairs are stored irrespectively of their order and coordinates are rounded
+    to given number of decimal places (default 6, i.e. about 0.1 m), so that
+    recurring locations hit the cache even if their coordinates differ slightly.
+    """
+
+    def __init__(self, maxsize=100000, precision=6):
+        self.maxsize = maxsize
+        self.precision = precision
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _keys(self, model, first, second):
+        first = numpy.round(first, self.precision).tolist()
+        second = numpy.round(second, self.precision).tolist()
+        return [(model,) + tuple(min(pair)) + tuple(max(pair))
+                for pair in zip(first, second)]
+
+    def get_many(self, model, first, second):
+        """Get cached distances for given pairs, NaN marks missing ones."""
+        keys = self._keys(model, first, second)
+        with self._lock:
+            result = numpy.array(
+                [self._data.get(key, numpy.nan) for key in keys], dtype='float64')
+            for key in compress(keys, ~numpy.isnan(result)):
+                self._data.move_to_end(key)
+        return result
+
+    def set_many(self, model, first, second, distances):
+        """Store distances for given pairs, evicting least recently used ones."""
+        keys = self._keys(model, first, second)
+        with self._lock:
+            self._data.update(zip(keys, numpy.asarray(distances).tolist()))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries from cache."""
+        with self._lock:
+            self._data.clear()
+
+
+DISTANCE_MODELS = {
+    'geodesic': geodesic_distances,
+    'haversine': haversine_distances
+}
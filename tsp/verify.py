@@ -0,0 +1,134 @@
+"""Equivalence check of the QUBO encoding against brute force.
+
+For every size, every pair of ends (start equal to end meaning a closed tour) and a
+few seeded random instances, the problem is reordered with
+:py:func:`tsp.qubo.fixed_ends_order`, its QUBO is solved exactly with dimod's
+ExactSolver and the samples are decoded with :py:func:`tsp.qubo.decode_samples`.
+The check fails unless:
+
+- the sample of the lowest energy is feasible and its route is optimal, i.e. its
+  mileage equals the one found by brute force over all routes with given ends,
+- every feasible sample decodes to a route with given ends visiting every location
+  once, and its energy equals :py:func:`tsp.qubo.route_energy` of the route.
+
+QUBOs with more than --max-variables variables (e.g. closed tours of 6 locations)
+are skipped, as ExactSolver enumerates all 2^n samples::
+
+    python -m tsp.verify --sizes 3 4 5 6
+"""
+import argparse
+import itertools
+import sys
+import dimod
+import numpy as np
+from tsp.bench import random_instance
+from tsp.qubo import best_routes, construct_bqm, decode_samples, fixed_ends_order, route_energy
+from tsp.utils import calculate_mileage
+
+
+DEFAULT_SIZES = [3, 4, 5, 6]
+MAX_VARIABLES = 16
+# Relative tolerance of compared mileages and energies.
+TOLERANCE = 1e-9
+
+
+def brute_force(dist_matrix, start, end):
+    """Return the shortest mileage of routes from start to end visiting all locations.
+
+    If start equals end, routes are closed tours.
+    """
+    inner = [node for node in range(dist_matrix.shape[0]) if node not in (start, end)]
+    return min(
+        calculate_mileage(dist_matrix, [start] + list(permutation) + [end])
+        for permutation in itertools.permutations(inner))
+
+
+def is_route(route, number_of_locations, start, end):
+    """Check that route goes from start to end and visits every location once."""
+    route = list(route)
+    visited = route[:-1] if start == end else route
+    return (route[0] == start and route[-1] == end and
+            sorted(visited) == list(range(number_of_locations)))
+
+
+def check_instance(dist_matrix, start, end, dist_mul, const_mul):
+    """Check encoding of the problem with given ends.
+
+    :returns: list of messages describing failed checks, empty if all passed.
+    :rtype: list of str
+    """
+    number_of_locations = dist_matrix.shape[0]
+    normalized = dist_matrix / np.max(dist_matrix)
+    order = fixed_ends_order(number_of_locations, start, end)
+    bqm = construct_bqm(normalized[np.ix_(order, order)], dist_mul, const_mul)
+    sampleset = dimod.ExactSolver().sample(bqm)
+    decoded = decode_samples(sampleset, number_of_locations, start, end, order)
+
+    failures = []
+    lowest = int(np.argmin(decoded.energies))
+    optimal = brute_force(dist_matrix, start, end)
+    if not decoded.feasible[lowest]:
+        failures.append('sample of the lowest energy is infeasible')
+    else:
+        mileage = best_routes(decoded, dist_matrix, 1, start, end)[0].mileage
+        if not np.isclose(mileage, optimal, rtol=TOLERANCE, atol=0):
+            failures.append('mileage {} of the lowest energy route, optimal is {}'.format(
+                mileage, optimal))
+    for route, energy in zip(decoded.routes[decoded.feasible],
+                             decoded.energies[decoded.feasible]):
+        if not is_route(route, number_of_locations, start, end):
+            failures.append('feasible sample decodes to invalid route {}'.format(route.tolist()))
+            break
+        expected = route_energy(normalized, route.tolist(), dist_mul, const_mul)
+        if not np.isclose(energy, expected, rtol=TOLERANCE, atol=TOLERANCE):
+            failures.append('energy {} of route {}, route_energy is {}'.format(
+                energy, route.tolist(), expected))
+            break
+    return failures
+
+
+def verify(sizes, trials=2, seed=0, dist_mul=10, const_mul=400, max_variables=MAX_VARIABLES):
+    """Check the encoding for all sizes, pairs of ends and trials.
+
+    :returns: triple (number of checked problems, number of skipped problems, list
+     of failures), where failures are messages prefixed with the problem.
+    :rtype: tuple
+    """
+    random_state = np.random.RandomState(seed)
+    checked, skipped, failures = 0, 0, []
+    for size in sizes:
+        instances = [random_instance(size, random_state)[1] for _ in range(trials)]
+        for start, end in itertools.product(range(size), repeat=2):
+            variables = (fixed_ends_order(size, start, end).shape[0] - 2) ** 2
+            if variables > max_variables:
+                skipped += trials
+                continue
+            for trial, dist_matrix in enumerate(instances):
+                checked += 1
+                failures.extend(
+                    'size {}, start {}, end {}, trial {}: {}'.format(size, start, end, trial, failure)
+                    for failure in check_instance(dist_matrix, start, end, dist_mul, const_mul))
+    return checked, skipped, failures
+
+
+def main(argv=None):
+    """Entry point of command line interface, exiting with status 1 if a check failed."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--trials', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dist-mul', type=float, default=10)
+    parser.add_argument('--const-mul', type=float, default=400)
+    parser.add_argument('--max-variables', type=int, default=MAX_VARIABLES)
+    args = parser.parse_args(argv)
+    checked, skipped, failures = verify(
+        args.sizes, args.trials, args.seed, args.dist_mul, args.const_mul, args.max_variables)
+    for failure in failures:
+        print(failure)
+    print('{} problems checked, {} skipped, {} failures.'.format(checked, skipped, len(failures)))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
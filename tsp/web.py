@@ -1,28 +1,65 @@
 """Module containing webservice to interact with TSP library."""
-import json
+from collections import namedtuple
 import logging
 import os
 import falcon
 import numpy as np
 from redis import StrictRedis
 from choke import RedisChokeManager, CallLimitExceededError
-from tsp.solver import sample_from_distance_matrix
-from dwave.system.samplers import DWaveSampler
-from dwave.system.composites import FixedEmbeddingComposite
-from dwave.system.composites import EmbeddingComposite
-import gc
-import math
+from tsp.assets import AssetSink, AssetStore
+from tsp.cache import SolutionCache, canonical_key
+from tsp.calibration import AUTO
+from tsp.deadline import DeadlineExceeded, Stage, call_with_timeout, solve_anytime
+from tsp.decompose import DEFAULT_CLUSTER_SIZE
+from tsp.dispatch import QPUDispatcher, QueueTimeoutError
+from tsp.fakeqpu import fake_factories
+from tsp.jobs import DONE, JobQueue, QueueFullError
+from tsp.metrics import REGISTRY, GCPolicy, profiling, span
+from tsp.qubo import qubo_size
+from tsp.registry import SolverRegistry, dwave_composite, dwave_sampler
+from tsp.solver import (
+    STAGE_MIN_SECONDS, TSPSolution, local_stages, sample_batch, sample_from_distance_matrix)
+from tsp.utils import DistanceCache, calculate_mileage, create_distance_matrix
+from tsp.wire import BINARY_MEDIA_TYPE, COORDINATES, FormatError, decode_matrix, dumps, loads
 
 # unitary:web
 BASIC_AUTH_TOKEN = 'Basic dW5pdGFyeTp3ZWI='
 STATIC_DIRECTORY = os.path.abspath(os.path.join(os.getcwd(), './build'))
-INDEX_HTML = os.path.abspath(os.path.join(STATIC_DIRECTORY, './index.html'))
 REDIS = StrictRedis(
     host=os.getenv('REDIS_HOST', 'localhost'),
     port=int(os.getenv('REDIS_PORT', '6379')),
     password=os.getenv('REDIS_PASSWORD', None))
+ASSET_STORE = AssetStore(STATIC_DIRECTORY, redis=REDIS)
 
 CHOKE_MANAGER = RedisChokeManager(REDIS)
+QPU_DISPATCHER = QPUDispatcher(
+    REDIS,
+    CHOKE_MANAGER,
+    window_length=float(os.getenv('CHOKE_WINDOW_LENGTH', '60')),
+    limit=float(os.getenv('CHOKE_LIMIT', '10')),
+    max_depth=int(os.getenv('QPU_QUEUE_DEPTH', '64')),
+    lease=float(os.getenv('QPU_LEASE', '120')))
+QPU_MAX_WAIT = float(os.getenv('QPU_MAX_WAIT', '10'))
+SOLUTION_CACHE = SolutionCache(
+    maxsize=int(os.getenv('SOLUTION_CACHE_SIZE', '1024')),
+    ttl=float(os.getenv('SOLUTION_CACHE_TTL', '3600')),
+    redis=REDIS if os.getenv('SOLUTION_CACHE_REDIS', '0') == '1' else None)
+JOB_QUEUE = JobQueue(
+    max_workers=int(os.getenv('JOB_WORKERS', '2')),
+    max_depth=int(os.getenv('JOB_QUEUE_DEPTH', '32')),
+    ttl=float(os.getenv('JOB_TTL', '600')),
+    redis=REDIS)
+JOB_MAX_WAIT = int(os.getenv('JOB_MAX_WAIT', '30'))
+CLASSICAL_BACKEND = os.getenv('CLASSICAL_BACKEND', 'qbsolv')
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '0')) or None
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '64'))
+DECOMPOSE_CLUSTER_SIZE = int(os.getenv('DECOMPOSE_CLUSTER_SIZE', str(DEFAULT_CLUSTER_SIZE)))
+DECOMPOSE_WORKERS = int(os.getenv('DECOMPOSE_WORKERS', '1'))
+DISTANCE_MODEL = os.getenv('DISTANCE_MODEL', 'geodesic')
+DISTANCE_CACHE = DistanceCache(maxsize=int(os.getenv('DISTANCE_CACHE_SIZE', '100000')))
+DEFAULT_CONST_MUL = os.getenv('DEFAULT_CONST_MUL', '400')
+GC_POLICY = GCPolicy(os.getenv('GC_POLICY', 'never'))
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '1') == '1'
 LOGGER_NAME = 'tsp.api'
 
 class AuthMiddleware(object):
@@ -34,41 +71,100 @@ class AuthMiddleware(object):
 
 
 
-logging.basicConfig(level='WARNING')
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING'))
 logging.getLogger('redis_choke').setLevel('DEBUG')
 
 DWAVE_ENDPOINT = 'https://cloud.dwavesys.com/sapi'
 DWAVE_TOKEN = os.getenv('DWAVE_TOKEN', None)
+FAKE_DWAVE = os.getenv('FAKE_DWAVE', None)
+
+if FAKE_DWAVE is not None:
+    logging.getLogger(LOGGER_NAME).warning('Using fake D-Wave sampler: %s', FAKE_DWAVE)
+    DWAVE_TOKEN = DWAVE_TOKEN or 'fake'
+    SAMPLER_FACTORY, COMPOSITE_FACTORY = fake_factories(FAKE_DWAVE)
+else:
+    SAMPLER_FACTORY, COMPOSITE_FACTORY = dwave_sampler, dwave_composite
 
 if DWAVE_TOKEN is None:
     logging.getLogger(LOGGER_NAME).warning('D-Wave token not configured. Only local requests will be supported.')
 
+SOLVER_REGISTRY = SolverRegistry(
+    DWAVE_TOKEN,
+    DWAVE_ENDPOINT,
+    embeddings_dir=os.getenv('EMBEDDINGS_DIRECTORY', 'embeddings'),
+    store_path=os.getenv('EMBEDDING_STORE', None),
+    # Embeddings found for the fake, defect-free QPU could be invalid on the real one.
+    compute_missing=FAKE_DWAVE is None and os.getenv('COMPUTE_MISSING_EMBEDDINGS', '1') == '1',
+    sampler_factory=SAMPLER_FACTORY,
+    composite_factory=COMPOSITE_FACTORY)
+if os.getenv('PRELOAD_EMBEDDINGS', '0') == '1':
+    SOLVER_REGISTRY.preload()
+
+
+REQUESTS = REGISTRY.counter(
+    'tsp_requests', 'Number of handled requests.', ['endpoint'])
+SOLUTIONS = REGISTRY.counter(
+    'tsp_solutions', 'Number of computed solutions.', ['backend', 'route_status'])
+DWAVE_FALLBACKS = REGISTRY.counter(
+    'tsp_dwave_fallbacks', 'Number of D-Wave requests solved classically.', ['reason'])
+
+
+@REGISTRY.collector
+def queue_and_cache_gauges():
+    """Report state and totals of the job queue, the solution cache and D-Wave calls."""
+    cache = SOLUTION_CACHE.info()
+    queue = JOB_QUEUE.info()
+    dispatcher = QPU_DISPATCHER.info()
+    gauges = [
+        ('tsp_cache_size', 'Number of solutions in the in-memory cache.', cache['size']),
+        ('tsp_cache_hits', 'Number of solution cache hits.', cache['hits'], 'counter'),
+        ('tsp_cache_misses', 'Number of solution cache misses.', cache['misses'], 'counter'),
+        ('tsp_jobs_pending', 'Number of queued or running jobs.', queue['depth']),
+        ('tsp_qpu_coalesce_rate', 'Fraction of D-Wave calls of this worker served by '
+         'identical calls.', dispatcher['coalesce_rate']),
+        ('tsp_qpu_timeouts', 'Number of D-Wave calls of this worker which timed out.',
+         dispatcher['timeouts'], 'counter')
+    ]
+    if dispatcher['depth'] is not None:
+        gauges.append(
+            ('tsp_qpu_queue_depth', 'Number of D-Wave calls waiting for rate limit.',
+             dispatcher['depth']))
+    return gauges
+
+
+TSPProblem = namedtuple(
+    'TSPProblem',
+    ['dist_matrix', 'dist_mul', 'const_mul', 'start', 'end', 'use_dwave', 'decompose',
+     'priority', 'max_wait', 'time_limit_ms'])
+
 
 class TSPResource(object):
     """Resource for computing TSP solution."""
-    def __init__(self):
-        self.solvers_list = {}
-        sampler = DWaveSampler(token=DWAVE_TOKEN, endpoint=DWAVE_ENDPOINT)
-        for i in range(4, 10):
-            embedding = np.load(os.path.join('embeddings', 'embedding_' + str(i) + '.npy')).item()
-            for key in embedding.keys():
-                embedding[key] = [int(item) for item in embedding[key]]
-            try:
-                self.solvers_list[i] = FixedEmbeddingComposite(sampler, embedding=embedding)
-            except Exception as e:
-                pass
-        self.backup_solver = EmbeddingComposite(sampler)
+    def __init__(self, registry):
+        self.registry = registry
 
     @staticmethod
-    @CHOKE_MANAGER.choke(
-        window_length=float(os.getenv('CHOKE_WINDOW_LENGTH')),
-        limit=float(os.getenv('CHOKE_LIMIT')))
-    def solve_using_dwave(dist_matrix, dist_mul, const_mul, start, end, solver):
-        """Solve TSP problem using D-Wave."""
+    def solve_using_dwave(dist_matrix, dist_mul, const_mul, start, end, solver, decompose=False):
+        """Solve TSP problem using D-Wave.
+
+        If decompose is True, solver should be a function mapping size of sub-problem
+        to D-Wave solver. Calls are rate-limited by QPU_DISPATCHER, see :py:meth:`solve`.
+        """
         logging.getLogger(LOGGER_NAME).info(
-            'Calling sample_from_distance_matrix with args: '
-            '%s %s %s %s %s %s %s %s',
-            dist_matrix, dist_mul, const_mul, start, end, True, solver, DWAVE_TOKEN)
+            'Solving problem of size %d (start %s, end %s, decompose %s) on D-Wave.',
+            dist_matrix.shape[0], start, end, decompose)
+        if decompose:
+            return sample_from_distance_matrix(
+                dist_matrix,
+                dist_mul,
+                const_mul,
+                start=start,
+                end=end,
+                use_dwave=True,
+                dwave_token=DWAVE_TOKEN,
+                solvers=solver,
+                decompose=True,
+                max_cluster_size=DECOMPOSE_CLUSTER_SIZE)
         return sample_from_distance_matrix(
             dist_matrix,
             dist_mul,
@@ -80,33 +176,46 @@ class TSPResource(object):
             solver=solver)
 
     @staticmethod
-    def solve_clasically(dist_matrix, dist_mul, const_mul, start, end):
-        """Solve TSP using classical emulator."""
+    def solve_clasically(dist_matrix, dist_mul, const_mul, start, end, decompose=False):
+        """Solve TSP using classical emulator selected by CLASSICAL_BACKEND."""
         return sample_from_distance_matrix(
             dist_matrix,
             dist_mul,
             const_mul,
             start=start,
-            end=end)
+            end=end,
+            backend=CLASSICAL_BACKEND,
+            decompose=decompose,
+            max_cluster_size=DECOMPOSE_CLUSTER_SIZE,
+            max_workers=DECOMPOSE_WORKERS)
 
-    def on_post(self, req, resp):
-        """The POST handler."""
-        payload = json.load(req.bounded_stream)
+    @staticmethod
+    def parse_problem(payload):
+        """Read and validate TSP problem from the request's payload.
 
+        The problem is given either as "distances" matrix or as "locations" list of
+        (latitude, longitude) pairs, from which the matrix is computed using
+        "distance_model" (defaults to DISTANCE_MODEL).
+
+        :raises falcon.HTTPBadRequest: if the payload does not describe correct problem.
+        """
         start = payload.get('start_node', None)
         end = payload.get('end_node', start)
         use_dwave = payload.get('use_dwave', False)
+        decompose = bool(payload.get('decompose', False))
 
         if use_dwave and DWAVE_TOKEN is None: # Terminate early if D-Wave solution requested
             use_dwave = False
 
 
+        if 'distances' not in payload and 'locations' in payload:
+            payload = dict(payload, distances=parse_locations(payload))
         try:
-            dist_matrix = np.array(payload['distances'], dtype='float64')
+            dist_matrix = np.asarray(payload['distances'], dtype='float64')
         except KeyError:
-            msg = 'The "distances" matrix is absent from the request.'
+            msg = 'The "distances" matrix (or "locations" list) is absent from the request.'
             raise falcon.HTTPBadRequest('Bad request', msg)
-        except ValueError:
+        except (TypeError, ValueError):
             msg = 'The "distances" field should be a correct matrix.'
             raise falcon.HTTPBadRequest('Bad request', msg)
 
@@ -114,76 +223,453 @@ class TSPResource(object):
             raise falcon.HTTPBadRequest('Bad request', 'The "distances" matrix should be square.')
 
         dist_mul = payload.get('dist_mul', 10)
-        const_mul = payload.get('const_mul', 400)
+        const_mul = payload.get(
+            'const_mul', DEFAULT_CONST_MUL if DEFAULT_CONST_MUL == AUTO else float(DEFAULT_CONST_MUL))
+        if const_mul != AUTO and (
+                isinstance(const_mul, bool) or not isinstance(const_mul, (int, float))):
+            msg = 'The "const_mul" field should be a number or "{}".'.format(AUTO)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+        try:
+            priority = int(payload.get('priority', 0))
+            max_wait = min(float(payload.get('max_wait', QPU_MAX_WAIT)), QPU_MAX_WAIT)
+        except (TypeError, ValueError):
+            msg = 'The "priority" and "max_wait" fields should be numbers.'
+            raise falcon.HTTPBadRequest('Bad request', msg)
+        time_limit_ms = payload.get('time_limit_ms', None)
+        if time_limit_ms is not None and (
+                isinstance(time_limit_ms, bool) or not isinstance(time_limit_ms, (int, float))
+                or time_limit_ms <= 0):
+            msg = 'The "time_limit_ms" field should be a positive number.'
+            raise falcon.HTTPBadRequest('Bad request', msg)
+        return TSPProblem(
+            dist_matrix, dist_mul, const_mul, start, end, use_dwave, decompose,
+            priority, max(max_wait, 0.0), time_limit_ms)
+
+    def solve(self, problem):
+        """Solve TSP problem, using D-Wave if requested and falling back to classical solver.
+
+        D-Wave calls go through QPU_DISPATCHER: identical problems being solved on
+        D-Wave by any worker are solved once, and calls over the rate limit wait
+        (ordered by the problem's priority) for at most max_wait seconds.
+
+        If the problem has time_limit_ms, D-Wave, CLASSICAL_BACKEND and heuristic are
+        run as a chain under that deadline, see :py:mod:`tsp.deadline`.
+
+        :param problem: problem to solve, as returned by :py:meth:`parse_problem`.
+        :type problem: TSPProblem
+        :rtype: TSPSolution
+        """
+        (dist_matrix, dist_mul, const_mul, start, end, use_dwave, decompose,
+         priority, max_wait, time_limit_ms) = problem
+        size = qubo_size(dist_matrix.shape[0], start, end)
+        decompose = decompose and size > DECOMPOSE_CLUSTER_SIZE
+
+        cache_key, cached = cached_solution(problem, 'dwave' if use_dwave else CLASSICAL_BACKEND)
+        if cached is not None:
+            return cached
 
         # Flag indicating whether we will need to solve classically.
         # Obviously is we dont use D-Wave this should be true already.
         classical_solution_needed = not use_dwave
-        import os
-        import psutil
-        process = psutil.Process(os.getpid())
-        print("MEMORY BEFORE:", convert_size(process.memory_info().rss))
+        result = None
+        logger = logging.getLogger(LOGGER_NAME)
 
-        if use_dwave:
-            try:
-                try:
-                    solver = self.solvers_list[int(dist_matrix.shape[0])]
-                except Exception as e:
-                    print(e)
-                    print("Problem with solver, using backup solver")
-                    solver = self.backup_solver
-                result = self.solve_using_dwave(
-                    dist_matrix,
-                    dist_mul,
-                    const_mul,
-                    start=start,
-                    end=end,
-                    solver=solver)
-                if -1 in result.route:
-                    print("D-Wave unable to find proper solution")
-                    classical_solution_needed = True
-            except CallLimitExceededError:
-                logger = logging.getLogger('tsp.api')
-                logger.warning('Throttling triggered. Classical solution will be returned')
-                classical_solution_needed = True
-            except Exception as e:
-                print("Unexpected error:", e)
-                classical_solution_needed = True
+        if use_dwave and decompose:
+            # Sub-problems get solvers of their sizes, if the sampler is available.
+            solver = self.registry.get if self.registry.sampler() is not None else None
+        else:
+            solver = self.registry.get(int(size)) if use_dwave else None
+        if use_dwave and solver is None:
+            logger.warning('D-Wave sampler unavailable. Classical solution will be returned')
+            DWAVE_FALLBACKS.inc(reason='unavailable')
+            classical_solution_needed = True
+
+        if time_limit_ms is not None:
+            return self.solve_within(problem, solver, decompose, cache_key)
+
+        if use_dwave and solver is not None:
+            result = self.call_dwave(problem, solver, decompose, cache_key, max_wait)
+            classical_solution_needed = result is None or -1 in result.route
 
         if classical_solution_needed:
-            result = self.solve_clasically(dist_matrix, dist_mul, const_mul, start=start, end=end)
-        print("MEMORY AFTER:", convert_size(process.memory_info().rss))
+            broken = use_dwave and result is not None
+            with span('fallback' if use_dwave else 'classical'):
+                result = self.solve_clasically(
+                    dist_matrix, dist_mul, const_mul, start=start, end=end, decompose=decompose)
+            if broken:
+                result.info['route_status'] = 'resolved'
+            cache_key = canonical_key(
+                dist_matrix, dist_mul, const_mul, start, end,
+                cache_backend(CLASSICAL_BACKEND, problem.decompose))
+
+        if -1 not in result.route:
+            SOLUTION_CACHE.set(cache_key, result)
+        result.info['cache'] = 'miss'
+        SOLUTIONS.inc(backend=result.info['backend'], route_status=result.info['route_status'])
+        return result
+
+    def solve_within(self, problem, solver, decompose, cache_key):
+        """Solve TSP problem with chain of backends run under problem's time limit.
+
+        :param solver: D-Wave solver (or function mapping sizes to solvers if
+         decompose is True), None if D-Wave shouldn't be used.
+        :param cache_key: key of D-Wave solution in SOLUTION_CACHE.
+        :rtype: TSPSolution
+        """
+        stages = []
+        if solver is not None:
+            def dwave(budget):
+                try:
+                    return call_with_timeout(
+                        lambda: self.call_dwave(
+                            problem, solver, decompose, cache_key, min(problem.max_wait, budget)),
+                        budget)
+                except DeadlineExceeded:
+                    logging.getLogger(LOGGER_NAME).warning(
+                        'D-Wave missed the deadline. Classical solution will be returned')
+                    DWAVE_FALLBACKS.inc(reason='deadline')
+                    raise
+            stages.append(Stage('dwave', dwave, STAGE_MIN_SECONDS['dwave']))
+        stages.extend(local_stages(
+            problem.dist_matrix,
+            problem.dist_mul,
+            problem.const_mul,
+            CLASSICAL_BACKEND,
+            start=problem.start,
+            end=problem.end,
+            decompose=decompose,
+            max_cluster_size=DECOMPOSE_CLUSTER_SIZE,
+            max_workers=DECOMPOSE_WORKERS))
+        with span('deadline'):
+            result = solve_anytime(stages, problem.time_limit_ms)
+        if result.info['deadline']['stage'] != 'dwave':
+            cache_key = canonical_key(
+                problem.dist_matrix, problem.dist_mul, problem.const_mul, problem.start,
+                problem.end, cache_backend(result.info['backend'], problem.decompose))
+        if -1 not in result.route:
+            SOLUTION_CACHE.set(cache_key, result)
+        result.info['cache'] = 'miss'
+        SOLUTIONS.inc(backend=result.info['backend'], route_status=result.info['route_status'])
+        return result
+
+    def call_dwave(self, problem, solver, decompose, cache_key, max_wait):
+        """Solve TSP problem on D-Wave through QPU_DISPATCHER.
+
+        :returns: solution, or None if D-Wave couldn't be used. Failures and broken
+         solutions are counted in DWAVE_FALLBACKS.
+        :rtype: TSPSolution
+        """
+        logger = logging.getLogger(LOGGER_NAME)
+        try:
+            result = QPU_DISPATCHER.dispatch(
+                cache_key,
+                lambda: self.solve_using_dwave(
+                    problem.dist_matrix,
+                    problem.dist_mul,
+                    problem.const_mul,
+                    start=problem.start,
+                    end=problem.end,
+                    solver=solver,
+                    decompose=decompose),
+                problem.priority,
+                max_wait)
+        except QueueTimeoutError:
+            logger.warning('D-Wave queue timed out. Classical solution will be returned')
+            DWAVE_FALLBACKS.inc(reason='timeout')
+            return None
+        except QueueFullError:
+            logger.warning('D-Wave queue is full. Classical solution will be returned')
+            DWAVE_FALLBACKS.inc(reason='queue_full')
+            return None
+        except CallLimitExceededError:
+            logger.warning('Throttling triggered. Classical solution will be returned')
+            DWAVE_FALLBACKS.inc(reason='throttled')
+            return None
+        except Exception as e:
+            logger.exception('Unexpected error: %s', e)
+            DWAVE_FALLBACKS.inc(reason='error')
+            return None
+        if -1 in result.route:
+            logger.info('D-Wave unable to find proper solution')
+            DWAVE_FALLBACKS.inc(reason='broken')
+        return result
+
+    def on_post(self, req, resp):
+        """The POST handler.
+
+        Passing "profile" query parameter adds durations of solving stages to the
+        response (under "profile" key), unless profiling is disabled.
+        """
+        REQUESTS.inc(endpoint='solve')
+        with profiling(PROFILING_ENABLED and req.get_param_as_bool('profile')) as profile:
+            with span('parse'):
+                payload = read_payload(req)
+                problem = self.parse_problem(payload)
+            result = self.solve(problem)
+        body = solution_to_dict(result)
+        if profile is not None:
+            body['profile'] = profile.to_dict()
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = dumps(body)
+        GC_POLICY.after_request()
+
+
+class JobsResource(object):
+    """Resource for submitting TSP problems to be solved asynchronously."""
+
+    def __init__(self, tsp_resource, queue):
+        self.tsp_resource = tsp_resource
+        self.queue = queue
+
+    def on_post(self, req, resp):
+        """The POST handler, accepts the same payload as /tsp/solve."""
+        REQUESTS.inc(endpoint='jobs')
+        payload = read_payload(req)
+        problem = self.tsp_resource.parse_problem(payload)
+        try:
+            job = self.queue.submit(self.tsp_resource.solve, problem)
+        except QueueFullError as error:
+            raise falcon.HTTPServiceUnavailable(
+                'Service unavailable', str(error), retry_after=1)
+        resp.status = falcon.HTTP_202
+        resp.location = '/tsp/jobs/' + job.job_id
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = dumps(job.to_dict())
+
 
+class JobResource(object):
+    """Resource for polling status and result of asynchronous job.
+
+    Passing "wait" query parameter makes the request block for at most that many
+    seconds (capped by JOB_MAX_WAIT) until the job finishes.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def on_get(self, req, resp, job_id):
+        """The GET handler."""
+        wait = min(req.get_param_as_int('wait') or 0, JOB_MAX_WAIT)
+        job = self.queue.wait(job_id, wait) if wait > 0 else self.queue.get(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound()
+        body = job.to_dict()
+        if job.status == DONE:
+            body['result'] = solution_to_dict(job.result)
         resp.content_type = falcon.MEDIA_JSON
-        resp.body = json.dumps({
-            'route': result.route,
-            'distance': result.mileage,
-            'energy': result.energy,
-            'info': result.info,
-        })
-        gc.collect()
+        resp.body = dumps(body)
+
+
+class BatchResource(object):
+    """Resource for solving many independent TSP problems at once.
+
+    Problems are solved locally, in parallel, using pool of BATCH_WORKERS processes.
+    """
+
+    def on_post(self, req, resp):
+        """The POST handler, accepts {"problems": [...]} where each problem has the
+        same format as payload of /tsp/solve."""
+        REQUESTS.inc(endpoint='solve_batch')
+        payload = read_payload(req, binary=False)
+        try:
+            problems = [TSPResource.parse_problem(item) for item in payload['problems']]
+        except (KeyError, TypeError, AttributeError):
+            msg = 'The "problems" field should be a list of problems.'
+            raise falcon.HTTPBadRequest('Bad request', msg)
+        if len(problems) > BATCH_MAX_SIZE:
+            msg = 'At most {} problems can be solved in one batch.'.format(BATCH_MAX_SIZE)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+        results = [None] * len(problems)
+        cache_keys = {}
+        for index, problem in enumerate(problems):
+            cache_keys[index], cached = cached_solution(problem, CLASSICAL_BACKEND)
+            if cached is not None:
+                results[index] = {'result': solution_to_dict(cached), 'error': None, 'time': 0.0}
+        missing = [index for index, result in enumerate(results) if result is None]
+        batch = sample_batch(
+            [{'distances': problems[index].dist_matrix,
+              'dist_mul': problems[index].dist_mul,
+              'const_mul': problems[index].const_mul,
+              'start': problems[index].start,
+              'end': problems[index].end,
+              'decompose': problems[index].decompose,
+              'time_limit_ms': problems[index].time_limit_ms} for index in missing],
+            max_workers=BATCH_WORKERS,
+            backend=CLASSICAL_BACKEND,
+            max_cluster_size=DECOMPOSE_CLUSTER_SIZE)
+        for index, item in zip(missing, batch):
+            if item.solution is not None:
+                problem = problems[index]
+                if problem.time_limit_ms is not None:
+                    # Stages of the deadline chain are cached under their backends.
+                    cache_keys[index] = canonical_key(
+                        problem.dist_matrix, problem.dist_mul, problem.const_mul,
+                        problem.start, problem.end,
+                        cache_backend(item.solution.info['backend'], problem.decompose))
+                if -1 not in item.solution.route:
+                    SOLUTION_CACHE.set(cache_keys[index], item.solution)
+                item.solution.info['cache'] = 'miss'
+            results[index] = {
+                'result': solution_to_dict(item.solution) if item.solution else None,
+                'error': item.error,
+                'time': item.time
+            }
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = dumps({'results': results})
+        GC_POLICY.after_request()
+
+
+class CacheStatsResource(object):
+    """Resource exposing statistics of the solution cache."""
+
+    def on_get(self, req, resp):
+        """The GET handler."""
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = dumps(SOLUTION_CACHE.info())
+
+
+class AssetsResource(object):
+    """Resource exposing statistics of in-memory static files and reloading them."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def on_get(self, req, resp):
+        """The GET handler."""
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = dumps(self.store.info())
+
+    def on_post(self, req, resp):
+        """The POST handler, reloads files from the build directory in all workers."""
+        if req.get_header('Authorization') != BASIC_AUTH_TOKEN:
+            raise falcon.HTTPUnauthorized(
+                'Authentication required',
+                headers=[('WWW-Authenticate', 'Basic realm=Authorization Required')])
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = dumps(self.store.reload())
+
+
+class MetricsResource(object):
+    """Resource exposing metrics of this worker in Prometheus text format."""
+
+    def on_get(self, req, resp):
+        """The GET handler."""
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.body = REGISTRY.render()
+
+
+def cached_solution(problem, backend):
+    """Look up solution of the problem in SOLUTION_CACHE.
+
+    :returns: pair (key, solution), where solution is None if there is no cached
+     solution, and key can be used for storing the solution later.
+    """
+    dist_matrix, dist_mul, const_mul, start, end, _, decompose, _, _, _ = problem
+    key = canonical_key(
+        dist_matrix, dist_mul, const_mul, start, end, cache_backend(backend, decompose))
+    cached, tier = SOLUTION_CACHE.get(key)
+    if cached is None:
+        return key, None
+    # Mileage depends on the scale of distances, which is not part of the key.
+    mileage = calculate_mileage(dist_matrix, cached.route)
+    info = dict(cached.info, mileage=mileage, cache=tier)
+    # Report of the deadline chain describes the request which computed the solution.
+    info.pop('deadline', None)
+    return key, TSPSolution(cached.route, cached.energy, mileage, info)
+
+def read_payload(req, binary=True):
+    """Read payload of the request, which is JSON or (if binary) BINARY_MEDIA_TYPE.
+
+    Binary requests contain just the distance matrix or locations (see
+    :py:mod:`tsp.wire`), remaining fields of the payload are read from the query
+    string, e.g. POST /tsp/solve?start_node=0&use_dwave=true.
+
+    :raises falcon.HTTPBadRequest: if the request cannot be decoded.
+    """
+    media_type = (req.content_type or '').split(';')[0].strip()
+    data = req.bounded_stream.read()
+    if binary and media_type == BINARY_MEDIA_TYPE:
+        try:
+            layout, array = decode_matrix(data)
+        except FormatError as error:
+            raise falcon.HTTPBadRequest('Bad request', str(error))
+        payload = query_payload(req)
+        payload['locations' if layout == COORDINATES else 'distances'] = array
+        return payload
+    try:
+        payload = loads(data)
+    except ValueError:
+        raise falcon.HTTPBadRequest('Bad request', 'The request should be a JSON document.')
+    if not isinstance(payload, dict):
+        raise falcon.HTTPBadRequest('Bad request', 'The request should be a JSON object.')
+    return payload
+
+def query_payload(req):
+    """Read fields of the payload of binary request from its query string."""
+    payload = {}
+    for name in ('start_node', 'end_node', 'priority'):
+        if req.get_param(name) is not None:
+            payload[name] = req.get_param_as_int(name)
+    for name in ('use_dwave', 'decompose'):
+        if req.get_param(name) is not None:
+            payload[name] = req.get_param_as_bool(name)
+    for name in ('dist_mul', 'const_mul', 'max_wait', 'time_limit_ms'):
+        value = req.get_param(name)
+        if value is None or (name == 'const_mul' and value == AUTO):
+            payload[name] = value
+            continue
+        try:
+            payload[name] = float(value)
+        except ValueError:
+            raise falcon.HTTPInvalidParam('The value should be a number.', name)
+    if req.get_param('distance_model') is not None:
+        payload['distance_model'] = req.get_param('distance_model')
+    return {name: value for name, value in payload.items() if value is not None}
+
+def parse_locations(payload):
+    """Compute distance matrix of "locations" of the payload.
+
+    :raises falcon.HTTPBadRequest: if locations or distance model are incorrect.
+    """
+    try:
+        locations = np.asarray(payload['locations'], dtype='float64')
+    except (TypeError, ValueError):
+        locations = None
+    if locations is None or locations.ndim != 2 or locations.shape[1] != 2:
+        msg = 'The "locations" field should be a list of (latitude, longitude) pairs.'
+        raise falcon.HTTPBadRequest('Bad request', msg)
+    try:
+        return create_distance_matrix(
+            locations, payload.get('distance_model', DISTANCE_MODEL), DISTANCE_CACHE)
+    except ValueError as error:
+        raise falcon.HTTPBadRequest('Bad request', str(error))
+
+def cache_backend(backend, decompose):
+    """Return name of the backend under which solutions are cached."""
+    return backend + '/decomposed' if decompose else backend
+
+def solution_to_dict(result):
+    """Convert TSPSolution to a JSON-serializable dictionary returned by the API."""
+    return {
+        'route': result.route,
+        'distance': result.mileage,
+        'energy': result.energy,
+        'info': result.info,
+    }
 
 # api = falcon.API(middleware=[
 #                      AuthMiddleware()
 #                  ])
 api = falcon.API()
 
-def index_html_sink(req, resp):
-    resp.content_type = 'text/html; charset=utf-8'
-
-    with open(INDEX_HTML, 'rt') as f:
-        resp.body = f.read()
-
-api.add_sink(index_html_sink, prefix='^/$')
-api.add_static_route('/', STATIC_DIRECTORY)
-api.add_route('/tsp/solve', TSPResource())
-
+api.add_sink(AssetSink(ASSET_STORE), prefix='^/')
+TSP_RESOURCE = TSPResource(SOLVER_REGISTRY)
+api.add_route('/tsp/solve', TSP_RESOURCE)
+api.add_route('/tsp/jobs', JobsResource(TSP_RESOURCE, JOB_QUEUE))
+api.add_route('/tsp/jobs/{job_id}', JobResource(JOB_QUEUE))
+api.add_route('/tsp/solve_batch', BatchResource())
+api.add_route('/tsp/cache', CacheStatsResource())
+api.add_route('/tsp/assets', AssetsResource(ASSET_STORE))
+api.add_route('/metrics', MetricsResource())
 
-def convert_size(size_bytes):
-    if size_bytes == 0:
-        return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
-    return "%s %s" % (s, size_name[i])
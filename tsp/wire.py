@@ -0,0 +1,130 @@
+"""Wire formats of the web API: compact binary distance matrices and fast JSON.
+
+Binary requests (content type BINARY_MEDIA_TYPE) consist of a 12-byte header
+followed by little-endian floating point numbers::
+
+    magic    4 bytes   b"TSPM"
+    version  uint8     1
+    dtype    uint8     4 (float32) or 8 (float64)
+    layout   uint8     0 (full matrix), 1 (upper triangle) or 2 (coordinates)
+    reserved uint8     0
+    size     uint32    number of locations n (at least 2)
+
+The full layout contains n * n distances in row-major order, the upper triangle
+layout contains n * (n - 1) / 2 distances above the diagonal in row-major order
+(i.e. d[0, 1], d[0, 2], ..., d[1, 2], ...), and the coordinates layout contains n
+(latitude, longitude) pairs. Data is decoded with numpy.frombuffer, i.e. without
+parsing text and (for full float64 matrices) without copying.
+
+JSON is encoded with orjson if it is installed, and with the standard library
+otherwise.
+"""
+import json
+import struct
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BINARY_MEDIA_TYPE = 'application/x-tsp-matrix'
+MAGIC = b'TSPM'
+VERSION = 1
+HEADER = struct.Struct('<4sBBBBI')
+
+FULL = 0
+UPPER = 1
+COORDINATES = 2
+LAYOUTS = (FULL, UPPER, COORDINATES)
+DTYPES = {4: np.dtype('<f4'), 8: np.dtype('<f8')}
+
+
+class FormatError(ValueError):
+    """Raised when binary request is malformed."""
+
+
+def encode_matrix(matrix, layout=UPPER, dtype='float64'):
+    """Encode distance matrix (or coordinates) in binary format.
+
+    :param matrix: square distance matrix, or n x 2 array of coordinates if layout
+     is COORDINATES.
+    :type matrix: numpy.ndarray
+    :param layout: one of FULL, UPPER or COORDINATES.
+    :type layout: int
+    :param dtype: "float32" or "float64".
+    :type dtype: str
+    :rtype: bytes
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    matrix = np.asarray(matrix, dtype=dtype)
+    if layout == UPPER:
+        data = matrix[np.triu_indices(matrix.shape[0], 1)]
+    elif layout in (FULL, COORDINATES):
+        data = matrix.ravel()
+    else:
+        raise ValueError('Unknown layout: {}.'.format(layout))
+    header = HEADER.pack(MAGIC, VERSION, dtype.itemsize, layout, 0, matrix.shape[0])
+    return header + np.ascontiguousarray(data).tobytes()
+
+
+def decode_matrix(data):
+    """Decode binary request produced by :py:func:`encode_matrix`.
+
+    :param data: body of the request.
+    :type data: bytes
+    :returns: pair (layout, array), where array is a float64 distance matrix, or n x 2
+     array of coordinates if layout is COORDINATES. The array may be read-only.
+    :rtype: tuple
+    :raises FormatError: if data is malformed.
+    """
+    if len(data) < HEADER.size:
+        raise FormatError('Binary request is shorter than its header.')
+    magic, version, itemsize, layout, _, size = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise FormatError('Binary request should start with {!r} version {}.'.format(
+            MAGIC.decode(), VERSION))
+    if itemsize not in DTYPES:
+        raise FormatError('Binary request should contain float32 or float64 numbers.')
+    if layout not in LAYOUTS:
+        raise FormatError('Unknown layout of binary request: {}.'.format(layout))
+    if size < 2:
+        raise FormatError('Binary request should describe at least 2 locations.')
+    count = {FULL: size * size, UPPER: size * (size - 1) // 2, COORDINATES: 2 * size}[layout]
+    if len(data) != HEADER.size + count * itemsize:
+        raise FormatError('Binary request should contain {} numbers after its header.'.format(
+            count))
+    values = np.frombuffer(data, dtype=DTYPES[itemsize], count=count, offset=HEADER.size)
+    if layout == COORDINATES:
+        return layout, values.reshape(size, 2).astype('float64', copy=False)
+    if layout == FULL:
+        return layout, values.reshape(size, size).astype('float64', copy=False)
+    matrix = np.zeros((size, size))
+    matrix[np.triu_indices(size, 1)] = values
+    return layout, matrix + matrix.T
+
+
+def loads(data):
+    """Decode JSON document.
+
+    :raises ValueError: if data is not a valid JSON document.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """Encode object as JSON string, accepting NumPy arrays and scalars."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj, default=_default)
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('Object of type {} is not JSON serializable.'.format(type(obj).__name__))